@@ -0,0 +1,69 @@
+"""Compare the throughput of the supported hash algorithms
+
+Hashes a random buffer with each algorithm of `keypass_sync.hashing`, by
+chunks as the sync engine does, and reports the median throughput of
+several runs. The algorithms whose dependencies are missing (e.g. xxh3
+without the xxhash package) are reported as unavailable.
+
+Usage:
+
+    python benchmarks/bench_hash.py [--size 256M] [--runs 5]
+        [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+from pathlib import Path
+
+from keypass_sync import hashing
+
+size_units = dict(K=1024, M=1024 ** 2, G=1024 ** 3)
+
+
+def parse_size(size: str)->int:
+    if size[-1].upper() in size_units:
+        return int(float(size[:-1]) * size_units[size[-1].upper()])
+    return int(size)
+
+
+def throughput(algorithm: str, data: bytes, runs: int)->float:
+    """Return the median throughput of `algorithm` on `data`, in MiB/s"""
+    view = memoryview(data)
+    chunks = [view[start:start + hashing.default_chunk_size]
+              for start in range(0, len(view), hashing.default_chunk_size)]
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        hashing.hash_chunks(chunks, algorithm)
+        durations.append(time.perf_counter() - start)
+    return len(data) / statistics.median(durations) / size_units['M']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', default='256M')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', type=Path)
+    arguments = parser.parse_args(argv)
+
+    data = os.urandom(parse_size(arguments.size))
+    results = {}
+    for algorithm in hashing.algorithms:
+        try:
+            results[algorithm] = dict(mib_per_second=round(
+                throughput(algorithm, data, arguments.runs), 1))
+        except ValueError as error:
+            results[algorithm] = dict(unavailable=str(error))
+    result = dict(size=len(data), runs=arguments.runs,
+                  default_algorithm=hashing.default_algorithm,
+                  algorithms=results)
+    print(json.dumps(result, indent=2))
+    if arguments.output:
+        arguments.output.write_text(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Check the start-up time of the command-line tool
+
+Runs `python -X importtime -m keypass_sync help` several times and reports
+the time spent importing the package. Fails (exit code 1) if:
+
+* the median import time of the package exceeds the budget
+* the google-api stack was imported: it should only be imported once a
+  network operation is actually needed
+
+Usage:
+
+    python benchmarks/bench_startup.py [--runs 10] [--budget-ms 100]
+        [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+# Modules that should not be imported to display the help
+lazy_modules = ('google', 'googleapiclient', 'google_services', 'httplib2')
+
+
+def import_times(command: list)->dict:
+    """Run `command` with `-X importtime`
+
+    Returns:
+        dict giving the cumulative import time of each imported module, in
+        microseconds, and whether it was imported at the top level (not by
+        another module): {module: (cumulative, top_level)}
+    """
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [str(Path(__file__).parents[1] / 'src')]
+        + [path for path in sys.path if path]))
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + command,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True,
+        env=environment).stderr.decode()
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        times[module.strip()] = (int(cumulative),
+                                 not module[1:].startswith(' '))
+    return times
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float, default=100.)
+    parser.add_argument('--output', type=Path)
+    arguments = parser.parse_args(argv)
+
+    package_times = []
+    eagerly_imported = set()
+    for _ in range(arguments.runs):
+        times = import_times(['-m', 'keypass_sync', 'help'])
+        package_times.append(sum(
+            cumulative for module, (cumulative, top_level) in times.items()
+            if top_level and module.startswith('keypass_sync')) / 1000)
+        eagerly_imported.update(
+            module for module in times
+            if module.split('.')[0] in lazy_modules)
+
+    result = dict(median_ms=statistics.median(package_times),
+                  min_ms=min(package_times), max_ms=max(package_times),
+                  budget_ms=arguments.budget_ms,
+                  eagerly_imported=sorted(eagerly_imported))
+    print(json.dumps(result))
+    if arguments.output:
+        arguments.output.write_text(json.dumps(result, indent=2))
+    if result['median_ms'] > arguments.budget_ms or eagerly_imported:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
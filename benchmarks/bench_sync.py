@@ -0,0 +1,297 @@
+"""Benchmark the sync engine against a local stand-in for the google drive
+
+Each scenario runs in its own process, against a `LocalDirectoryBackend`
+(or an `InMemoryBackend`, see `--backend`), and records:
+
+* `wall_time`: duration of the sync operation, in seconds
+* `peak_rss`: peak resident memory of the process, in bytes
+* `bytes_read`: bytes read from the file system by the process (linux only)
+* `bytes_hashed`: bytes fed to the hash functions, the chunk hashes of
+  the chunked mode included
+
+The syncs use the options of a profile with the default settings, as
+`sync_version` does. `--set KEY=VALUE` changes a setting, as
+`python -m keypass_sync set` does, e.g. to enable the content cache and
+the snapshots.
+
+Usage:
+
+    python benchmarks/bench_sync.py [--sizes 100K,1M,10M,100M,1G]
+        [--scenarios no-op,local-changed,...] [--backend local|memory]
+        [--set history_keep=10 ...]
+        [--output results.json] [--compare previous_results.json]
+
+The results are written as json, with the commit they were measured on, so
+that two runs can be compared with `--compare`.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from keypass_sync import chunking, config, downloads, hashing, sync_utils, \
+    uploads
+from keypass_sync.backends.local import LocalDirectoryBackend
+from keypass_sync.backends.memory import InMemoryBackend
+
+scenarios = ('no-op', 'local-changed', 'remote-changed', 'first-sync',
+             'force-update-cloud', 'force-update-local')
+size_units = dict(K=1024, M=1024 ** 2, G=1024 ** 3)
+write_chunk_size = 16 * 1024 * 1024
+
+
+def parse_size(size: str)->int:
+    if size[-1].upper() in size_units:
+        return int(float(size[:-1]) * size_units[size[-1].upper()])
+    return int(size)
+
+
+def write_random_file(path: Path, size: int)->None:
+    with path.open('wb') as file:
+        for start in range(0, size, write_chunk_size):
+            file.write(os.urandom(min(write_chunk_size, size - start)))
+
+
+def change_end_of_file(path: Path)->None:
+    """Modify a file in place, keeping its size"""
+    with path.open('r+b') as file:
+        file.seek(max(0, path.stat().st_size - 16))
+        file.write(os.urandom(16))
+
+
+def make_old(path: Path)->None:
+    """Back-date a file so that its stat-fingerprint is trusted"""
+    os.utime(str(path), ns=(0, 0))
+
+
+class HashCounter:
+    """Count the bytes fed to the hash functions, once `install`ed
+
+    Every hasher of the package is a `hashing.Hasher`, whatever the module
+    that made it: their `update` is counted, with the chunk hashes.
+    """
+    bytes_hashed = 0
+
+    @classmethod
+    def install(cls)->None:
+        update = hashing.Hasher.update
+        chunk_hash = chunking.chunk_hash
+
+        def counting_update(hasher, data)->None:
+            cls.bytes_hashed += len(data)
+            update(hasher, data)
+
+        def counting_chunk_hash(data)->str:
+            cls.bytes_hashed += len(data)
+            return chunk_hash(data)
+
+        hashing.Hasher.update = counting_update
+        chunking.chunk_hash = counting_chunk_hash
+
+
+def bytes_read()->int:
+    """Bytes read by the process so far, or None if unknown"""
+    try:
+        with open('/proc/self/io') as io_stats:
+            for line in io_stats:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def peak_rss()->int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on linux, bytes on macos
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def make_backend(kind: str, root_path: Path):
+    if kind == 'memory':
+        return InMemoryBackend()
+    return LocalDirectoryBackend(root_path / 'cloud')
+
+
+def set_remote(backend, data_path: Path)->None:
+    if isinstance(backend, InMemoryBackend):
+        backend.put('db', data_path.read_bytes())
+    else:
+        with data_path.open('rb') as data_file:
+            backend.upload_from(data_file, 'db', 'db')
+
+
+def run_scenario(scenario: str, size: int, backend_kind: str,
+                 settings: dict, results)->None:
+    """Set a scenario up, time it and put its measures in `results`"""
+    root_path = Path(tempfile.mkdtemp(prefix='keypass_sync_bench_'))
+    try:
+        results.put(_run_scenario(scenario, size, backend_kind, settings,
+                                  root_path))
+    finally:
+        shutil.rmtree(str(root_path))
+
+
+def _run_scenario(scenario: str, size: int, backend_kind: str,
+                  settings: dict, root_path: Path)->dict:
+    local_file_path = root_path / 'db.kdbx'
+    cache_folder_path = root_path / 'cache'
+    # Keep the state store out of the user's config folder
+    config.default_config_path = str(root_path / 'config') + '/'
+    config.state_store().put_config('default', dict(
+        settings, local_file_path=str(local_file_path), cloud_file_id='db',
+        cache_folder=str(cache_folder_path)))
+    options = config.sync_options()
+    options.pop('folder_workers', None)
+    backend = make_backend(backend_kind, root_path)
+
+    write_random_file(local_file_path, size)
+    set_remote(backend, local_file_path)
+    if scenario not in ('first-sync', 'force-update-cloud',
+                        'force-update-local'):
+        sync_utils.sync(local_file_path, 'db', cache_folder_path,
+                        backend=backend, **options)
+        make_old(local_file_path)
+        # Trust the fingerprint: the file is old enough now
+        sync_utils.cache_fingerprint(
+            sync_utils.get_fingerprint(local_file_path), cache_folder_path)
+    if scenario == 'local-changed':
+        change_end_of_file(local_file_path)
+    if scenario == 'remote-changed':
+        changed_path = root_path / 'changed'
+        write_random_file(changed_path, size)
+        set_remote(backend, changed_path)
+        changed_path.unlink()
+    if scenario == 'force-update-local':
+        write_random_file(local_file_path, size)
+
+    HashCounter.install()
+    read_before = bytes_read()
+    start = time.perf_counter()
+
+    if scenario == 'force-update-cloud':
+        sync_utils.update_cloud(
+            local_file_path, 'db', cache_folder_path, backend=backend,
+            chunk_size=options.get('upload_chunk_size',
+                                   uploads.default_chunk_size),
+            algorithm=options.get('hash_algorithm',
+                                  hashing.default_algorithm),
+            content_cache=options['content_cache'],
+            snapshots=options['snapshots'])
+    elif scenario == 'force-update-local':
+        metadata = backend.get_metadata('db')
+        downloaded_file_path, data_hash = sync_utils.download_next_to(
+            local_file_path, 'db', backend, metadata,
+            chunk_size=options.get('download_chunk_size',
+                                   downloads.default_chunk_size),
+            max_workers=options.get(
+                'download_workers', downloads.default_max_workers),
+            algorithm=options.get('hash_algorithm',
+                                  hashing.default_algorithm),
+            content_cache=options['content_cache'])
+        sync_utils.update_local(local_file_path, downloaded_file_path,
+                                cache_folder_path, metadata, data_hash,
+                                snapshots=options['snapshots'])
+    else:
+        sync_utils.sync(local_file_path, 'db', cache_folder_path,
+                        backend=backend, **options)
+
+    wall_time = time.perf_counter() - start
+    read_after = bytes_read()
+    return dict(
+        scenario=scenario, size=size, backend=backend_kind,
+        wall_time=wall_time, peak_rss=peak_rss(),
+        bytes_read=None if read_before is None else read_after - read_before,
+        bytes_hashed=HashCounter.bytes_hashed)
+
+
+def measure(scenario: str, size: int, backend_kind: str,
+            settings: dict=None)->dict:
+    """Run a scenario in a fresh process, so that memory measures are its own
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=run_scenario,
+                              args=(scenario, size, backend_kind,
+                                    settings or {}, results))
+    process.start()
+    while True:
+        try:
+            result = results.get(timeout=1.)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError(
+                    f'Scenario {scenario} failed for size {size}')
+    process.join()
+    return result
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, check=True,
+            cwd=str(Path(__file__).parent)).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, reference_results: list)->None:
+    """Print the ratio of each measure to the one of the reference run"""
+    references = {(result['scenario'], result['size'], result['backend']):
+                  result for result in reference_results}
+    for result in results:
+        reference = references.get(
+            (result['scenario'], result['size'], result['backend']))
+        if reference is None:
+            continue
+        ratios = ', '.join(
+            f'{key} x{result[key] / reference[key]:.2f}'
+            for key in ('wall_time', 'peak_rss', 'bytes_read', 'bytes_hashed')
+            if result[key] is not None and reference[key])
+        print(f'{result["scenario"]:>18} {result["size"]:>12}: {ratios}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='100K,1M,10M,100M,1G')
+    parser.add_argument('--scenarios', default=','.join(scenarios))
+    parser.add_argument('--backend', choices=['local', 'memory'],
+                        default='local')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='KEY=VALUE')
+    parser.add_argument('--output', type=Path)
+    parser.add_argument('--compare', type=Path)
+    arguments = parser.parse_args(argv)
+    settings = dict(setting.split('=', 1) for setting in arguments.set)
+
+    results = []
+    for size in map(parse_size, arguments.sizes.split(',')):
+        for scenario in arguments.scenarios.split(','):
+            if scenario not in scenarios:
+                parser.error(f'unknown scenario: {scenario}')
+            result = measure(scenario, size, arguments.backend, settings)
+            results.append(result)
+            print(json.dumps(result))
+
+    report = dict(commit=current_commit(), python=platform.python_version(),
+                  platform=platform.platform(), time=time.time(),
+                  settings=settings, results=results)
+    if arguments.output:
+        arguments.output.write_text(json.dumps(report, indent=2))
+    if arguments.compare:
+        compare(results, json.loads(arguments.compare.read_text())['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -47,6 +47,11 @@ setup_params = dict(
         "pathlib",
         "setuptools",
         "google_services",
+        "google-api-python-client",
+        "google-auth",
+        "google-auth-httplib2",
+        "google-auth-oauthlib",
+        "httplib2",
     ],
 )
 
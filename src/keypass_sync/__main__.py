@@ -3,16 +3,19 @@
 """
 
 import sys
-import pprint
 from keypass_sync.utilities import logger, log_and_exit
-from keypass_sync import config
-from keypass_sync.sync_utils import sync, update_cloud, update_local, \
-    read_data_from_file, drive
+from keypass_sync import config, downloads, locking, uploads
+from keypass_sync.backends import google_drive_client
+from keypass_sync.sync_utils import sync_version, sync_all, update_cloud, \
+    update_cloud_chunked, update_local, download_next_to, \
+    download_chunks_next_to, uploaded, downloaded, failed
+from keypass_sync.chunking import default_average_size, fetch_manifest
+from keypass_sync.hashing import default_algorithm
 
 
 if __name__ == "__main__":
     logger.info('start of the project cration script')
-    logger.info(f'script argument: {pprint.pformat(sys.argv)}')
+    logger.info(f'script argument: {sys.argv}')
 
     if len(sys.argv) > 1 and (sys.argv[1] == 'help' or sys.argv[1] == '-h'):
         print('\n'
@@ -21,17 +24,37 @@ if __name__ == "__main__":
               'python -m keypass_sync [sync] -> sync file with drive ('
               'fails if both were updated since last sync)\n\n'
               'python -m keypass_sync init -> setup SSO & file to think\n\n'
+              'python -m keypass_sync sync --all -> sync every configured '
+              'file, in parallel, and print a summary\n\n'
+              'python -m keypass_sync sync --no-wait -> exit at once if '
+              'the file is being synced by another process, instead of '
+              'waiting for its result\n\n'
+              'python -m keypass_sync watch [--all] '
+              '[--remote-poll-interval=SECONDS] -> stay running, sync on '
+              'local change and check the cloud file periodically (every 60 '
+              'seconds by default)\n\n'
+              'python -m keypass_sync set KEY=VALUE -> set an optional '
+              'config entry (e.g. metrics_log, rehash_every), an empty '
+              'VALUE removes it\n\n'
               'python -m keypass_sync force-update cloud -> overwrite the '
               'file on the cloud without checking for conflicts\n\n'
               'python -m keypass_sync force-update local -> overwrite the '
               'local file without checking for conflicts\n\n'
+              'python -m keypass_sync history -> list the snapshots of the '
+              'synced versions\n\n'
+              'python -m keypass_sync restore ID -> replace the local file '
+              'with a snapshot, to be uploaded by the next sync\n\n'
               '\n'
               'All commands can be followed with a `name` argument to '
               'choose between multiple files to sync:\n'
               'python -m keypass_sync sync [name]\n'
               'python -m keypass_sync init [name]\n'
+              'python -m keypass_sync watch [name]\n'
+              'python -m keypass_sync set KEY=VALUE [name]\n'
               'python -m keypass_sync force-update cloud [name]\n'
-              'python -m keypass_sync force-update local [name]')
+              'python -m keypass_sync force-update local [name]\n'
+              'python -m keypass_sync history [name]\n'
+              'python -m keypass_sync restore ID [name]')
         exit(0)
 
     if len(sys.argv) > 1 and sys.argv[1] == 'init':
@@ -39,12 +62,77 @@ if __name__ == "__main__":
         config.init(version)
         exit(0)
 
-    if len(sys.argv) == 1 or sys.argv[1] == 'sync':
+    if len(sys.argv) > 1 and sys.argv[1] == 'set':
+        if len(sys.argv) < 3 or '=' not in sys.argv[2]:
+            log_and_exit('invalid argument for set: expected '
+                         '`set KEY=VALUE [name]`')
+        key, value = sys.argv[2].split('=', 1)
+        config.set_option(key, value, '_'.join(sys.argv[3:]))
+        exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'history':
+        import datetime
         version = '_'.join(sys.argv[2:])
-        options = config.load(version)
-        sync(*options)
+        profile = config.load_profile(version)
+        for snapshot in config.profile_history(version).snapshots(
+                profile['cache_folder_path']):
+            taken = datetime.datetime.fromtimestamp(
+                snapshot['taken_ns'] / 10**9).isoformat(' ', 'seconds')
+            print(f'{snapshot["id"]:>6}  {taken}  {snapshot["origin"]:<16} '
+                  f'{snapshot["size"]:>10} bytes  {snapshot["path"]}')
+        exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'restore':
+        if len(sys.argv) < 3 or not sys.argv[2].isdigit():
+            log_and_exit('invalid argument for restore: expected '
+                         '`restore ID [name]`, see the `history` command')
+        version = '_'.join(sys.argv[3:])
+        profile = config.load_profile(version)
+        locking.single_flight(
+            profile['cache_folder_path'], 'restore',
+            lambda: config.profile_history(version).restore(
+                int(sys.argv[2]), profile['cache_folder_path'])['origin'],
+            share=False)
+        exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'sync' \
+            and any(arg.startswith('--') for arg in sys.argv[2:]):
+        options = [arg for arg in sys.argv[2:] if arg.startswith('--')]
+        version = '_'.join(arg for arg in sys.argv[2:]
+                           if not arg.startswith('--'))
+        for option in options:
+            if option not in ('--all', '--no-wait'):
+                log_and_exit(f'invalid option for sync: {option}')
+        wait = '--no-wait' not in options
+        if '--all' in options:
+            results = sync_all(wait=wait)
+            for version, result in results.items():
+                print(f'{version}: {result}')
+            exit(int(any(result == failed for result in results.values())))
+        exit(int(sync_version(version, wait=wait) == failed))
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'watch':
+        from keypass_sync.watch import watch
+        options = [arg for arg in sys.argv[2:] if arg.startswith('--')]
+        version = '_'.join(arg for arg in sys.argv[2:]
+                           if not arg.startswith('--'))
+        remote_poll_interval = 60.
+        for option in options:
+            if option.startswith('--remote-poll-interval='):
+                remote_poll_interval = float(option.split('=', 1)[1])
+            elif option != '--all':
+                log_and_exit(f'invalid option for watch: {option}')
+        try:
+            watch(None if '--all' in options else [version or 'default'],
+                  remote_poll_interval=remote_poll_interval)
+        except KeyboardInterrupt:
+            pass
         exit(0)
 
+    if len(sys.argv) == 1 or sys.argv[1] == 'sync':
+        version = '_'.join(sys.argv[2:])
+        exit(int(sync_version(version) == failed))
+
     if sys.argv[1] == 'force-update':
         if sys.argv[2] not in ['cloud', 'local']:
             log_and_exit(f'invalid argument for force operation: expected '
@@ -53,10 +141,65 @@ if __name__ == "__main__":
         version = '_'.join(sys.argv[3:])
 
         local_file_path, cloud_file_id, cache_path = config.load(version)
-        if sys.argv[2] == 'cloud':
-            update_cloud(read_data_from_file(local_file_path), cloud_file_id,
-                         cache_path, file_name=local_file_path.name)
+        if local_file_path.is_dir():
+            log_and_exit('force-update is not supported for folders: '
+                         'force-update the files one by one by removing '
+                         'them on the side to overwrite')
+        options = config.sync_options(version)
+        chunk_folder_id = options.get('chunk_folder_id')
+        algorithm = options.get('hash_algorithm', default_algorithm)
+        content_cache = options['content_cache']
+        snapshots = options['snapshots']
+
+        def force_update()->str:
+            if sys.argv[2] == 'cloud' and chunk_folder_id:
+                update_cloud_chunked(local_file_path, cloud_file_id,
+                                     chunk_folder_id, cache_path,
+                                     average_size=options.get(
+                                         'chunk_average_size',
+                                         default_average_size),
+                                     algorithm=algorithm,
+                                     content_cache=content_cache,
+                                     snapshots=snapshots)
+            elif sys.argv[2] == 'cloud':
+                update_cloud(local_file_path, cloud_file_id, cache_path,
+                             chunk_size=options.get(
+                                 'upload_chunk_size',
+                                 uploads.default_chunk_size),
+                             algorithm=algorithm, content_cache=content_cache,
+                             snapshots=snapshots)
+
+            if sys.argv[2] == 'local':
+                metadata = google_drive_client().get_metadata(cloud_file_id)
+                manifest = None
+                if chunk_folder_id:
+                    try:
+                        manifest = fetch_manifest(google_drive_client(),
+                                                  cloud_file_id, metadata)
+                    except ValueError:
+                        log_and_exit(
+                            f'Cloud file {cloud_file_id} does not hold a '
+                            f'chunk manifest. Please convert it by using '
+                            f'the `force-update cloud` option.')
+                    downloaded_file_path, data_hash = download_chunks_next_to(
+                        local_file_path, manifest, cache_path,
+                        algorithm=algorithm, content_cache=content_cache)
+                else:
+                    downloaded_file_path, data_hash = download_next_to(
+                        local_file_path, cloud_file_id, metadata=metadata,
+                        chunk_size=options.get(
+                            'download_chunk_size',
+                            downloads.default_chunk_size),
+                        max_workers=options.get(
+                            'download_workers',
+                            downloads.default_max_workers),
+                        algorithm=algorithm, content_cache=content_cache)
+                update_local(local_file_path, downloaded_file_path,
+                             cache_path, metadata, data_hash, manifest,
+                             snapshots=snapshots)
+                return downloaded
+            return uploaded
 
-        if sys.argv[2] == 'local':
-            update_local(local_file_path, drive.download_file(cloud_file_id),
-                         cache_path)
+        # Waits for a running sync of the profile, then overrides it
+        locking.single_flight(cache_path, f'force-update {sys.argv[2]}',
+                              force_update, share=False)
@@ -0,0 +1,283 @@
+"""Storages the synced files live in
+
+The sync operations (see `keypass_sync.sync_utils`) only talk to the cloud
+through a `Backend`:
+
+* `google_drive.GoogleDriveBackend`: the google drive (the default)
+* `local.LocalDirectoryBackend`: files in a local folder
+* `memory.InMemoryBackend`: files in memory, with injectable latency and
+  errors, for tests and benchmarks
+
+`scheduled.ScheduledBackend` wraps a backend to rate-limit its calls and
+retry them on transient failures.
+
+Uploads can be conditioned on the revision of the cloud file the sync
+decision was made on: if another client replaced it in between, they fail
+with `RevisionMismatch` instead of overwriting its content. The in-memory
+and local backends check and replace atomically. The drive api v3 has no
+precondition on updates (no If-Match/etag): the google-drive backend
+fetches the revision when the upload starts, one more request, and a
+change made by another client while uploading is still overwritten (it
+is kept in the revisions of the cloud file).
+
+The google-api stack takes long to import: `google_drive` is only imported
+once a google-drive client is actually needed (see `google_drive_client`).
+"""
+
+import io
+
+# Metadata entries a backend should provide (see `Backend.get_metadata`)
+metadata_keys = ('id', 'md5Checksum', 'headRevisionId', 'modifiedTime',
+                 'size')
+
+
+class RevisionMismatch(Exception):
+    """The cloud file is not at the revision an upload is conditioned on
+
+    Args:
+        file_id (str): id of the file
+        expected_revision (str): revision the upload was conditioned on
+        revision (str): current revision of the file
+    """
+    def __init__(self, file_id: str, expected_revision: str, revision: str):
+        super().__init__(f'Cloud file {file_id} is at revision {revision}, '
+                         f'not {expected_revision}')
+        self.file_id = file_id
+        self.expected_revision = expected_revision
+        self.revision = revision
+
+
+def google_drive_client(credential_folder_path=None):
+    """Return the shared google-drive client for the given credentials
+
+    Args:
+        credential_folder_path (str): folder containing the `token.json`.
+            Defaults to the one configured in google_services.
+
+    Returns:
+        scheduled.ScheduledBackend wrapping a google_drive.GoogleDriveBackend
+    """
+    from keypass_sync.backends import google_drive
+    return google_drive.client(credential_folder_path)
+
+
+class Backend:
+    """Interface of a storage holding the synced files
+
+    Files are identified by an id (for the google drive: the file id).
+    Their metadata are dicts with (some of) the `metadata_keys` entries, as
+    returned by the google-drive api: `headRevisionId` changes each time the
+    content changes, `size` is a string.
+    """
+    # Size of which the chunks of a resumable upload should be multiples
+    chunk_granularity = 1
+
+    def get_metadata(self, file_id: str)->dict:
+        """Fetch the metadata of a file, without its content
+
+        Args:
+            file_id (str): id of the file
+
+        Returns:
+            dict with the `metadata_keys` entries known by the backend
+        """
+        raise NotImplementedError
+
+    def download_range(self, file_id: str, start: int, end: int)->bytes:
+        """Return a part of the content of a file
+
+        Optional: backends without ranged downloads raise
+        `NotImplementedError` (see `download_to`).
+
+        Args:
+            file_id (str): id of the file
+            start (int): position of the first byte of the part
+            end (int): position after the last byte of the part
+
+        Returns:
+            the bytes from `start` to `end` (excluded)
+        """
+        raise NotImplementedError
+
+    def get_metadata_batch(self, file_ids: list)->dict:
+        """Fetch the metadata of several files, in as few requests as possible
+
+        Backends without batch requests fetch them one by one.
+
+        Args:
+            file_ids (list): ids of the files
+
+        Returns:
+            dict giving, for each file id, its metadata (see
+            `get_metadata`) or the exception raised while fetching them
+        """
+        results = {}
+        for file_id in file_ids:
+            try:
+                results[file_id] = self.get_metadata(file_id)
+            except Exception as error:
+                results[file_id] = error
+        return results
+
+    def download_to(self, file_id: str, file_object)->None:
+        """Stream the content of a file into `file_object`
+
+        Args:
+            file_id (str): id of the file
+            file_object: writable binary file
+        """
+        raise NotImplementedError
+
+    def upload_from(self, file_object, file_id: str, file_name: str,
+                    expected_revision: str=None)->dict:
+        """Replace the content of a file with the one of `file_object`
+
+        Args:
+            file_object: readable, seekable binary file
+            file_id (str): id of the file
+            file_name (str): name to give to the file
+            expected_revision (str): `headRevisionId` the file must still
+                have, else `RevisionMismatch` is raised and its content is
+                kept. Defaults to replacing whatever revision. Not atomic
+                on every backend (see the module docstring).
+
+        Returns:
+            the metadata of the updated file (see `get_metadata`)
+        """
+        raise NotImplementedError
+
+    def start_upload(self, file_id: str, file_name: str, size: int,
+                     expected_revision: str=None)->str:
+        """Start a resumable upload replacing the content of a file
+
+        Optional: backends without resumable uploads raise
+        `NotImplementedError` (see `upload_from`).
+
+        Args:
+            file_id (str): id of the file
+            file_name (str): name to give to the file
+            size (int): size of the new content, in bytes
+            expected_revision (str): see `upload_from`. Depending on the
+                backend, `RevisionMismatch` is raised by this call or by
+                the `upload_chunk` completing the upload.
+
+        Returns:
+            the upload session, to give to `upload_chunk` and
+            `query_upload`. It outlives the process.
+        """
+        raise NotImplementedError
+
+    def upload_chunk(self, session: str, data: bytes, offset: int,
+                     size: int)->tuple:
+        """Send the next chunk of a resumable upload
+
+        Args:
+            session (str): returned by `start_upload`
+            data (bytes): the chunk. Its size should be a multiple of
+                `chunk_granularity`, unless it is the last one.
+            offset (int): position of the chunk in the new content
+            size (int): size of the new content, in bytes
+
+        Returns:
+            (number of bytes received so far: int, metadata of the updated
+            file once the upload is complete (see `get_metadata`), else
+            None)
+        """
+        raise NotImplementedError
+
+    def query_upload(self, session: str, size: int)->tuple:
+        """Ask how far a resumable upload went, e.g. after an interruption
+
+        Args:
+            session (str): returned by `start_upload`
+            size (int): size of the new content, in bytes
+
+        Returns:
+            same as `upload_chunk`
+        """
+        raise NotImplementedError
+
+    def list_folder(self, folder_id: str)->dict:
+        """List the files of a folder
+
+        Optional, as `create_file`: backends without folders raise
+        `NotImplementedError`.
+
+        Args:
+            folder_id (str): id of the folder
+
+        Returns:
+            dict giving the id of each file of the folder, by name
+        """
+        raise NotImplementedError
+
+    def create_file(self, file_object, folder_id: str,
+                    file_name: str)->dict:
+        """Create a file in a folder, with the content of `file_object`
+
+        Args:
+            file_object: readable, seekable binary file
+            folder_id (str): id of the folder
+            file_name (str): name of the new file
+
+        Returns:
+            the metadata of the new file (see `get_metadata`)
+        """
+        raise NotImplementedError
+
+    def get_start_page_token(self)->str:
+        """Return the position of the present in the changes feed
+
+        Optional: backends without a changes feed raise
+        `NotImplementedError`.
+
+        Returns:
+            page token to give to `list_changes` to get the changes made
+            from now on
+        """
+        raise NotImplementedError
+
+    def list_changes(self, page_token: str)->tuple:
+        """List the files changed since `page_token`
+
+        Optional: backends without a changes feed raise
+        `NotImplementedError`.
+
+        Args:
+            page_token (str): returned by `get_start_page_token` or by a
+                previous `list_changes` call
+
+        Returns:
+            (ids of the changed or removed files: set, page token to use
+            for the next call: str)
+        """
+        raise NotImplementedError
+
+    def download(self, file_id: str)->bytes:
+        """Return the content of a file
+
+        Args:
+            file_id (str): id of the file
+
+        Returns:
+            the binary content of the file
+        """
+        buffer = io.BytesIO()
+        self.download_to(file_id, buffer)
+        return buffer.getvalue()
+
+    def upload(self, data: bytes, file_id: str, file_name: str,
+               expected_revision: str=None)->dict:
+        """Replace the content of a file with `data`
+
+        Args:
+            data (bytes): new content of the file
+            file_id (str): id of the file
+            file_name (str): name to give to the file
+            expected_revision (str): see `upload_from`
+
+        Returns:
+            the metadata of the updated file (see `get_metadata`)
+        """
+        return self.upload_from(io.BytesIO(data), file_id, file_name,
+                                expected_revision)
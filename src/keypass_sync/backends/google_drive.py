@@ -0,0 +1,550 @@
+"""Backend syncing the files with the google drive
+
+Talks to the drive api with the google-SSO token configured through the
+google_services package (https://github.com/Retzoh/google_services_wrapper).
+Contents are streamed by chunks, in both directions.
+
+A client is shared by every sync operation using the same credentials,
+including the ones running concurrently in other threads (see `client`).
+It keeps its http connections open between requests, and its access token
+until it expires: the token is refreshed in the background shortly before,
+and saved to `token.json` for the next runs. Without a `token.json` (e.g.
+right after `init`), the access to the drive is asked in the browser with
+the OAuth ID file, `client_id.json`.
+"""
+
+import contextlib
+import datetime
+import json
+import logging
+import os
+import queue
+import tempfile
+import threading
+
+import google_auth_httplib2
+import httplib2
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
+from google_services import config as services_config
+from google_services._utilities import logger as services_logger
+
+from keypass_sync import metrics
+from keypass_sync.backends import Backend, RevisionMismatch
+from keypass_sync.backends.scheduled import ScheduledBackend
+from keypass_sync.utilities import logger, sanitize_path
+
+# google_services logs through its own logger: its warnings (e.g. on the
+# credentials) stay visible, whatever the level of the `keypass_sync` one
+services_logger.setLevel(logging.WARNING)
+
+# Access asked for with the OAuth ID file
+scopes = ['https://www.googleapis.com/auth/drive']
+
+# Cheap-to-fetch fields describing the state of the remote file
+metadata_fields = 'id,md5Checksum,headRevisionId,modifiedTime,size'
+
+# Size of the chunks requested when streaming a download
+download_chunk_size = 8 * 1024 * 1024
+
+# Size of the chunks sent when streaming an upload
+upload_chunk_size = 8 * 1024 * 1024
+
+# Maximum number of changes listed per request (the api's maximum)
+changes_page_size = 1000
+
+# Maximum number of files listed per request (the api's maximum)
+list_page_size = 1000
+
+# Maximum number of requests sent in one batch (the api's maximum)
+batch_size = 100
+
+# Endpoint starting the resumable uploads
+resumable_upload_url = ('https://www.googleapis.com/upload/drive/v3/files/'
+                        '{file_id}?uploadType=resumable&fields='
+                        + metadata_fields)
+
+# The access token is refreshed when it expires in less than this
+token_refresh_margin = datetime.timedelta(minutes=5)
+
+# Time between two attempts to refresh the access token in the background,
+# when the previous one failed or the expiry is unknown, in seconds
+token_refresh_retry_delay = 60.
+
+# Timeout of the http requests, in seconds
+http_timeout = 60.
+
+
+class GoogleDriveBackend(Backend):
+    """Drive-api client authenticated with one google-SSO token
+
+    The credentials and the api client are set up once and shared. The http
+    connections are not thread-safe: they are kept in a pool, each request
+    using one that no other thread is using, and they are kept open for the
+    next requests.
+
+    Args:
+        credential_folder_path (str): folder containing the `token.json`, or
+            the `client_id.json` to create it with
+    """
+    # The drive api expects chunks of multiples of 256KiB
+    chunk_granularity = 256 * 1024
+
+    def __init__(self, credential_folder_path):
+        self.credential_folder_path = sanitize_path(credential_folder_path)
+        self._credentials = None
+        self._service_resource = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._connections = queue.LifoQueue()
+        self._closed = threading.Event()
+        self._refresher = None
+
+    @property
+    def token_path(self):
+        return self.credential_folder_path / 'token.json'
+
+    @property
+    def client_id_path(self):
+        return self.credential_folder_path / 'client_id.json'
+
+    def _load_credentials(self):
+        """Load the saved token, or ask the user for a new one
+
+        Without a `token.json`, the access to the drive is asked in the
+        browser with the `client_id.json`, and the token saved.
+
+        Returns:
+            google.oauth2.credentials.Credentials
+        """
+        if self.token_path.exists():
+            return Credentials.from_authorized_user_file(
+                str(self.token_path))
+        if not self.client_id_path.exists():
+            raise FileNotFoundError(
+                f'Neither token.json nor client_id.json were found at '
+                f'{self.credential_folder_path}')
+        # Imported here, as it is only needed once per account
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
+        logger.info(f'No token.json at {self.credential_folder_path}: '
+                    f'asking for the access to the drive in the browser')
+        flow = InstalledAppFlow.from_client_secrets_file(
+            str(self.client_id_path), scopes)
+        self._credentials = flow.run_local_server(port=0)
+        self._save_token()
+        return self._credentials
+
+    def _service(self):
+        """Return the drive-api client
+
+        Its requests should be executed with `_execute`, or with a
+        connection from `_connection`.
+
+        Returns:
+            googleapiclient.discovery.Resource
+        """
+        if self._service_resource is None:
+            with metrics.span('credential_setup'), self._lock:
+                if self._credentials is None:
+                    self._credentials = self._load_credentials()
+                if self._service_resource is None:
+                    self._service_resource = build(
+                        'drive', 'v3', credentials=self._credentials,
+                        cache_discovery=False)
+                if self._refresher is None:
+                    self._refresher = threading.Thread(
+                        target=self._keep_token_fresh, daemon=True,
+                        name=f'token refresher {self.credential_folder_path}')
+                    self._refresher.start()
+        return self._service_resource
+
+    @contextlib.contextmanager
+    def _connection(self):
+        """Borrow an authorized http connection from the pool
+
+        Yields:
+            google_auth_httplib2.AuthorizedHttp
+        """
+        self._service()
+        try:
+            self._refresh_token_if_needed()
+        except Exception as error:
+            # The connection refreshes the token itself once it expired
+            logger.warning(f'Could not refresh the access token of '
+                           f'{self.credential_folder_path}: {error!r}')
+        try:
+            connection = self._connections.get_nowait()
+        except queue.Empty:
+            connection = google_auth_httplib2.AuthorizedHttp(
+                self._credentials, http=httplib2.Http(timeout=http_timeout))
+        try:
+            yield connection
+        finally:
+            self._connections.put(connection)
+
+    def _execute(self, request):
+        """Execute an api request on a pooled connection"""
+        with self._connection() as connection:
+            return request.execute(http=connection)
+
+    def _token_expires_soon(self)->bool:
+        expiry = self._credentials.expiry
+        # google-auth uses naive utc datetimes
+        return not self._credentials.token or expiry is not None and \
+            expiry - token_refresh_margin <= datetime.datetime.utcnow()
+
+    def _refresh_token_if_needed(self)->None:
+        """Refresh the access token if it expires soon, and save it"""
+        if not self._token_expires_soon():
+            return
+        with self._refresh_lock:
+            # Another thread may have refreshed it in the meantime
+            if not self._token_expires_soon():
+                return
+            with metrics.span('token_refresh'):
+                self._credentials.refresh(google_auth_httplib2.Request(
+                    httplib2.Http(timeout=http_timeout)))
+            self._save_token()
+
+    def _save_token(self)->None:
+        """Save the credentials, so that the next runs reuse the token"""
+        try:
+            file_descriptor, tmp_path = tempfile.mkstemp(
+                prefix='.token.json.', dir=str(self.credential_folder_path))
+        except OSError as error:
+            logger.warning(f'Could not save the access token: {error!r}')
+            return
+        try:
+            with os.fdopen(file_descriptor, 'w') as token_file:
+                token_file.write(self._credentials.to_json())
+            os.replace(tmp_path, str(self.token_path))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _keep_token_fresh(self)->None:
+        """Refresh the access token shortly before it expires, until closed
+        """
+        while True:
+            expiry = self._credentials.expiry
+            delay = token_refresh_retry_delay if expiry is None else max(
+                (expiry - token_refresh_margin
+                 - datetime.datetime.utcnow()).total_seconds(),
+                token_refresh_retry_delay)
+            if self._closed.wait(delay):
+                return
+            try:
+                self._refresh_token_if_needed()
+            except Exception as error:
+                logger.warning(f'Could not refresh the access token of '
+                               f'{self.credential_folder_path}: {error!r}')
+
+    def close(self)->None:
+        """Stop refreshing the token and close the http connections"""
+        self._closed.set()
+        while True:
+            try:
+                connection = self._connections.get_nowait()
+            except queue.Empty:
+                return
+            for http_connection in connection.http.connections.values():
+                http_connection.close()
+
+    def get_metadata(self, cloud_file_id: str)->dict:
+        """Fetch the metadata of a cloud file, without its content
+
+        Args:
+            cloud_file_id (str): id of the cloud file
+
+        Returns:
+            dict with the `metadata_fields` entries known by the drive
+        """
+        return self._execute(self._service().files().get(
+            fileId=cloud_file_id, fields=metadata_fields))
+
+    def get_metadata_batch(self, cloud_file_ids: list)->dict:
+        """Fetch the metadata of several cloud files, in batch requests
+
+        Up to `batch_size` files are checked per http request.
+
+        Args:
+            cloud_file_ids (list): ids of the cloud files
+
+        Returns:
+            dict giving, for each file id, its metadata (see
+            `get_metadata`) or the exception raised while fetching them
+        """
+        results = {}
+
+        def store_result(cloud_file_id, response, exception):
+            results[cloud_file_id] = response if exception is None \
+                else exception
+
+        service = self._service()
+        cloud_file_ids = list(dict.fromkeys(cloud_file_ids))
+        for start in range(0, len(cloud_file_ids), batch_size):
+            batch = service.new_batch_http_request(callback=store_result)
+            for cloud_file_id in cloud_file_ids[start:start + batch_size]:
+                batch.add(service.files().get(
+                    fileId=cloud_file_id, fields=metadata_fields),
+                    request_id=cloud_file_id)
+            self._execute(batch)
+        return results
+
+    def download_to(self, cloud_file_id: str, file_object,
+                    chunk_size: int=download_chunk_size)->None:
+        """Stream the content of a cloud file into `file_object`
+
+        The file is requested by chunks of `chunk_size` bytes, each one
+        being written to `file_object` before the next one is requested.
+
+        Args:
+            cloud_file_id (str): id of the cloud file
+            file_object: writable binary file
+            chunk_size (int): size of the requested chunks, in bytes
+        """
+        request = self._service().files().get_media(fileId=cloud_file_id)
+        with self._connection() as connection:
+            request.http = connection
+            downloader = MediaIoBaseDownload(file_object, request,
+                                             chunksize=chunk_size)
+            done = False
+            while not done:
+                _, done = downloader.next_chunk()
+
+    def download_range(self, cloud_file_id: str, start: int,
+                       end: int)->bytes:
+        """Return a part of the content of a cloud file
+
+        Args:
+            cloud_file_id (str): id of the cloud file
+            start (int): position of the first byte of the part
+            end (int): position after the last byte of the part
+
+        Returns:
+            the bytes from `start` to `end` (excluded)
+        """
+        request = self._service().files().get_media(fileId=cloud_file_id)
+        request.headers['Range'] = f'bytes={start}-{end - 1}'
+        return self._execute(request)
+
+    def _check_revision(self, cloud_file_id: str,
+                        expected_revision: str)->None:
+        """Raise `RevisionMismatch` if a cloud file changed since a revision
+
+        The drive api v3 has no conditional update (no If-Match/etag
+        precondition): the revision is fetched when the upload starts, one
+        request more, and a change made while uploading is overwritten
+        (but kept in the revisions of the cloud file).
+        """
+        if expected_revision is None:
+            return
+        revision = self._execute(self._service().files().get(
+            fileId=cloud_file_id, fields='headRevisionId'))['headRevisionId']
+        if revision != expected_revision:
+            raise RevisionMismatch(cloud_file_id, expected_revision, revision)
+
+    def upload_from(self, file_object, cloud_file_id: str, file_name: str,
+                    expected_revision: str=None,
+                    chunk_size: int=upload_chunk_size)->dict:
+        """Replace the content of a cloud file with the one of `file_object`
+
+        The content is streamed from `file_object` by chunks of
+        `chunk_size` bytes.
+
+        Args:
+            file_object: readable, seekable binary file
+            cloud_file_id (str): id of the cloud file
+            file_name (str): name to give to the file on the cloud
+            expected_revision (str): `headRevisionId` the cloud file must
+                still have (see `_check_revision`)
+            chunk_size (int): size of the uploaded chunks, in bytes
+
+        Returns:
+            the metadata of the updated cloud file (see `get_metadata`)
+        """
+        self._check_revision(cloud_file_id, expected_revision)
+        media = MediaIoBaseUpload(file_object,
+                                  mimetype='application/octet-stream',
+                                  chunksize=chunk_size, resumable=True)
+        return self._execute(self._service().files().update(
+            fileId=cloud_file_id, body=dict(name=file_name),
+            media_body=media, fields=metadata_fields))
+
+    def start_upload(self, cloud_file_id: str, file_name: str,
+                     size: int, expected_revision: str=None)->str:
+        """Start a resumable upload replacing the content of a cloud file
+
+        Args:
+            cloud_file_id (str): id of the cloud file
+            file_name (str): name to give to the file on the cloud
+            size (int): size of the new content, in bytes
+            expected_revision (str): `headRevisionId` the cloud file must
+                still have (see `_check_revision`)
+
+        Returns:
+            the upload session uri, valid for a week
+        """
+        self._check_revision(cloud_file_id, expected_revision)
+        url = resumable_upload_url.format(file_id=cloud_file_id)
+        with self._connection() as connection:
+            response, content = connection.request(
+                url, method='PATCH', body=json.dumps(dict(name=file_name)),
+                headers={'Content-Type': 'application/json; charset=UTF-8',
+                         'X-Upload-Content-Type': 'application/octet-stream',
+                         'X-Upload-Content-Length': str(size)})
+        if response.status != 200:
+            raise HttpError(response, content, uri=url)
+        return response['location']
+
+    def upload_chunk(self, session: str, data: bytes, offset: int,
+                     size: int)->tuple:
+        """Send the next chunk of a resumable upload
+
+        Args:
+            session (str): returned by `start_upload`
+            data (bytes): the chunk, a multiple of `chunk_granularity` unless
+                it is the last one
+            offset (int): position of the chunk in the new content
+            size (int): size of the new content, in bytes
+
+        Returns:
+            (number of bytes received so far: int, metadata of the updated
+            cloud file once the upload is complete, else None)
+        """
+        return self._upload_request(session, bytes(data), size, {
+            'Content-Range': f'bytes {offset}-{offset + len(data) - 1}/{size}'
+            if data else f'bytes */{size}'})
+
+    def query_upload(self, session: str, size: int)->tuple:
+        """Ask how far a resumable upload went
+
+        Args:
+            session (str): returned by `start_upload`
+            size (int): size of the new content, in bytes
+
+        Returns:
+            same as `upload_chunk`
+        """
+        return self._upload_request(session, b'', size,
+                                    {'Content-Range': f'bytes */{size}'})
+
+    def _upload_request(self, session: str, body: bytes, size: int,
+                        headers: dict)->tuple:
+        with self._connection() as connection:
+            response, content = connection.request(
+                session, method='PUT', body=body,
+                headers=dict(headers, **{'Content-Length': str(len(body))}))
+        if response.status in (200, 201):
+            return size, json.loads(content)
+        if response.status == 308:
+            # Incomplete, `range` tells what was received: `bytes=0-1234`
+            received = response.get('range')
+            return int(received.rsplit('-', 1)[1]) + 1 if received else 0, \
+                None
+        raise HttpError(response, content, uri=session)
+
+    def list_folder(self, folder_id: str)->dict:
+        """List the files of a drive folder
+
+        Args:
+            folder_id (str): id of the folder
+
+        Returns:
+            dict giving the id of each file of the folder, by name
+        """
+        files = {}
+        page_token = None
+        while True:
+            response = self._execute(self._service().files().list(
+                q=f"'{folder_id}' in parents and trashed = false",
+                spaces='drive', pageSize=list_page_size, pageToken=page_token,
+                fields='nextPageToken,files(id,name)'))
+            files.update((file['name'], file['id'])
+                         for file in response.get('files', []))
+            page_token = response.get('nextPageToken')
+            if page_token is None:
+                return files
+
+    def create_file(self, file_object, folder_id: str,
+                    file_name: str)->dict:
+        """Create a file in a drive folder, with the content of `file_object`
+
+        Args:
+            file_object: readable, seekable binary file
+            folder_id (str): id of the folder
+            file_name (str): name of the new file
+
+        Returns:
+            the metadata of the new cloud file (see `get_metadata`)
+        """
+        media = MediaIoBaseUpload(file_object,
+                                  mimetype='application/octet-stream')
+        return self._execute(self._service().files().create(
+            body=dict(name=file_name, parents=[folder_id]),
+            media_body=media, fields=metadata_fields))
+
+    def get_start_page_token(self)->str:
+        """Return the position of the present in the drive's changes feed
+
+        Returns:
+            page token to give to `list_changes`
+        """
+        return self._execute(
+            self._service().changes().getStartPageToken())['startPageToken']
+
+    def list_changes(self, page_token: str)->tuple:
+        """List the files of the drive changed since `page_token`
+
+        Each request lists up to `changes_page_size` changes, whatever the
+        number of synced files.
+
+        Args:
+            page_token (str): returned by `get_start_page_token` or by a
+                previous `list_changes` call
+
+        Returns:
+            (ids of the changed or removed files: set, page token to use
+            for the next call: str)
+        """
+        changed_file_ids = set()
+        while True:
+            response = self._execute(self._service().changes().list(
+                pageToken=page_token, pageSize=changes_page_size,
+                includeRemoved=True, spaces='drive',
+                fields='nextPageToken,newStartPageToken,changes(fileId)'))
+            changed_file_ids.update(change['fileId']
+                                    for change in response.get('changes', []))
+            if 'newStartPageToken' in response:
+                return changed_file_ids, response['newStartPageToken']
+            page_token = response['nextPageToken']
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def client(credential_folder_path=None)->ScheduledBackend:
+    """Return the shared client for the given credentials
+
+    Its calls are scheduled per account: rate and concurrency limited, and
+    retried on transient failures (see `keypass_sync.backends.scheduled`).
+
+    Args:
+        credential_folder_path (str): folder containing the `token.json`.
+            Defaults to the one configured in google_services.
+
+    Returns:
+        ScheduledBackend wrapping a GoogleDriveBackend
+    """
+    if credential_folder_path is None:
+        credential_folder_path = services_config.default.credential_path
+    key = str(sanitize_path(credential_folder_path))
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = ScheduledBackend(GoogleDriveBackend(key))
+        return _clients[key]
+
@@ -0,0 +1,118 @@
+"""Backend keeping the synced files in a local folder
+
+Stands in for the google drive, e.g. to run the sync engine without
+network access or to sync through a mounted network share. The conditional
+uploads are atomic where the file system honours `flock` locks (local file
+systems do, network shares may not).
+"""
+
+import contextlib
+import datetime
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+from keypass_sync.backends import Backend, RevisionMismatch
+
+copy_buffer_size = 1024 * 1024
+
+
+class LocalDirectoryBackend(Backend):
+    """Files stored in `root_path`, the file id being the file name
+
+    The `file_name` given on upload is ignored. Folders are sub-folders of
+    `root_path`: the id of a file created in one is `folder_id/file_name`.
+
+    Args:
+        root_path (Path): folder holding the files
+    """
+    def __init__(self, root_path):
+        self.root_path = Path(root_path).expanduser()
+
+    def _path(self, file_id: str)->Path:
+        parts = file_id.split('/')
+        if len(parts) > 2 or any(part in ('', '.', '..') or os.sep in part
+                                 for part in parts):
+            raise ValueError(f'Invalid file id: {file_id!r}')
+        return self.root_path.joinpath(*parts)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _replacing(path: Path):
+        """Hold the lock replacing a file, across processes
+
+        Every upload replaces the file under the flock of a hidden lock
+        file next to it: the revision check and the replacement are one
+        compare-and-swap.
+        """
+        # Imported here, as it is not available on every platform
+        import fcntl
+
+        lock_descriptor = os.open(str(path.with_name(f'.{path.name}.lock')),
+                                  os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(lock_descriptor, fcntl.LOCK_EX)
+            yield
+        finally:
+            # Releases the lock
+            os.close(lock_descriptor)
+
+    def get_metadata(self, file_id: str)->dict:
+        stat = self._path(file_id).stat()
+        return dict(
+            id=file_id,
+            # Changes whenever the file is written to or replaced
+            headRevisionId=f'{stat.st_ino}-{stat.st_mtime_ns}-{stat.st_size}',
+            modifiedTime=datetime.datetime.fromtimestamp(
+                stat.st_mtime, datetime.timezone.utc).isoformat(),
+            size=str(stat.st_size))
+
+    def download_to(self, file_id: str, file_object)->None:
+        with self._path(file_id).open('rb') as file:
+            shutil.copyfileobj(file, file_object, copy_buffer_size)
+
+    def download_range(self, file_id: str, start: int, end: int)->bytes:
+        with self._path(file_id).open('rb') as file:
+            file.seek(start)
+            return file.read(end - start)
+
+    def upload_from(self, file_object, file_id: str, file_name: str,
+                    expected_revision: str=None)->dict:
+        path = self._path(file_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        file_descriptor, tmp_path = tempfile.mkstemp(
+            prefix=f'.{path.name}.', suffix='.upload', dir=str(path.parent))
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                shutil.copyfileobj(file_object, file, copy_buffer_size)
+            with self._replacing(path):
+                if expected_revision is not None:
+                    try:
+                        revision = self.get_metadata(
+                            file_id)['headRevisionId']
+                    except FileNotFoundError:
+                        revision = None
+                    if revision != expected_revision:
+                        raise RevisionMismatch(file_id, expected_revision,
+                                               revision)
+                os.replace(tmp_path, str(path))
+                return self.get_metadata(file_id)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def list_folder(self, folder_id: str)->dict:
+        folder_path = self._path(folder_id)
+        if not folder_path.is_dir():
+            return {}
+        return {path.name: f'{folder_id}/{path.name}'
+                for path in folder_path.iterdir()
+                # Skip the uploads in progress
+                if path.is_file() and not path.name.startswith('.')}
+
+    def create_file(self, file_object, folder_id: str,
+                    file_name: str)->dict:
+        return self.upload_from(file_object, f'{folder_id}/{file_name}',
+                                file_name)
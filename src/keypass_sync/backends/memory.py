@@ -0,0 +1,263 @@
+"""Backend keeping the synced files in memory
+
+Used to test and benchmark the sync engine without a network: latency and
+errors can be injected on every call, and the calls and transferred bytes
+are counted. Each change is appended to a change log, replayed by the
+changes feed (see `Backend.list_changes`).
+
+The conditional uploads are compare-and-swaps: the revision is checked and
+the content replaced at once, when the upload completes.
+"""
+
+import collections
+import datetime
+import hashlib
+import random
+import threading
+import time
+
+from keypass_sync.backends import Backend, RevisionMismatch
+
+
+class InMemoryBackend(Backend):
+    """Files stored in a dict, with injectable latency and errors
+
+    Args:
+        files (dict): initial content of the files, by file id
+        latency (float): time each call takes, in seconds
+        error_rate (float): probability for each call to fail
+        error (type): exception raised by the failing calls
+        chunk_size (int): size of the chunks streamed to/from the file
+            objects, in bytes
+        seed: seed of the random failures, for reproducibility
+        changes_page_size (int): number of changes listed per call to the
+            changes feed
+        batch_size (int): number of files whose metadata are fetched per
+            call to `get_metadata_batch`
+    """
+    def __init__(self, files: dict=None, latency: float=0.,
+                 error_rate: float=0., error: type=ConnectionError,
+                 chunk_size: int=1024 * 1024, seed=None,
+                 changes_page_size: int=100, batch_size: int=100):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error = error
+        self.chunk_size = chunk_size
+        self.changes_page_size = changes_page_size
+        self.batch_size = batch_size
+        # Ids of the changed files, in the order of the changes
+        self.change_log = []
+        self.calls = collections.Counter()
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._files = {}
+        self._failures = collections.deque()
+        self._uploads = {}
+        self._upload_count = 0
+        self._folders = collections.defaultdict(dict)
+        for file_id, data in (files or {}).items():
+            self.put(file_id, data)
+
+    def put(self, file_id: str, data: bytes,
+            expected_revision: str=None)->dict:
+        """Set the content of a file, as another client would do
+
+        Does not count as a call and never fails, but for a mismatching
+        `expected_revision`.
+
+        Args:
+            file_id (str): id of the file
+            data (bytes): new content
+            expected_revision (str): `headRevisionId` the file must have to
+                be replaced, else `RevisionMismatch` is raised. Defaults to
+                replacing whatever revision.
+
+        Returns:
+            the metadata of the file
+        """
+        data = bytes(data)
+        with self._lock:
+            revision = self._files.get(file_id, dict(revision=0))['revision']
+            if expected_revision is not None \
+                    and expected_revision != str(revision):
+                raise RevisionMismatch(file_id, expected_revision,
+                                       str(revision) if revision else None)
+            self._files[file_id] = dict(
+                data=data, revision=revision + 1,
+                md5=hashlib.md5(data).hexdigest(),
+                modified=datetime.datetime.now(datetime.timezone.utc))
+            self.change_log.append(file_id)
+        return self._metadata(file_id)
+
+    def record_change(self, file_id: str)->None:
+        """Log a change not touching the content (e.g. a renaming)"""
+        with self._lock:
+            self.change_log.append(file_id)
+
+    def get(self, file_id: str)->bytes:
+        """Return the content of a file, without counting it as a call
+
+        Args:
+            file_id (str): id of the file
+
+        Returns:
+            the content of the file
+        """
+        with self._lock:
+            return self._files[file_id]['data']
+
+    def fail_next(self, count: int=1, error: Exception=None)->None:
+        """Make the next `count` calls fail
+
+        Args:
+            count (int): number of calls to fail
+            error (Exception): exception to raise. Defaults to `self.error`.
+        """
+        with self._lock:
+            self._failures.extend([error or self.error('injected error')]
+                                  * count)
+
+    def _call(self, name: str)->None:
+        """Count a call, then apply the injected latency and errors"""
+        with self._lock:
+            self.calls[name] += 1
+            failure = self._failures.popleft() if self._failures else None
+            if failure is None and self.error_rate \
+                    and self._random.random() < self.error_rate:
+                failure = self.error(f'injected error on {name}')
+        if self.latency:
+            time.sleep(self.latency)
+        if failure is not None:
+            raise failure
+
+    def _metadata(self, file_id: str)->dict:
+        with self._lock:
+            if file_id not in self._files:
+                raise FileNotFoundError(f'No file with id {file_id}')
+            file = self._files[file_id]
+            return dict(id=file_id, md5Checksum=file['md5'],
+                        headRevisionId=str(file['revision']),
+                        modifiedTime=file['modified'].isoformat(),
+                        size=str(len(file['data'])))
+
+    def get_metadata(self, file_id: str)->dict:
+        self._call('get_metadata')
+        return self._metadata(file_id)
+
+    def get_metadata_batch(self, file_ids: list)->dict:
+        results = {}
+        file_ids = list(dict.fromkeys(file_ids))
+        for start in range(0, len(file_ids), self.batch_size):
+            # One call per batch, as with the drive api
+            self._call('get_metadata_batch')
+            for file_id in file_ids[start:start + self.batch_size]:
+                try:
+                    results[file_id] = self._metadata(file_id)
+                except FileNotFoundError as error:
+                    results[file_id] = error
+        return results
+
+    def download_to(self, file_id: str, file_object)->None:
+        self._call('download_to')
+        data = memoryview(self.get(file_id))
+        for start in range(0, len(data), self.chunk_size):
+            file_object.write(data[start:start + self.chunk_size])
+        with self._lock:
+            self.bytes_downloaded += len(data)
+
+    def download_range(self, file_id: str, start: int, end: int)->bytes:
+        self._call('download_range')
+        data = self.get(file_id)[start:end]
+        with self._lock:
+            self.bytes_downloaded += len(data)
+        return data
+
+    def upload_from(self, file_object, file_id: str, file_name: str,
+                    expected_revision: str=None)->dict:
+        self._call('upload_from')
+        data = b''.join(
+            iter(lambda: file_object.read(self.chunk_size), b''))
+        with self._lock:
+            self.bytes_uploaded += len(data)
+        return self.put(file_id, data, expected_revision)
+
+    def start_upload(self, file_id: str, file_name: str, size: int,
+                     expected_revision: str=None)->str:
+        self._call('start_upload')
+        with self._lock:
+            self._upload_count += 1
+            session = f'memory-upload-{self._upload_count}'
+            self._uploads[session] = dict(
+                file_id=file_id, size=size, data=bytearray(),
+                expected_revision=expected_revision)
+        return session
+
+    def _upload(self, session: str)->dict:
+        upload = self._uploads.get(session)
+        if upload is None:
+            raise FileNotFoundError(f'No upload session {session}')
+        return upload
+
+    def upload_chunk(self, session: str, data: bytes, offset: int,
+                     size: int)->tuple:
+        self._call('upload_chunk')
+        with self._lock:
+            upload = self._upload(session)
+            if offset != len(upload['data']) or offset + len(data) > size:
+                raise ValueError(f'Invalid chunk range: {offset}+'
+                                 f'{len(data)}/{size}')
+            upload['data'] += data
+            self.bytes_uploaded += len(data)
+            if len(upload['data']) < size:
+                return len(upload['data']), None
+            del self._uploads[session]
+        return size, self.put(upload['file_id'], upload['data'],
+                              upload['expected_revision'])
+
+    def query_upload(self, session: str, size: int)->tuple:
+        self._call('query_upload')
+        with self._lock:
+            return len(self._upload(session)['data']), None
+
+    def expire_upload_sessions(self)->None:
+        """Forget the ongoing uploads, as the drive does after a week"""
+        with self._lock:
+            self._uploads.clear()
+
+    def list_folder(self, folder_id: str)->dict:
+        self._call('list_folder')
+        with self._lock:
+            return dict(self._folders[folder_id])
+
+    def create_file(self, file_object, folder_id: str,
+                    file_name: str)->dict:
+        self._call('create_file')
+        data = b''.join(
+            iter(lambda: file_object.read(self.chunk_size), b''))
+        file_id = f'{folder_id}/{file_name}'
+        with self._lock:
+            self.bytes_uploaded += len(data)
+            self._folders[folder_id][file_name] = file_id
+        return self.put(file_id, data)
+
+    def get_start_page_token(self)->str:
+        self._call('get_start_page_token')
+        with self._lock:
+            return str(len(self.change_log))
+
+    def list_changes(self, page_token: str)->tuple:
+        changed_file_ids = set()
+        position = int(page_token)
+        while True:
+            # One call per page, as with the drive api
+            self._call('list_changes')
+            with self._lock:
+                page = self.change_log[
+                    position:position + self.changes_page_size]
+                position += len(page)
+                done = position >= len(self.change_log)
+            changed_file_ids.update(page)
+            if done:
+                return changed_file_ids, str(position)
@@ -0,0 +1,291 @@
+"""Schedule the calls to a backend: rate limit, concurrency limit, retries
+
+Every call to the wrapped backend:
+
+* waits for a token from a token bucket, so that bursts of syncs stay under
+  the request quota of the account
+* waits for one of the `max_concurrency` slots of the account
+* is retried on transient failures (network errors, http 429 and 5xx,
+  rate-limit 403), after an exponential backoff with jitter. A
+  `Retry-After` header is honored, and a throttled call pauses the bucket
+  for every other call to the account.
+
+The time spent waiting and backing off is recorded in the `backend_queue`
+and `backend_retry` spans (see `keypass_sync.metrics`).
+"""
+
+import random
+import threading
+import time
+
+from keypass_sync import metrics
+from keypass_sync.backends import Backend
+from keypass_sync.utilities import logger
+
+# Http statuses worth retrying
+retryable_statuses = (408, 429, 500, 502, 503, 504)
+
+# Reasons of the drive-api 403 errors worth retrying
+rate_limit_reasons = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+def error_status(error: Exception):
+    """Return the http status of a failed call, or None
+
+    Works with the `googleapiclient.errors.HttpError`s and with any error
+    having a `status` attribute.
+    """
+    status = getattr(error, 'status', None)
+    if status is None:
+        status = getattr(getattr(error, 'resp', None), 'status', None)
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after(error: Exception):
+    """Return the delay asked by the server before retrying, or None"""
+    delay = getattr(error, 'retry_after', None)
+    if delay is None:
+        headers = getattr(error, 'resp', None)
+        delay = headers.get('retry-after') if hasattr(headers, 'get') \
+            else None
+    try:
+        return float(delay)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_throttled(error: Exception)->bool:
+    """Check if a call failed because of the request quota"""
+    status = error_status(error)
+    if status == 429:
+        return True
+    if status == 403:
+        content = getattr(error, 'content', b'')
+        if isinstance(content, bytes):
+            content = content.decode(errors='replace')
+        return any(reason in str(content) for reason in rate_limit_reasons)
+    return False
+
+
+def is_retryable(error: Exception)->bool:
+    """Check if a failed call may succeed if retried"""
+    if is_throttled(error) or error_status(error) in retryable_statuses:
+        return True
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+class TokenBucket:
+    """Allow `rate` calls per second on average, and bursts of `capacity`
+
+    Args:
+        rate (float): tokens added per second
+        capacity (float): maximum number of tokens
+        clock: returns the current time, in seconds
+    """
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self)->None:
+        now = self._clock()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self)->float:
+        """Take a token
+
+        Returns:
+            time to wait before using it, in seconds
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            return max(0., -self._tokens / self.rate)
+
+    def pause(self, delay: float)->None:
+        """Give no token for the next `delay` seconds"""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, -delay * self.rate)
+
+
+class ScheduledBackend(Backend):
+    """Wrap a backend, scheduling its calls (see the module documentation)
+
+    Args:
+        backend (Backend): the wrapped backend
+        rate (float): average number of calls per second
+        burst (int): number of calls that may be done at once after a quiet
+            period
+        max_concurrency (int): maximum number of calls running at once
+        max_retries (int): maximum number of retries of a call
+        base_delay (float): backoff before the first retry, in seconds. It
+            doubles at each retry.
+        max_delay (float): maximum backoff, in seconds
+        clock: returns the current time, in seconds
+        sleep: waits for a given number of seconds
+        seed: seed of the jitter, for reproducibility
+    """
+    def __init__(self, backend: Backend, rate: float=10., burst: int=20,
+                 max_concurrency: int=4, max_retries: int=5,
+                 base_delay: float=.5, max_delay: float=32.,
+                 clock=time.monotonic, sleep=time.sleep, seed=None):
+        self.backend = backend
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.bucket = TokenBucket(rate, burst, clock)
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self.queued_time = 0.
+        self._clock = clock
+        self._sleep = sleep
+        self._random = random.Random(seed)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # Backend-specific attributes (e.g. `close`)
+        return getattr(self.backend, name)
+
+    def backoff(self, attempt: int, error: Exception)->float:
+        """Return the delay before retrying a call for the `attempt`th time
+
+        Full jitter: uniformly drawn below the exponential backoff, but not
+        shorter than the delay asked by the server.
+        """
+        with self._lock:
+            delay = self._random.uniform(0., min(
+                self.max_delay, self.base_delay * 2 ** attempt))
+        return max(delay, retry_after(error) or 0.)
+
+    def _schedule(self, name: str, call, *args, retryable=lambda: True,
+                  before_retry=lambda: None, **kwargs):
+        """Run `call(*args, **kwargs)` once scheduled, retrying it if needed
+
+        Args:
+            name (str): name of the call, for the logs
+            call: the call to the wrapped backend
+            retryable: tells if the call may still be retried after a
+                failure
+            before_retry: prepares the retry of the call
+        """
+        attempt = 0
+        while True:
+            with metrics.span('backend_queue'):
+                start = self._clock()
+                self._sleep(self.bucket.reserve())
+                self._slots.acquire()
+                queued_time = self._clock() - start
+            with self._lock:
+                self.calls += 1
+                self.queued_time += queued_time
+            try:
+                return call(*args, **kwargs)
+            except Exception as error:
+                if attempt >= self.max_retries or not is_retryable(error) \
+                        or not retryable():
+                    raise
+                delay = self.backoff(attempt, error)
+                with self._lock:
+                    self.retries += 1
+                    if is_throttled(error):
+                        self.throttled += 1
+                if is_throttled(error):
+                    # Slow every call to the account down
+                    self.bucket.pause(delay)
+                logger.info(f'{name} failed ({error!r}), retrying in '
+                            f'{delay:.1f}s')
+            finally:
+                self._slots.release()
+            with metrics.span('backend_retry'):
+                self._sleep(delay)
+            before_retry()
+            attempt += 1
+
+    def get_metadata(self, file_id: str)->dict:
+        return self._schedule('get_metadata', self.backend.get_metadata,
+                              file_id)
+
+    def get_metadata_batch(self, file_ids: list)->dict:
+        return self._schedule('get_metadata_batch',
+                              self.backend.get_metadata_batch, file_ids)
+
+    def download_to(self, file_id: str, file_object)->None:
+        # A partial download can not be taken back from `file_object`
+        writer = _CountingWriter(file_object)
+        return self._schedule('download_to', self.backend.download_to,
+                              file_id, writer,
+                              retryable=lambda: writer.bytes_written == 0)
+
+    def download_range(self, file_id: str, start: int, end: int)->bytes:
+        return self._schedule('download_range', self.backend.download_range,
+                              file_id, start, end)
+
+    def upload_from(self, file_object, file_id: str, file_name: str,
+                    expected_revision: str=None)->dict:
+        start = file_object.tell()
+        return self._schedule('upload_from', self.backend.upload_from,
+                              file_object, file_id, file_name,
+                              expected_revision,
+                              before_retry=lambda: file_object.seek(start))
+
+    @property
+    def chunk_granularity(self)->int:
+        return self.backend.chunk_granularity
+
+    def start_upload(self, file_id: str, file_name: str, size: int,
+                     expected_revision: str=None)->str:
+        return self._schedule('start_upload', self.backend.start_upload,
+                              file_id, file_name, size, expected_revision)
+
+    def upload_chunk(self, session: str, data: bytes, offset: int,
+                     size: int)->tuple:
+        # Part of the chunk may have been received: the uploader asks how
+        # far it went before sending the rest (see `keypass_sync.uploads`)
+        return self._schedule('upload_chunk', self.backend.upload_chunk,
+                              session, data, offset, size,
+                              retryable=lambda: False)
+
+    def query_upload(self, session: str, size: int)->tuple:
+        return self._schedule('query_upload', self.backend.query_upload,
+                              session, size)
+
+    def list_folder(self, folder_id: str)->dict:
+        return self._schedule('list_folder', self.backend.list_folder,
+                              folder_id)
+
+    def create_file(self, file_object, folder_id: str,
+                    file_name: str)->dict:
+        start = file_object.tell()
+        return self._schedule('create_file', self.backend.create_file,
+                              file_object, folder_id, file_name,
+                              before_retry=lambda: file_object.seek(start))
+
+    def get_start_page_token(self)->str:
+        return self._schedule('get_start_page_token',
+                              self.backend.get_start_page_token)
+
+    def list_changes(self, page_token: str)->tuple:
+        return self._schedule('list_changes', self.backend.list_changes,
+                              page_token)
+
+
+class _CountingWriter:
+    """Forward the writes to `file_object`, counting the written bytes"""
+    def __init__(self, file_object):
+        self._file_object = file_object
+        self.bytes_written = 0
+
+    def write(self, data)->int:
+        self.bytes_written += len(data)
+        return self._file_object.write(data)
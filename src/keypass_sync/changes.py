@@ -0,0 +1,98 @@
+"""Detect the cloud files changed since the last sync, from a changes feed
+
+Instead of fetching the metadata of every synced file, one paginated
+request to the changes feed of the account (see `Backend.list_changes`)
+lists the files changed since the previous poll. The position in the feed
+(page token) is kept in the state store, by profile: a run syncing some of
+the profiles of an account (e.g. `watch <name>`) moves their positions
+forward, and leaves the others where they were.
+
+The new position of a profile is only saved once its files were synced
+(see `save`): a failed sync is retried at the next poll.
+"""
+
+from keypass_sync import config, metrics
+from keypass_sync.utilities import logger
+
+
+def position_key(account: str, version: str)->str:
+    """Return the key of the position of a profile in the state store
+
+    Args:
+        account (str): key identifying the account, e.g. its credential
+            folder
+        version (str): the profile
+    """
+    return f'{account}#{version or "default"}'
+
+
+def poll(backend, account: str, versions: list)->tuple:
+    """List the cloud files changed since the saved positions of profiles
+
+    The profiles at the same position share one listing: they are all at
+    the same position once synced together.
+
+    Args:
+        backend (Backend): client of the account
+        account (str): key identifying the account in the state store, e.g.
+            its credential folder
+        versions (list): profiles of the account
+
+    Returns:
+        (dict giving the ids of the changed files for each profile: set, or
+        None if unknown: every file of the profile should be checked,
+        dict giving the position to `save` for each profile once it is
+        synced: str, or None)
+    """
+    store = config.state_store()
+    # Positions saved for the whole account by the older versions
+    account_token = store.get_page_token(account)
+    page_tokens = {
+        version: store.get_page_token(position_key(account, version))
+        or account_token for version in versions}
+    changed_file_ids = dict.fromkeys(versions)
+    positions = dict.fromkeys(versions)
+    with metrics.span('remote_changes'):
+        try:
+            for page_token in sorted(set(page_tokens.values()) - {None}):
+                try:
+                    changed, new_token = backend.list_changes(page_token)
+                except NotImplementedError:
+                    raise
+                except Exception as error:
+                    # e.g. an expired page token
+                    logger.warning(f'Could not list the changes of '
+                                   f'{account}: {error!r}: checking every '
+                                   f'file')
+                    continue
+                for version, token in page_tokens.items():
+                    if token == page_token:
+                        changed_file_ids[version] = changed
+                        positions[version] = new_token
+            unknown = [version for version in versions
+                       if positions[version] is None]
+            if unknown:
+                # Start from now: every file of those has to be checked
+                logger.info(f'No position in the changes feed of {account} '
+                            f'for {", ".join(map(str, unknown))}: checking '
+                            f'every file')
+                page_token = backend.get_start_page_token()
+                positions.update(dict.fromkeys(unknown, page_token))
+        except NotImplementedError:
+            pass
+        except Exception as error:
+            logger.warning(f'Could not reach the changes feed of {account}: '
+                           f'{error!r}: checking every file')
+    return changed_file_ids, positions
+
+
+def save(account: str, version: str, page_token: str)->None:
+    """Save the position of a profile in the changes feed of its account
+
+    Args:
+        account (str): see `poll`
+        version (str): the profile
+        page_token (str): returned by `poll`
+    """
+    config.state_store().put_page_token(position_key(account, version),
+                                        page_token)
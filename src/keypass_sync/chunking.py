@@ -0,0 +1,409 @@
+"""Chunked sync mode: content-defined chunks, chunk store and manifests
+
+In the chunked mode, the cloud file of a profile holds a small json
+manifest instead of the synced content. The content is split into chunks
+at positions chosen by a rolling hash (the gear hash of FastCDC): an edit
+only changes the chunks around it, the following boundaries stay in place.
+The chunks are stored in a cloud folder, the chunk store, named after
+their sha256. A new version of the file only uploads the chunks the store
+does not have yet, and a download only fetches the chunks that the local
+file does not already contain.
+
+The manifest looks like::
+
+    {"format": 1, "size": 1234, "hash": "<hash of the content>",
+     "chunks": [["<sha256 of the chunk>", <size>, "<cloud file id>"], ...]}
+
+`hash` is computed like the hash of a non-chunked file (see
+`keypass_sync.hashing`), so that the conflict detection of
+`sync_utils.sync` works the same in both modes. It tells the algorithm
+that made it: a client configured with another algorithm rebuilds the
+content to hash it (see `download_next_to`).
+
+The cut points are searched with numpy when it is installed: the rolling
+hash of every position is computed at once. Without it, the pure-python
+search only chunks a few MB per second, which is slower than uploading the
+whole file on most links.
+"""
+
+import functools
+import hashlib
+import io
+import json
+import os
+import tempfile
+from pathlib import Path
+
+from keypass_sync.hashing import HashingWriter, algorithm_of, \
+    default_algorithm, new_hasher
+from keypass_sync.utilities import logger
+
+# Version of the manifest format
+manifest_format = 1
+
+# Default average size of the chunks, in bytes. The chunks are between a
+# quarter and four times that size.
+default_average_size = 256 * 1024
+
+# Size of the reads when chunking a file, in bytes
+read_size = 1024 * 1024
+
+# Maximum size of a manifest, in bytes: about half a million chunks, i.e.
+# 128GiB of content at the default average chunk size
+max_manifest_size = 64 * 1024 * 1024
+
+_mask_64 = 2**64 - 1
+
+# Random values of the bytes for the gear hash. Derived from sha256 so that
+# every client cuts the same content at the same places.
+_gear = [int.from_bytes(hashlib.sha256(bytes([byte])).digest()[:8], 'big')
+         for byte in range(256)]
+
+
+def _masks(average_size: int)->tuple:
+    """Return the (strict, loose) masks of the normalized chunking
+
+    Cut points are tested on the high bits of the gear hash, which depend
+    on the last 64 bytes. The strict mask (one more bit) is used below the
+    average size and the loose one (one bit less) above, which keeps most
+    chunk sizes close to the average.
+    """
+    bits = max(2, average_size.bit_length() - 1)
+    return (((1 << (bits + 1)) - 1) << (63 - bits),
+            ((1 << (bits - 1)) - 1) << (65 - bits))
+
+
+@functools.lru_cache(maxsize=None)
+def _numpy():
+    """Return the numpy module, or None if it is not installed"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _cut_point_numpy(numpy, data, average_size: int)->int:
+    """Same as `cut_point`, computing the rolling hashes with numpy
+
+    The gear hash after a byte only depends on the last 64 bytes: it is the
+    sum of their gear values, each shifted by its distance to the byte. The
+    hashes of a block of positions are computed from those of the previous
+    byte(s) by doubling the hashed distance, 6 times.
+    """
+    min_size, max_size = average_size // 4, average_size * 4
+    size = len(data)
+    if size <= min_size:
+        return size
+    end = min(size, max_size)
+    normal_end = min(end, average_size)
+    strict_mask, loose_mask = (numpy.uint64(mask)
+                               for mask in _masks(average_size))
+    gear = numpy.array(_gear, dtype=numpy.uint64)
+    start = max(0, min_size - 64)
+    # Blocks of positions, the strict mask being used up to `normal_end`:
+    # the positions after the cut point are not hashed, but for the end of
+    # its block
+    block_size = max(64, average_size // 4)
+    bounds = sorted({normal_end, end}.union(
+        range(min_size, end, block_size)))
+    for block_start, block_end in zip(bounds, bounds[1:]):
+        first = max(start, block_start - 63)
+        hashes = gear.take(numpy.frombuffer(data, dtype=numpy.uint8,
+                                            count=block_end - first,
+                                            offset=first))
+        distance = 1
+        while distance < 64:
+            hashes[distance:] += hashes[:-distance] \
+                << numpy.uint64(distance)
+            distance *= 2
+        mask = strict_mask if block_start < normal_end else loose_mask
+        cuts = numpy.flatnonzero(
+            (hashes[block_start - first:] & mask) == 0)
+        if len(cuts):
+            return block_start + int(cuts[0]) + 1
+    return end
+
+
+def cut_point(data, average_size: int=default_average_size)->int:
+    """Return the size of the first chunk of `data`
+
+    Searched with numpy when it is installed (see `_cut_point_numpy`).
+
+    Args:
+        data (bytes-like): the data to chunk. It should hold at least four
+            times `average_size` bytes, unless it is the end of the content.
+        average_size (int): average size of the chunks, in bytes
+
+    Returns:
+        the position of the first cut point
+    """
+    numpy = _numpy()
+    if numpy is not None:
+        return _cut_point_numpy(numpy, data, average_size)
+    return _cut_point_python(data, average_size)
+
+
+def _cut_point_python(data, average_size: int)->int:
+    """Same as `cut_point`, in pure python"""
+    min_size, max_size = average_size // 4, average_size * 4
+    size = len(data)
+    if size <= min_size:
+        return size
+    end = min(size, max_size)
+    normal_end = min(end, average_size)
+    strict_mask, loose_mask = _masks(average_size)
+    gear = _gear
+    rolling_hash = 0
+    # No cut point below `min_size`: the bytes before it are not hashed
+    position = max(0, min_size - 64)
+    while position < normal_end:
+        rolling_hash = ((rolling_hash << 1) + gear[data[position]]) \
+            & _mask_64
+        position += 1
+        if position > min_size and not rolling_hash & strict_mask:
+            return position
+    while position < end:
+        rolling_hash = ((rolling_hash << 1) + gear[data[position]]) \
+            & _mask_64
+        position += 1
+        if not rolling_hash & loose_mask:
+            return position
+    return end
+
+
+def iter_chunks(file_object, average_size: int=default_average_size):
+    """Split the content of `file_object` into content-defined chunks
+
+    Args:
+        file_object: readable binary file
+        average_size (int): average size of the chunks, in bytes
+
+    Yields:
+        the chunks (bytes), in order
+    """
+    max_size = average_size * 4
+    buffer = bytearray()
+    end_of_file = False
+    while buffer or not end_of_file:
+        while not end_of_file and len(buffer) < max_size:
+            data = file_object.read(max(read_size, max_size))
+            end_of_file = not data
+            buffer += data
+        if not buffer:
+            return
+        size = cut_point(buffer, average_size)
+        yield bytes(buffer[:size])
+        del buffer[:size]
+
+
+def chunk_hash(data)->str:
+    """Return the name of a chunk in the chunk store"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def chunk_file(path: Path, average_size: int=default_average_size,
+               algorithm: str=default_algorithm, store_chunk=None)->dict:
+    """Split a file into chunks, reading it once
+
+    Args:
+        path (Path): file to chunk
+        average_size (int): average size of the chunks, in bytes
+        algorithm (str): name of the algorithm of the hash of the content
+            (see `hashing.algorithms`)
+        store_chunk: called with the name and the data of each chunk, as
+            it is read. Returns the id of the chunk in the chunk store.
+            Defaults to storing nothing.
+
+    Returns:
+        the manifest of the file, with the ids of the chunks if stored
+    """
+    if _numpy() is None:
+        logger.warning('numpy is not installed: the file is chunked at a '
+                       'few MB per second (pip install numpy)')
+    hasher = new_hasher(algorithm)
+    chunks = []
+    size = 0
+    with path.open('rb') as file:
+        for data in iter_chunks(file, average_size):
+            hasher.update(data)
+            name = chunk_hash(data)
+            chunks.append([name, len(data), None if store_chunk is None
+                           else store_chunk(name, data)])
+            size += len(data)
+    return dict(format=manifest_format, size=size, hash=hasher.hexdigest(),
+                chunks=chunks)
+
+
+def read_manifest(data: bytes)->dict:
+    """Parse the content of a cloud file holding a manifest
+
+    Args:
+        data (bytes): content of the cloud file
+
+    Returns:
+        the manifest
+
+    Raises:
+        ValueError: the content is not a manifest (e.g. the cloud file was
+            written in the non-chunked mode)
+    """
+    try:
+        manifest = json.loads(data.decode())
+    except (UnicodeDecodeError, ValueError):
+        manifest = None
+    if not isinstance(manifest, dict) \
+            or manifest.get('format') != manifest_format:
+        raise ValueError('The cloud file does not hold a chunk manifest')
+    return manifest
+
+
+def fetch_manifest(backend, file_id: str, metadata: dict=None)->dict:
+    """Download and parse the manifest held by a cloud file
+
+    At most `max_manifest_size` bytes are downloaded: a bigger cloud file
+    is rejected.
+
+    Args:
+        backend (Backend): where the cloud file is
+        file_id (str): id of the cloud file
+        metadata (dict): current metadata of the cloud file, if already
+            fetched
+
+    Raises:
+        ValueError: see `read_manifest`, or if the cloud file is bigger
+            than `max_manifest_size`
+    """
+    metadata = metadata or backend.get_metadata(file_id)
+    if int(metadata.get('size', 0)) > max_manifest_size:
+        raise ValueError('The cloud file is too big to hold a chunk manifest')
+    if metadata.get('size') == '0':
+        # Not a manifest, and no range to download
+        return read_manifest(b'')
+    try:
+        data = backend.download_range(file_id, 0, max_manifest_size + 1)
+    except NotImplementedError:
+        data = backend.download(file_id)
+    if len(data) > max_manifest_size:
+        raise ValueError('The cloud file is too big to hold a chunk manifest')
+    return read_manifest(data)
+
+
+def upload(backend, path: Path, file_id: str, folder_id: str,
+           file_name: str, average_size: int=default_average_size,
+           algorithm: str=default_algorithm,
+           expected_revision: str=None)->tuple:
+    """Upload the chunks of a file missing from the store, then its manifest
+
+    Args:
+        backend (Backend): where the cloud file and the chunk store are
+        path (Path): file to upload
+        file_id (str): id of the cloud file holding the manifest
+        folder_id (str): id of the chunk store folder
+        file_name (str): name to give to the cloud file
+        average_size (int): average size of the chunks, in bytes
+        algorithm (str): name of the algorithm of the hash of the content
+            (see `hashing.algorithms`)
+        expected_revision (str): `headRevisionId` the cloud file must still
+            have for its manifest to be replaced (see
+            `Backend.upload_from`)
+
+    Returns:
+        (metadata of the updated cloud file: dict, uploaded manifest: dict,
+        number of uploaded bytes: int)
+    """
+    stored_chunks = backend.list_folder(folder_id)
+    bytes_uploaded = 0
+
+    def store_chunk(name: str, data: bytes)->str:
+        nonlocal bytes_uploaded
+        if name not in stored_chunks:
+            stored_chunks[name] = backend.create_file(
+                io.BytesIO(data), folder_id, name)['id']
+            bytes_uploaded += len(data)
+        return stored_chunks[name]
+
+    # The missing chunks are uploaded as they are read and hashed: the
+    # manifest describes the uploaded bytes, even if the file changes
+    manifest = chunk_file(path, average_size, algorithm, store_chunk)
+    logger.info(f'Uploaded {bytes_uploaded} bytes in chunks, '
+                f'{manifest["size"] - bytes_uploaded} were already stored')
+    metadata = backend.upload(json.dumps(manifest).encode(), file_id,
+                              file_name, expected_revision)
+    return metadata, manifest, bytes_uploaded
+
+
+def _local_chunks(path: Path, manifest: dict)->dict:
+    """Index the chunks of the local file by hash, with their offsets"""
+    if manifest is None or not path.exists():
+        return {}
+    chunks = {}
+    offset = 0
+    for name, size, _ in manifest['chunks']:
+        chunks.setdefault(name, (offset, size))
+        offset += size
+    return chunks
+
+
+def download_next_to(local_file_path: Path, manifest: dict, backend,
+                     local_manifest: dict=None,
+                     algorithm: str=default_algorithm)->tuple:
+    """Rebuild the content described by `manifest` in a temporary file
+    next to `local_file_path`
+
+    The chunks already in the local file are copied from it, the others
+    are downloaded from the chunk store. Each chunk is checked against its
+    hash, and the rebuilt content against the hash of the manifest.
+
+    Args:
+        local_file_path (Path): file that the download may replace
+        manifest (dict): manifest of the content to download
+        backend (Backend): where the chunk store is
+        local_manifest (dict): manifest of the local file, as of the last
+            sync. Its chunks are looked for in the local file.
+        algorithm (str): name of the algorithm of the returned hash (see
+            `hashing.algorithms`)
+
+    Returns:
+        (downloaded_file_path: Path, hash of the downloaded content: str,
+        number of downloaded bytes: int)
+    """
+    local_chunks = _local_chunks(local_file_path, local_manifest)
+    file_descriptor, downloaded_file_path = tempfile.mkstemp(
+        prefix=f'.{local_file_path.name}.', suffix='.download',
+        dir=str(local_file_path.parent))
+    downloaded_file_path = Path(downloaded_file_path)
+    bytes_downloaded = 0
+    local_file = None
+    try:
+        if local_chunks:
+            local_file = local_file_path.open('rb')
+        with os.fdopen(file_descriptor, 'wb') as downloaded_file:
+            writer = checker = HashingWriter(downloaded_file, algorithm)
+            if algorithm_of(manifest['hash']) != algorithm:
+                checker = HashingWriter(writer, algorithm_of(manifest['hash']))
+            for name, size, chunk_id in manifest['chunks']:
+                data = None
+                if name in local_chunks:
+                    local_file.seek(local_chunks[name][0])
+                    data = local_file.read(size)
+                if data is None or chunk_hash(data) != name:
+                    data = backend.download(chunk_id)
+                    bytes_downloaded += len(data)
+                    if chunk_hash(data) != name:
+                        raise IOError(f'Chunk {name} of the store is '
+                                      f'corrupted')
+                checker.write(data)
+            downloaded_file.flush()
+            os.fsync(downloaded_file.fileno())
+        if checker.hexdigest() != manifest['hash']:
+            raise IOError('The downloaded chunks do not match the manifest')
+    except BaseException:
+        downloaded_file_path.unlink()
+        raise
+    finally:
+        if local_file is not None:
+            local_file.close()
+    logger.info(f'Downloaded {bytes_downloaded} bytes in chunks, '
+                f'{manifest["size"] - bytes_downloaded} were found locally')
+    return downloaded_file_path, writer.hexdigest(), bytes_downloaded
@@ -7,9 +7,11 @@ integration
 """
 
 import json
-import pprint
-from google_services import config as services_config
 
+from keypass_sync import state
+from keypass_sync.content_cache import ContentCache, default_max_size
+from keypass_sync.history import History, default_keep, \
+    default_max_age_days
 from keypass_sync.utilities import logger, sanitize_path, \
     create_folder_if_needed
 from keypass_sync.config import ask_user
@@ -19,9 +21,90 @@ default_config_path = '~/.keypass_google_drive_sync/'
 
 
 def get_config_file_path(version):
+    """Where older versions saved the config of `version`
+
+    Configs are now saved in the state store (see `state_store`).
+    """
     return sanitize_path(default_config_path) / version
 
 
+def state_store()->state.StateStore:
+    """Return the store holding the configs and the sync state
+
+    It lives in the config folder. On first use, the configs saved as json
+    files by the older versions are imported into it.
+
+    Returns:
+        state.StateStore
+    """
+    store = state.open_store(
+        sanitize_path(default_config_path) / '.state.sqlite3')
+    store.import_configs(sanitize_path(default_config_path))
+    return store
+
+
+def content_cache(max_size: int=default_max_size)->ContentCache:
+    """Return the cache of the synced contents
+
+    It lives in the config folder, and is shared by every version.
+
+    Args:
+        max_size (int): maximum size of the cached contents, in bytes
+
+    Returns:
+        content_cache.ContentCache
+    """
+    return ContentCache(sanitize_path(default_config_path) / '.contents',
+                        state_store(), max_size)
+
+
+def history(keep: int=default_keep,
+            max_age_days: float=default_max_age_days,
+            content_cache_size: int=default_max_size)->History:
+    """Return the snapshots of the synced versions
+
+    Their contents are kept in the content cache (see `content_cache`).
+
+    Args:
+        keep (int): number of snapshots kept per file
+        max_age_days (float): age beyond which the snapshots are removed,
+            in days. 0 keeps them whatever their age.
+        content_cache_size (int): maximum size of the cached contents that
+            no snapshot refers to, in bytes
+
+    Returns:
+        history.History
+    """
+    return History(content_cache(content_cache_size), keep, max_age_days)
+
+
+def profile_history(version: str='')->History:
+    """Return the snapshots, with the retention policy of a version
+
+    Unlike the `snapshots` sync option (see `sync_options`), it is returned
+    even if the snapshots of the version are disabled, to list or restore
+    the older ones.
+
+    Args:
+        version(str): version of the configuration to use
+
+    Returns:
+        history.History
+    """
+    if version == '':
+        version = 'default'
+    return _history_of(_read(version))
+
+
+def _history_of(config: dict)->History:
+    """Return the snapshots, with the `history_*` and `content_cache_size`
+    entries of a config (both disabled by default, see `sync_options`)"""
+    return history(int(config.get('history_keep', 0)),
+                   float(config.get('history_max_age_days',
+                                    default_max_age_days)),
+                   int(config.get('content_cache_size', 0)))
+
+
 def _read(version: str= 'default')->dict:
     """Load desired config fom the filesystem
 
@@ -53,17 +136,63 @@ def _read(version: str= 'default')->dict:
         cache_folder=default_config_path + f'{version}_cache/')
 
     # Update them with saved ones
-    config_file_path = get_config_file_path(version)
-    logger.debug(f'config path: {config_file_path}')
-    if config_file_path.exists():
-        with config_file_path.open("r") as config_file:
-            saved_config = json.load(config_file)
+    saved_config = state_store().get_config(version)
+    if saved_config is not None:
         config.update(saved_config)
 
-    logger.debug(f'Loaded config: {pprint.pformat(config)}')
+    logger.debug(f'Loaded config: {json.dumps(config, indent=2)}')
     return config
 
 
+def list_versions()->list:
+    """List the versions of the configuration saved on this machine
+
+    Returns:
+        sorted list of version names
+    """
+    return state_store().versions()
+
+
+def load_profile(version: str='')->dict:
+    """Load and validate the config for the specified version
+
+    Unlike `load`, the google-api SSO token path is returned instead of being
+    set globally, so that several profiles may be used at the same time.
+
+    The optional `metrics_log` and `metrics_textfile` entries tell where to
+    export the timings of the sync operations: a file to which a json line
+    is appended for each sync, and a node_exporter textfile. They default
+    to None (no export).
+
+    Args:
+        version(str): version of the configuration to use
+
+    Returns:
+        dict with the `local_file_path` (pathlib.Path), `cloud_file_id`
+        (str), `cache_folder_path` (pathlib.Path), `credential_folder_path`
+        (str), `metrics_log` and `metrics_textfile` (pathlib.Path or None)
+        entries
+    """
+    if version == '':
+        version = 'default'
+
+    config = validate_config(_read(version), context_msg=(
+            f' Please make sure that you have followed the '
+            f'instructions at '
+            f'https://github.com/Retzoh/keypass_google_drive_sync to download'
+            f'a google-SSO token and run `python -m keypass-sync init`. '
+            f'Config version: {version}.'))
+
+    return dict(local_file_path=sanitize_path(config['local_file_path']),
+                cloud_file_id=config['cloud_file_id'],
+                cache_folder_path=sanitize_path(config['cache_folder']),
+                credential_folder_path=config['credential_folder_path'],
+                metrics_log=config.get('metrics_log') and sanitize_path(
+                    config['metrics_log']),
+                metrics_textfile=config.get('metrics_textfile')
+                and sanitize_path(config['metrics_textfile']))
+
+
 def load(version: str='')->tuple:
     """Load, validate and process the config for the specified version
 
@@ -81,24 +210,90 @@ def load(version: str='')->tuple:
         (local_file_path: pathlib.Path, cloud_file_id: str,
         cache_folder: pathlib.Path)
     """
-    if version == '':
-        version = 'default'
+    # Imported here, as importing google_services takes long
+    from google_services import config as services_config
+
+    profile = load_profile(version)
+
+    logger.info('setting credential path')
+    services_config.default.credential_path = profile[
+        'credential_folder_path']
+
+    return (profile['local_file_path'],
+            profile['cloud_file_id'],
+            profile['cache_folder_path'])
+
+
+def sync_options(version: str='')->dict:
+    """Load the optional sync settings for the specified version
+
+    Those entries are not required in the config file:
+
+    * `rehash_every`: fully re-hash the local file every `rehash_every` runs,
+      even if its stat-fingerprint did not change (0, the default, never
+      forces it)
+    * `upload_chunk_size`: size of the uploaded chunks, in bytes (8MiB by
+      default). Interrupted uploads resume from the last chunk received.
+    * `download_chunk_size`: size of the ranges in which large cloud files
+      are downloaded, in bytes (8MiB by default)
+    * `download_workers`: number of ranges downloaded at once (4 by default,
+      1 streams every file in a single request)
+    * `hash_algorithm`: algorithm of the hashes telling if the files changed:
+      sha256 (the default), blake2b, sha3_512 (used by the older versions)
+      or xxh3 (fastest, not cryptographic, needs the xxhash package)
+    * `folder_workers`: number of files of a folder profile transferred at
+      once (4 by default, see `keypass_sync.folders`)
+    * `chunk_folder_id`: google-drive-id of a folder holding the chunks of
+      the file, to sync it in the chunked mode (see `keypass_sync.chunking`)
+    * `chunk_average_size`: average size of the chunks, in bytes (256KiB by
+      default)
+    * `content_cache_size`: maximum size of the local copies of the synced
+      contents, in bytes (0, the default, disables them; e.g. 268435456
+      for 256MiB). They are used instead of downloading known revisions
+      again (see `keypass_sync.content_cache`), at the cost of writing
+      each synced content to the disk a second time. The contents of the
+      snapshots are kept there too, and not counted.
+    * `history_keep`: number of snapshots of the synced versions kept per
+      file (0, the default, disables them; e.g. 10, see
+      `keypass_sync.history`). They take up to `history_keep` times the
+      size of each synced file on the disk, on top of the content cache.
+    * `history_max_age_days`: age beyond which the snapshots are removed,
+      in days (0, the default, keeps them whatever their age)
 
-    config = validate_config(_read(version), context_msg=(
-            f' Please make sure that you have followed the '
-            f'instructions at '
-            f'https://github.com/Retzoh/keypass_google_drive_sync to download'
-            f'a google-SSO token and run `python -m keypass-sync init`. '
-            f'Config version: {version}.'))
+    Args:
+        version(str): version of the configuration to use
 
-    if 'credential_folder_path' in config.keys():
-        logger.info('setting credential path')
-        services_config.default.credential_path = config[
-            'credential_folder_path']
+    Returns:
+        dict of keyword arguments for `sync_utils.sync`, but for
+        `folder_workers` (see `folders.sync_folder`). The
+        `content_cache_size` entry gives the `content_cache` argument, and
+        the `history_*` entries the `snapshots` one (None if disabled).
+    """
+    if version == '':
+        version = 'default'
 
-    return (sanitize_path(config['local_file_path']),
-            config['cloud_file_id'],
-            sanitize_path(config['cache_folder']))
+    config = _read(version)
+    options = dict(rehash_every=int(config.get('rehash_every', 0)))
+    if config.get('upload_chunk_size'):
+        options['upload_chunk_size'] = int(config['upload_chunk_size'])
+    if config.get('download_chunk_size'):
+        options['download_chunk_size'] = int(config['download_chunk_size'])
+    if config.get('download_workers'):
+        options['download_workers'] = int(config['download_workers'])
+    if config.get('hash_algorithm'):
+        options['hash_algorithm'] = config['hash_algorithm']
+    if config.get('folder_workers'):
+        options['folder_workers'] = int(config['folder_workers'])
+    if config.get('chunk_folder_id'):
+        options['chunk_folder_id'] = config['chunk_folder_id']
+    if config.get('chunk_average_size'):
+        options['chunk_average_size'] = int(config['chunk_average_size'])
+    content_cache_size = int(config.get('content_cache_size', 0))
+    options['content_cache'] = content_cache(content_cache_size) \
+        if content_cache_size else None
+    snapshots = _history_of(config)
+    options['snapshots'] = snapshots if snapshots.keep else None
+    return options
 
 
 def _write(config: dict, version: str= 'default')->dict:
@@ -127,14 +322,36 @@ def _write(config: dict, version: str= 'default')->dict:
 
     logger.debug(f'version: {version}')
 
-    create_folder_if_needed(get_config_file_path(version).parent)
-    with get_config_file_path(version).open("w") as config_file:
-        json.dump(config, config_file)
+    state_store().put_config(version, config)
 
-    logger.debug(f'Saved config: {pprint.pformat(config)}')
+    logger.debug(f'Saved config: {json.dumps(config, indent=2)}')
     return config
 
 
+def set_option(key: str, value: str, version: str='')->dict:
+    """Set one entry of the config of a version
+
+    Used for the optional entries (e.g. `metrics_log`, `rehash_every`),
+    which `init` does not ask for. An empty value removes the entry.
+
+    Args:
+        key (str): name of the entry
+        value (str): value of the entry
+        version (str): version of the configuration to use
+
+    Returns:
+        the updated config
+    """
+    if version == '':
+        version = 'default'
+    config = state_store().get_config(version) or {}
+    if value == '':
+        config.pop(key, None)
+    else:
+        config[key] = value
+    return _write(config, version)
+
+
 def init(version: str='')->None:
     """Setup everything to be able to sync a file
 
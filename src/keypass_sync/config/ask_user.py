@@ -83,11 +83,11 @@ def credential_file_path(root_path, default):
         f'to {root_path})', default_value=default)
 
 
-@repeat_ask_until_valid_decorator(validate.is_file_and_exists)
+@repeat_ask_until_valid_decorator(validate.is_file_or_folder_and_exists)
 def local_file_path(default):
-    """Ask for the path to the database to sync
+    """Ask for the path to the database (or folder) to sync
 
-    Validity: the resulting path should point to an existing file
+    Validity: the resulting path should point to an existing file or folder
 
     Args:
         default (str): a default path
@@ -96,7 +96,8 @@ def local_file_path(default):
         the path
     """
     return with_default(
-        f'Path to keypass database on local machine', default_value=default)
+        f'Path to keypass database (or folder) on local machine',
+        default_value=default)
 
 
 @repeat_ask_until_valid_decorator(validate.cloud_file_id)
@@ -112,4 +113,4 @@ def cloud_file_id(default):
         the id
     """
     return with_default(
-        f'Id of the file on google drive', default)
+        f'Id of the file (or folder) on google drive', default)
@@ -88,6 +88,27 @@ def is_file_and_exists(candidate: str):
     return candidate, False
 
 
+def is_file_or_folder_and_exists(candidate: str):
+    """Check that the given candidate is valid
+
+    Same as `is_file_and_exists`, folders being valid too (folder profiles,
+    see `keypass_sync.folders`).
+
+    Args:
+        candidate (str): the file-path candidate
+
+    Returns:
+        if valid:
+          candidate, False
+        if not:
+           candidate, indication
+
+    """
+    if candidate != '' and sanitize_path(candidate).is_dir():
+        return candidate, False
+    return is_file_and_exists(candidate)
+
+
 def config(candidate: dict, context_msg: str= '')->dict:
     """Validate a config candidate
 
@@ -97,8 +118,8 @@ def config(candidate: dict, context_msg: str= '')->dict:
       containing at least a `client_id.json` or `token.json` file. The
       validity of those files will be checked later by the google_services
       package (https://github.com/Retzoh/google_services_wrapper).
-    * A `local_file_path` pointing to an existing file
-    * A non-empty `cloud_file_id`
+    * A `local_file_path` pointing to an existing file, or folder
+    * A non-empty `cloud_file_id` (of a folder if `local_file_path` is one)
     * A non-empty `cache_folder` entry
 
     Args:
@@ -119,7 +140,7 @@ def config(candidate: dict, context_msg: str= '')->dict:
     _, error_msg = cloud_file_id(candidate['cloud_file_id'])
     log_and_exit(error_msg + context_msg) if error_msg else ''
 
-    _, error_msg = is_file_and_exists(candidate['local_file_path'])
+    _, error_msg = is_file_or_folder_and_exists(candidate['local_file_path'])
     log_and_exit(error_msg + context_msg) if error_msg else ''
 
     # cache_folder is specified
@@ -0,0 +1,257 @@
+"""Local cache of the synced contents, to avoid downloading them again
+
+The contents uploaded and downloaded by the syncs are copied to a folder
+(`.contents` in the config folder), named after their hash, and the
+revision of the cloud file holding each of them is recorded in the state
+store (see `keypass_sync.state`). When a sync, or `force-update local`,
+needs a revision of the cloud file whose content is cached, the content is
+copied from the disk instead of being downloaded (see
+`sync_utils.download_next_to`). A sync only comparing hashes does not even
+copy it: the hash of a known revision is enough.
+
+A cached content is checked against its hash each time it is used, and
+dropped if it does not match. Once the cached contents exceed `max_size`
+bytes, the least recently used ones are removed.
+
+The snapshots of the synced versions (see `keypass_sync.history`) keep
+their contents in the same folder: a content is stored once, whether it is
+cached, snapshotted or both. The contents that a snapshot refers to are
+pinned: they are neither evicted nor counted in `max_size`.
+"""
+
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+from keypass_sync import hashing
+from keypass_sync.hashing import HashingWriter
+from keypass_sync.utilities import logger
+
+# Default maximum size of the cached contents, in bytes
+default_max_size = 256 * 1024 * 1024
+
+
+def revision_of(metadata: dict):
+    """Return the revision of a cloud file from its metadata, or None"""
+    return (metadata or {}).get('headRevisionId')
+
+
+def copy_next_to(content_path: Path, data_hash: str, local_file_path: Path,
+                 algorithm: str=hashing.default_algorithm):
+    """Copy a content to a temporary file next to `local_file_path`,
+    checking it against its hash
+
+    Args:
+        content_path (Path): file holding the content
+        data_hash (str): hash of the content
+        local_file_path (Path): file that the copy may replace
+        algorithm (str): name of the algorithm of the returned hash (see
+            `hashing.algorithms`)
+
+    Returns:
+        (copied_file_path: Path, hash of the content: str), or None if
+        `content_path` does not exist or does not match the hash
+    """
+    try:
+        content_file = content_path.open('rb')
+    except FileNotFoundError:
+        return None
+    file_descriptor, copied_file_path = tempfile.mkstemp(
+        prefix=f'.{local_file_path.name}.', suffix='.download',
+        dir=str(local_file_path.parent))
+    copied_file_path = Path(copied_file_path)
+    try:
+        with content_file, \
+                os.fdopen(file_descriptor, 'wb') as copied_file:
+            writer = checker = HashingWriter(copied_file, algorithm)
+            if hashing.algorithm_of(data_hash) != algorithm:
+                checker = HashingWriter(writer,
+                                        hashing.algorithm_of(data_hash))
+            shutil.copyfileobj(content_file, checker,
+                               hashing.default_chunk_size)
+            copied_file.flush()
+            os.fsync(copied_file.fileno())
+    except BaseException:
+        copied_file_path.unlink()
+        raise
+    if checker.hexdigest() != data_hash:
+        copied_file_path.unlink()
+        return None
+    return copied_file_path, writer.hexdigest()
+
+
+class ContentCache:
+    """Contents of cloud files, by hash and by revision
+
+    Args:
+        folder_path (Path): folder holding the contents
+        store (state.StateStore): store holding the index of the contents
+        max_size (int): maximum size of the cached contents, in bytes
+    """
+    def __init__(self, folder_path: Path, store,
+                 max_size: int=default_max_size):
+        self.folder_path = Path(folder_path)
+        self.store = store
+        self.max_size = max_size
+
+    def path_of(self, data_hash: str)->Path:
+        """Where the content of hash `data_hash` is kept"""
+        # The `:` of the tagged hashes is not allowed in every file system
+        return self.folder_path / data_hash.replace(':', '-')
+
+    def lookup(self, file_id: str, metadata: dict):
+        """Return the hash of the revision of a cloud file, if it is cached
+
+        Args:
+            file_id (str): id of the cloud file
+            metadata (dict): metadata of the cloud file, giving its revision
+
+        Returns:
+            the hash of the content of the revision, or None
+        """
+        revision = revision_of(metadata)
+        if revision is None:
+            return None
+        return self.store.get_revision(file_id, revision)
+
+    def put(self, path: Path, data_hash: str, file_id: str=None,
+            metadata: dict=None)->bool:
+        """Copy a content to the cache
+
+        Args:
+            path (Path): file holding the content
+            data_hash (str): hash of the content
+            file_id (str): id of the cloud file holding the content, if any
+            metadata (dict): metadata of the cloud file, giving its revision
+
+        Returns:
+            true if the content was cached, false if it is larger than the
+            cache
+        """
+        size = path.stat().st_size
+        if size > self.max_size:
+            return False
+        content_path = self.path_of(data_hash)
+        if not content_path.exists():
+            self.folder_path.mkdir(parents=True, exist_ok=True)
+            file_descriptor, copy_path = tempfile.mkstemp(
+                prefix='.', suffix='.tmp', dir=str(self.folder_path))
+            os.close(file_descriptor)
+            try:
+                shutil.copyfile(str(path), copy_path)
+                os.replace(copy_path, str(content_path))
+            except BaseException:
+                os.unlink(copy_path)
+                raise
+        self.store.put_content(data_hash, size, file_id,
+                               revision_of(metadata))
+        self.evict()
+        return True
+
+    def store_file(self, path: Path, algorithm: str)->str:
+        """Copy a file to the cache folder, hashing it, without indexing it
+
+        The content is not evicted until it is indexed (see e.g.
+        `history.History.snapshot`).
+
+        Args:
+            path (Path): file holding the content
+            algorithm (str): name of the hash algorithm (see
+                `hashing.algorithms`)
+
+        Returns:
+            the hash of the copied content
+        """
+        self.folder_path.mkdir(parents=True, exist_ok=True)
+        file_descriptor, copy_path = tempfile.mkstemp(
+            prefix='.', suffix='.tmp', dir=str(self.folder_path))
+        try:
+            with path.open('rb') as file, \
+                    os.fdopen(file_descriptor, 'wb') as copy:
+                writer = HashingWriter(copy, algorithm)
+                shutil.copyfileobj(file, writer, hashing.default_chunk_size)
+                copy.flush()
+                os.fsync(copy.fileno())
+            data_hash = writer.hexdigest()
+            content_path = self.path_of(data_hash)
+            if content_path.exists():
+                os.unlink(copy_path)
+            else:
+                os.replace(copy_path, str(content_path))
+        except BaseException:
+            if os.path.exists(copy_path):
+                os.unlink(copy_path)
+            raise
+        return data_hash
+
+    def copy_next_to(self, data_hash: str, local_file_path: Path,
+                     algorithm: str=hashing.default_algorithm):
+        """Copy a cached content to a temporary file next to
+        `local_file_path`, checking it against its hash
+
+        Args:
+            data_hash (str): hash of the content
+            local_file_path (Path): file that the copy may replace
+            algorithm (str): name of the algorithm of the returned hash (see
+                `hashing.algorithms`)
+
+        Returns:
+            (copied_file_path: Path, hash of the content: str), or None if
+            the content is not cached or does not match its hash
+        """
+        content_path = self.path_of(data_hash)
+        copied = copy_next_to(content_path, data_hash, local_file_path,
+                              algorithm)
+        if copied is None:
+            if content_path.exists():
+                logger.warning(f'Cached content {data_hash} is corrupted, '
+                               f'dropping it')
+            self.discard([data_hash])
+            return None
+        self.store.touch_content(data_hash)
+        return copied
+
+    def discard(self, data_hashes: list, snapshotted: bool=True)->list:
+        """Remove contents from the cache
+
+        Args:
+            data_hashes (list): hashes of the contents
+            snapshotted (bool): whether to remove the contents that
+                snapshots refer to (e.g. corrupted ones)
+
+        Returns:
+            the hashes of the removed contents
+        """
+        # The files are removed in the transaction: a snapshot can not
+        # start referring to them in between (see `history.History`)
+        with self.store.transaction():
+            data_hashes = self.store.delete_contents(data_hashes,
+                                                     snapshotted)
+            for data_hash in data_hashes:
+                try:
+                    self.path_of(data_hash).unlink()
+                except FileNotFoundError:
+                    pass
+        return data_hashes
+
+    def evict(self)->list:
+        """Remove the least recently used contents, down to `max_size` bytes
+
+        The contents that snapshots refer to are kept, and not counted.
+
+        Returns:
+            the hashes of the removed contents
+        """
+        contents = self.store.contents()
+        total_size = sum(size for _, size in contents)
+        evicted = []
+        for data_hash, size in contents:
+            if total_size <= self.max_size:
+                break
+            evicted.append(data_hash)
+            total_size -= size
+        if evicted:
+            logger.debug(f'Evicting {len(evicted)} content(s) from the cache')
+            evicted = self.discard(evicted, snapshotted=False)
+        return evicted
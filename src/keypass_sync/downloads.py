@@ -0,0 +1,136 @@
+"""Download large files by ranges, fetched in parallel
+
+The file is split in ranges of `chunk_size` bytes, fetched concurrently by
+`max_workers` threads (see `Backend.download_range`). Each range is written
+at its place in a preallocated file as soon as it arrives, and hashed once
+the ranges before it were: the whole file is never held in memory, at most
+`2 * max_workers` ranges are.
+
+Small files, and backends without ranged downloads, are streamed in one
+request instead (see `Backend.download_to`).
+"""
+
+import hashlib
+import os
+from collections import deque
+
+from keypass_sync.hashing import HashingWriter, default_algorithm, \
+    new_hasher
+
+# Default size of the ranges, in bytes
+default_chunk_size = 8 * 1024 * 1024
+
+# Default number of ranges fetched at once
+default_max_workers = 4
+
+
+def _preallocate(file_descriptor: int, size: int)->None:
+    """Reserve the space of the file, so that the ranges may be written in
+    any order without fragmenting it"""
+    try:
+        os.posix_fallocate(file_descriptor, 0, size)
+    except (AttributeError, OSError):
+        # Not available on every platform and file system
+        os.ftruncate(file_descriptor, size)
+
+
+def _write_at(file_descriptor: int, data: bytes, offset: int)->None:
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(file_descriptor, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def download(backend, file_id: str, file_object, size: int=None,
+             md5_checksum: str=None, chunk_size: int=default_chunk_size,
+             max_workers: int=default_max_workers,
+             algorithm: str=default_algorithm)->tuple:
+    """Download a cloud file into `file_object`, hashing it
+
+    Args:
+        backend (Backend): where the cloud file is
+        file_id (str): id of the cloud file
+        file_object: empty binary file, opened for writing. It should be a
+            real file (with a `fileno`) to be downloaded by ranges.
+        size (int): size of the cloud file, if known. Files smaller than
+            two ranges, or of unknown size, are streamed in one request.
+        md5_checksum (str): md5 checksum of the cloud file, if known. The
+            ranges are checked against it, as they might come from different
+            revisions of the file.
+        chunk_size (int): size of the ranges, in bytes
+        max_workers (int): number of ranges fetched at once
+        algorithm (str): name of the hash algorithm (see
+            `hashing.algorithms`)
+
+    Returns:
+        (hash of the content: str, number of bytes written: int)
+    """
+    if size is None or size < 2 * chunk_size or max_workers < 2 \
+            or not hasattr(file_object, 'fileno') \
+            or not hasattr(os, 'pwrite'):
+        return _download_stream(backend, file_id, file_object, algorithm)
+    try:
+        return _download_ranges(backend, file_id, file_object, size,
+                                md5_checksum, chunk_size, max_workers,
+                                algorithm)
+    except NotImplementedError:
+        file_object.seek(0)
+        file_object.truncate()
+        return _download_stream(backend, file_id, file_object, algorithm)
+
+
+def _download_stream(backend, file_id: str, file_object,
+                     algorithm: str)->tuple:
+    writer = HashingWriter(file_object, algorithm)
+    backend.download_to(file_id, writer)
+    return writer.hexdigest(), writer.bytes_written
+
+
+def _download_ranges(backend, file_id: str, file_object, size: int,
+                     md5_checksum: str, chunk_size: int,
+                     max_workers: int, algorithm: str)->tuple:
+    # Imported here to keep the import of the command-line tool fast
+    from concurrent.futures import ThreadPoolExecutor
+
+    file_object.flush()
+    file_descriptor = file_object.fileno()
+    _preallocate(file_descriptor, size)
+    hasher = new_hasher(algorithm)
+    md5 = hashlib.md5() if md5_checksum else None
+
+    def fetch(start: int)->bytes:
+        end = min(start + chunk_size, size)
+        data = backend.download_range(file_id, start, end)
+        if len(data) != end - start:
+            raise IOError(f'Expected {end - start} bytes from range '
+                          f'{start}-{end} of {file_id}, got {len(data)}')
+        _write_at(file_descriptor, data, start)
+        return data
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        try:
+            for start in range(0, size, chunk_size):
+                pending.append(executor.submit(fetch, start))
+                # Hash in order, keeping a bounded number of ranges around
+                while len(pending) >= 2 * max_workers:
+                    _hash(pending.popleft().result(), hasher, md5)
+            while pending:
+                _hash(pending.popleft().result(), hasher, md5)
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+
+    if md5 is not None and md5.hexdigest() != md5_checksum:
+        raise IOError(f'The content of {file_id} changed while downloading '
+                      f'it')
+    file_object.seek(size)
+    return hasher.hexdigest(), size
+
+
+def _hash(data: bytes, hasher, md5)->None:
+    hasher.update(data)
+    if md5 is not None:
+        md5.update(data)
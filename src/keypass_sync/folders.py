@@ -0,0 +1,297 @@
+"""Folder profiles: sync the files of a local folder with a drive folder
+
+The files of the local folder are matched with the files of the cloud
+folder by name. Sub-folders and hidden files are left out. The cloud files
+whose name is not a plain file name of the local folder (e.g. `../file` or
+`.file`) are skipped (see `is_safe_name`).
+
+The state of the folder is a manifest in the state store: each file has its
+own cache entries (hash, stat-fingerprint and revision of the cloud file,
+see `sync_utils.sync`) under `<cache folder>/files/<name>`, and the
+`folder.json` entry of the profile gives the id of the cloud file of each
+name. A sync lists the cloud folder and fetches the metadata of its files
+in one pass, compares them and the local fingerprints with the manifest,
+and only syncs the files that changed, in parallel. Each of them goes
+through `sync_utils.sync`: the conflicts are detected file by file, from
+the same three hashes (local, cloud, last synced).
+
+Files deleted on one side are copied again from the other: remove them on
+both sides.
+"""
+
+import json
+import os
+from pathlib import Path
+
+from keypass_sync import downloads, hashing, history, metrics
+from keypass_sync.hashing import HashingReader
+from keypass_sync.sync_utils import cache_entries, download_next_to, \
+    fetch_metadata, fingerprint_entry, get_fingerprint, \
+    load_entry_from_cache, load_remote_metadata, remote_was_updated, sync, \
+    unchanged_local_hash, update_local, up_to_date, uploaded, downloaded, \
+    failed
+from keypass_sync.utilities import logger
+
+# Result of a folder sync that both uploaded and downloaded files
+uploaded_and_downloaded = 'uploaded and downloaded'
+
+# Result of a cloud file left out for its name
+skipped = 'skipped'
+
+# Default number of files transferred at once
+default_max_workers = 4
+
+
+def file_cache_path(cache_folder_path: Path, name: str)->Path:
+    """Return the scope of the cache entries of a file of the folder"""
+    return cache_folder_path / 'files' / name
+
+
+def list_local_files(local_folder_path: Path)->dict:
+    """List the files to sync in a local folder
+
+    Returns:
+        dict giving the path of each file, by name
+    """
+    return {path.name: path for path in local_folder_path.iterdir()
+            if path.is_file() and not path.name.startswith('.')}
+
+
+def is_safe_name(name: str, local_folder_path: Path)->bool:
+    """Check if a cloud file name may be written in the local folder
+
+    The name must be the one of a file directly in the folder, and not a
+    hidden one (those are not listed, see `list_local_files`).
+
+    Args:
+        name (str): name of the cloud file
+        local_folder_path (Path): the local folder
+    """
+    if not name or name in ('.', '..') or name.startswith('.') \
+            or '\0' in name or Path(name).is_absolute() \
+            or any(separator and separator in name
+                   for separator in ('/', os.sep, os.altsep)):
+        return False
+    folder_path = local_folder_path.resolve()
+    return (local_folder_path / name).resolve().parent == folder_path
+
+
+def is_unchanged(local_file_path: Path, metadata: dict,
+                 cache_folder_path: Path)->bool:
+    """Check if a file changed on neither side since the last sync
+
+    Nothing is recorded (see `sync_utils.unchanged_local_hash`): the files
+    that may have changed are synced with `sync_utils.sync`, which checks
+    them again.
+
+    Args:
+        local_file_path (Path): the local file
+        metadata (dict): current metadata of the cloud file
+        cache_folder_path (Path): scope of the cache entries of the file
+    """
+    return not remote_was_updated(
+        metadata, load_remote_metadata(cache_folder_path)) \
+        and unchanged_local_hash(local_file_path,
+                                 cache_folder_path) is not None
+
+
+def local_files_unchanged(local_folder_path: Path,
+                          cache_folder_path: Path)->bool:
+    """Check if no local file of the folder changed since the last sync
+
+    Nothing is recorded (see `sync_utils.unchanged_local_hash`).
+
+    Args:
+        local_folder_path (Path): the local folder
+        cache_folder_path (Path): cache folder of the profile
+    """
+    known_files = json.loads(load_entry_from_cache(
+        'folder.json', cache_folder_path) or '{}')
+    return all(
+        name in known_files and unchanged_local_hash(
+            local_file_path, file_cache_path(cache_folder_path, name))
+        is not None
+        for name, local_file_path in list_local_files(
+            local_folder_path).items())
+
+
+def create_cloud_file(local_file_path: Path, cloud_folder_id: str,
+                      cache_folder_path: Path, backend,
+                      algorithm: str=hashing.default_algorithm,
+                      snapshots=None)->str:
+    """Upload a file that the cloud folder does not have yet
+
+    Args:
+        local_file_path (Path): the new local file
+        cloud_folder_id (str): id of the cloud folder
+        cache_folder_path (Path): scope of the cache entries of the file
+        backend (Backend): where the cloud folder is
+        algorithm (str): name of the hash algorithm (see
+            `hashing.algorithms`)
+        snapshots (history.History): where to snapshot the uploaded
+            version, if anywhere
+
+    Returns:
+        the id of the new cloud file
+    """
+    fingerprint = get_fingerprint(local_file_path)
+    with local_file_path.open('rb') as local_file, \
+            metrics.span('upload') as upload_span:
+        reader = HashingReader(local_file, algorithm)
+        metadata = backend.create_file(reader, cloud_folder_id,
+                                       local_file_path.name)
+        upload_span.bytes_count = reader.bytes_hashed
+        data_hash = reader.hexdigest(int(metadata['size'])
+                                     if 'size' in metadata else None)
+    unchanged = get_fingerprint(local_file_path) == fingerprint
+    cache_entries({
+        'file.sha': data_hash, 'remote.json': json.dumps(metadata),
+        'file.stat': fingerprint_entry(fingerprint) if unchanged else None},
+        cache_folder_path)
+    if unchanged and snapshots is not None:
+        snapshots.snapshot(local_file_path, local_file_path,
+                           cache_folder_path, history.uploaded, data_hash)
+    return metadata['id']
+
+
+def download_new_file(local_file_path: Path, cloud_file_id: str,
+                      metadata: dict, cache_folder_path: Path, backend,
+                      chunk_size: int=downloads.default_chunk_size,
+                      max_workers: int=downloads.default_max_workers,
+                      algorithm: str=hashing.default_algorithm,
+                      content_cache=None, snapshots=None)->None:
+    """Download a file that the local folder does not have yet
+
+    Args:
+        local_file_path (Path): where to write the file
+        cloud_file_id (str): id of the cloud file
+        metadata (dict): current metadata of the cloud file
+        cache_folder_path (Path): scope of the cache entries of the file
+        backend (Backend): where the cloud file is
+        chunk_size (int): see `sync_utils.download_next_to`
+        max_workers (int): see `sync_utils.download_next_to`
+        algorithm (str): name of the hash algorithm (see
+            `hashing.algorithms`)
+        content_cache (content_cache.ContentCache): see
+            `sync_utils.download_next_to`
+        snapshots (history.History): see `sync_utils.update_local`
+    """
+    metadata = metadata or backend.get_metadata(cloud_file_id)
+    downloaded_file_path, data_hash = download_next_to(
+        local_file_path, cloud_file_id, backend, metadata,
+        chunk_size=chunk_size, max_workers=max_workers, algorithm=algorithm,
+        content_cache=content_cache)
+    if local_file_path.exists():
+        downloaded_file_path.unlink()
+        raise FileExistsError(f'{local_file_path} was created while '
+                              f'downloading it')
+    update_local(local_file_path, downloaded_file_path, cache_folder_path,
+                 metadata, data_hash, snapshots=snapshots)
+
+
+def summarize(results: dict)->str:
+    """Return the result of a folder sync from the results of its files"""
+    done = set(results.values()) - {up_to_date, skipped}
+    if failed in done:
+        return failed
+    if not done:
+        return up_to_date
+    if len(done) == 1:
+        return done.pop()
+    return uploaded_and_downloaded
+
+
+def sync_folder(local_folder_path: Path, cloud_folder_id: str,
+                cache_folder_path: Path, backend,
+                max_workers: int=default_max_workers,
+                **sync_options)->dict:
+    """Sync the files of a local folder with the ones of a cloud folder
+
+    Args:
+        local_folder_path (Path): the local folder
+        cloud_folder_id (str): id of the cloud folder
+        cache_folder_path (Path): cache folder of the profile
+        backend (Backend): where the cloud folder is
+        max_workers (int): number of files transferred at once
+        **sync_options: keyword arguments of `sync_utils.sync` (e.g.
+            `rehash_every`), used for each file
+
+    Returns:
+        dict giving what was done (see `sync_utils.sync`), `failed` or
+        `skipped`, for each file that may have changed (see `summarize`)
+    """
+    # Imported here to keep the import of the command-line tool fast
+    from concurrent.futures import ThreadPoolExecutor
+
+    algorithm = sync_options.get('hash_algorithm', hashing.default_algorithm)
+    download_options = dict(
+        chunk_size=sync_options.get('download_chunk_size',
+                                    downloads.default_chunk_size),
+        max_workers=sync_options.get('download_workers',
+                                     downloads.default_max_workers),
+        algorithm=algorithm,
+        content_cache=sync_options.get('content_cache'),
+        snapshots=sync_options.get('snapshots'))
+    known_files = json.loads(load_entry_from_cache(
+        'folder.json', cache_folder_path) or '{}')
+    with metrics.span('remote_metadata'):
+        cloud_files = backend.list_folder(cloud_folder_id)
+        unsafe_names = sorted(name for name in cloud_files
+                              if not is_safe_name(name, local_folder_path))
+        for name in unsafe_names:
+            logger.warning(f'Skipping the cloud file {name!r}: it is not a '
+                           f'plain file name')
+            del cloud_files[name]
+        metadata = fetch_metadata(backend, list(cloud_files.values()))
+    local_files = list_local_files(local_folder_path)
+
+    def sync_file(name: str)->str:
+        file_cache_folder_path = file_cache_path(cache_folder_path, name)
+        local_file_path = local_folder_path / name
+        cloud_file_id = cloud_files.get(name)
+        try:
+            if cloud_file_id is None:
+                cloud_files[name] = create_cloud_file(
+                    local_file_path, cloud_folder_id, file_cache_folder_path,
+                    backend, algorithm, sync_options.get('snapshots'))
+                return uploaded
+            if name not in local_files:
+                download_new_file(local_file_path, cloud_file_id,
+                                  metadata.get(cloud_file_id),
+                                  file_cache_folder_path, backend,
+                                  **download_options)
+                return downloaded
+            if known_files.get(name) != cloud_file_id:
+                # Another file took the name: its state is not the cached one
+                cache_entries(dict.fromkeys(
+                    ['file.sha', 'file.stat', 'remote.json']),
+                    file_cache_folder_path)
+            return sync(local_file_path, cloud_file_id,
+                        file_cache_folder_path, backend=backend,
+                        metadata=metadata.get(cloud_file_id), **sync_options)
+        except SystemExit:
+            # The reason was already logged by `log_and_exit`
+            return failed
+        except Exception as error:
+            logger.error(f'Could not sync {local_file_path}: {error!r}')
+            return failed
+
+    # Compute the differing set in one pass, before transferring anything
+    to_sync = sorted(
+        name for name in set(local_files) | set(cloud_files)
+        if name not in local_files or name not in cloud_files
+        or known_files.get(name) != cloud_files[name]
+        or not is_unchanged(local_files[name],
+                            metadata.get(cloud_files[name], {}),
+                            file_cache_path(cache_folder_path, name)))
+    logger.info(f'{len(to_sync)} file(s) of {local_folder_path} to sync')
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = dict(zip(to_sync, executor.map(sync_file, to_sync)))
+    results.update(dict.fromkeys(unsafe_names, skipped))
+
+    # A failed file keeps its state, to be synced again at the next run
+    cache_entries({'folder.json': json.dumps({
+        name: cloud_file_id for name, cloud_file_id in cloud_files.items()
+        if results.get(name) != failed
+        or known_files.get(name) == cloud_file_id})}, cache_folder_path)
+    return results
@@ -0,0 +1,280 @@
+"""Hashing of the synced data
+
+Files and download streams are hashed incrementally, by chunks, so that
+they never have to be held in memory. A `HashCache` memoizes the hashes
+computed during one sync operation so that each buffer/file is hashed at
+most once.
+
+The hash algorithm is configurable (see `algorithms`). The hashes tell
+which algorithm made them: `<algorithm>:<hexadecimal digest>`, except for
+the sha3_512 ones, bare hexadecimal digests as written by the older
+versions.
+"""
+
+import hashlib
+from pathlib import Path
+
+default_chunk_size = 1024 * 1024
+
+# Algorithm of the hashes without prefix, written by the older versions
+legacy_algorithm = 'sha3_512'
+
+# Algorithm used unless configured otherwise (see `config.sync_options`).
+# Hardware-accelerated on most recent cpus (see benchmarks/bench_hash.py).
+default_algorithm = 'sha256'
+
+
+def _xxh3():
+    try:
+        import xxhash
+    except ImportError:
+        raise ValueError('The xxh3 hash algorithm needs the xxhash package: '
+                         'pip install xxhash')
+    return xxhash.xxh3_128()
+
+
+# Constructors of the supported hash algorithms. xxh3 is not cryptographic:
+# it detects changes, but a forged content could go unnoticed.
+algorithms = dict(sha3_512=hashlib.sha3_512, sha256=hashlib.sha256,
+                  blake2b=hashlib.blake2b, xxh3=_xxh3)
+
+
+def algorithm_of(data_hash: str)->str:
+    """Return the name of the algorithm that made a hash
+
+    Args:
+        data_hash (str): hash returned by this module, or by the older
+            versions
+
+    Returns:
+        name of the algorithm (see `algorithms`)
+    """
+    if ':' in data_hash:
+        return data_hash.split(':', 1)[0]
+    return legacy_algorithm
+
+
+class Hasher:
+    """Incremental hasher, whose digests tell the algorithm that made them
+
+    Args:
+        algorithm (str): name of the algorithm (see `algorithms`)
+
+    Raises:
+        ValueError if the algorithm is unknown or unavailable
+    """
+    def __init__(self, algorithm: str=default_algorithm):
+        if algorithm not in algorithms:
+            raise ValueError(f'Unknown hash algorithm {algorithm!r}, '
+                             f'expected one of {", ".join(algorithms)}')
+        self.algorithm = algorithm
+        self._hasher = algorithms[algorithm]()
+
+    def update(self, data)->None:
+        self._hasher.update(data)
+
+    def hexdigest(self)->str:
+        if self.algorithm == legacy_algorithm:
+            return self._hasher.hexdigest()
+        return f'{self.algorithm}:{self._hasher.hexdigest()}'
+
+
+def new_hasher(algorithm: str=default_algorithm)->Hasher:
+    """Return a new incremental hasher
+
+    Args:
+        algorithm (str): name of the algorithm (see `algorithms`)
+
+    Returns:
+        Hasher
+    """
+    return Hasher(algorithm)
+
+
+def hash_data(data, algorithm: str=default_algorithm)->str:
+    """Return the hexadecimal hash of an in-memory buffer
+
+    Args:
+        data (bytes-like): data to hash
+        algorithm (str): name of the algorithm (see `algorithms`)
+
+    Returns:
+        hash
+    """
+    hasher = new_hasher(algorithm)
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def hash_chunks(chunks, algorithm: str=default_algorithm)->str:
+    """Return the hexadecimal hash of a stream of chunks
+
+    Args:
+        chunks (iterable of bytes-like): data to hash, in order
+        algorithm (str): name of the algorithm (see `algorithms`)
+
+    Returns:
+        hash
+    """
+    hasher = new_hasher(algorithm)
+    for chunk in chunks:
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def iter_file_chunks(path: Path, chunk_size: int=default_chunk_size):
+    """Read the file at `path` by chunks
+
+    The same buffer is re-used between chunks: each chunk is only valid
+    until the next one is yielded.
+
+    Args:
+        path (Path): file to read
+        chunk_size (int): size of the chunks, in bytes
+
+    Yields:
+        memoryview over the chunks of the file
+    """
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with path.open('rb') as file:
+        while True:
+            size = file.readinto(buffer)
+            if not size:
+                return
+            yield view[:size]
+
+
+def hash_file(path: Path, chunk_size: int=default_chunk_size,
+              algorithm: str=default_algorithm)->str:
+    """Return the hexadecimal hash of a file, reading it by chunks
+
+    Args:
+        path (Path): file to hash
+        chunk_size (int): size of the chunks, in bytes
+        algorithm (str): name of the algorithm (see `algorithms`)
+
+    Returns:
+        hash
+    """
+    return hash_chunks(iter_file_chunks(path, chunk_size), algorithm)
+
+
+class HashingWriter:
+    """Wrap a writable binary file, hashing what is written through it
+
+    Used to hash a download stream while it is written to disk.
+
+    Args:
+        file_object: writable binary file
+        algorithm (str): name of the hash algorithm (see `algorithms`)
+    """
+    def __init__(self, file_object, algorithm: str=default_algorithm):
+        self._file_object = file_object
+        self._hasher = new_hasher(algorithm)
+        self.bytes_written = 0
+
+    def write(self, data)->int:
+        self._hasher.update(data)
+        self.bytes_written += len(data)
+        return self._file_object.write(data)
+
+    def hexdigest(self)->str:
+        return self._hasher.hexdigest()
+
+
+class HashingReader:
+    """Wrap a readable, seekable binary file, hashing what is read from it
+
+    Used to hash a file while it is uploaded. Uploaders may seek and re-read
+    parts of the file (e.g. to retry a chunk): only the bytes read for the
+    first time, in order, are hashed.
+
+    Args:
+        file_object: readable, seekable binary file
+        algorithm (str): name of the hash algorithm (see `algorithms`)
+    """
+    def __init__(self, file_object, algorithm: str=default_algorithm):
+        self._file_object = file_object
+        self._hasher = new_hasher(algorithm)
+        self.bytes_hashed = 0
+
+    def read(self, size: int=-1)->bytes:
+        position = self._file_object.tell()
+        data = self._file_object.read(size)
+        if position <= self.bytes_hashed < position + len(data):
+            self._hasher.update(
+                memoryview(data)[self.bytes_hashed - position:])
+            self.bytes_hashed = position + len(data)
+        return data
+
+    def seek(self, offset: int, whence: int=0)->int:
+        return self._file_object.seek(offset, whence)
+
+    def tell(self)->int:
+        return self._file_object.tell()
+
+    def hexdigest(self, size: int=None)->str:
+        """Return the hash of the file
+
+        The parts of the file that were not read are read and hashed first.
+
+        Args:
+            size (int): hash only the first `size` bytes of the file.
+                Defaults to the whole file.
+        """
+        self._file_object.seek(self.bytes_hashed)
+        while size is None or self.bytes_hashed < size:
+            if not self.read(default_chunk_size if size is None
+                             else min(default_chunk_size,
+                                      size - self.bytes_hashed)):
+                break
+        return self._hasher.hexdigest()
+
+
+class HashCache:
+    """Memoize the hashes computed during one operation
+
+    Buffers are identified by identity: they should not be modified while
+    the cache is in use. Files are identified by path and stat-fingerprint.
+
+    Args:
+        algorithm (str): name of the hash algorithm (see `algorithms`)
+    """
+    def __init__(self, algorithm: str=default_algorithm):
+        self.algorithm = algorithm
+        self._data_hashes = {}
+        self._file_hashes = {}
+
+    def of_data(self, data)->str:
+        """Return the hash of an in-memory buffer
+
+        Args:
+            data (bytes-like): data to hash
+
+        Returns:
+            hash
+        """
+        # The buffer is kept in the entry so that its id is not re-used
+        entry = self._data_hashes.get(id(data))
+        if entry is None or entry[0] is not data:
+            entry = self._data_hashes[id(data)] = (
+                data, hash_data(data, self.algorithm))
+        return entry[1]
+
+    def of_file(self, path: Path, fingerprint: dict=None)->str:
+        """Return the hash of a file, reading it by chunks
+
+        Args:
+            path (Path): file to hash
+            fingerprint (dict): stat-fingerprint of the file, to tell
+                different versions of it apart
+
+        Returns:
+            hash
+        """
+        key = (str(path), tuple(sorted((fingerprint or {}).items())))
+        if key not in self._file_hashes:
+            self._file_hashes[key] = hash_file(path,
+                                               algorithm=self.algorithm)
+        return self._file_hashes[key]
@@ -0,0 +1,197 @@
+"""Snapshots of the synced versions, to recover from conflicts
+
+Once enabled (`history_keep`, see `config.sync_options`), every version met
+by a sync is kept:
+
+* the content uploaded (see `sync_utils.update_cloud`)
+* the content downloaded, and the local content it replaced (see
+  `sync_utils.update_local`)
+* both sides of a conflict
+
+so that a version discarded by e.g. a `force-update` can be restored (see
+`History.restore`).
+
+The contents are kept in the content cache (see
+`keypass_sync.content_cache`), named after their hash: snapshotting a
+version already kept, e.g. just uploaded, only adds a line to the index in
+the state store (see `keypass_sync.state`). The contents that a snapshot
+refers to are not evicted from the cache. They are copies, not hard links:
+writing to the local file in place must not alter them.
+
+The retention policy keeps the `keep` most recent snapshots of each file,
+and drops those older than `max_age_days`, but for the most recent one. The
+contents that no snapshot refers to any more are left to the eviction of
+the content cache. The snapshots of a file thus take up to `keep` times
+its size on the disk.
+"""
+
+import time
+from pathlib import Path
+
+from keypass_sync import hashing
+from keypass_sync.utilities import logger, log_and_exit
+
+# How the snapshotted versions were met
+uploaded, downloaded, replaced, local_conflict, cloud_conflict = \
+    'uploaded', 'downloaded', 'replaced', 'conflict, local', \
+    'conflict, cloud'
+
+# Default number of snapshots kept per file
+default_keep = 10
+
+# Default maximum age of the snapshots, in days (0 keeps them whatever
+# their age)
+default_max_age_days = 0
+
+
+class History:
+    """Snapshots of the synced versions of every profile
+
+    Args:
+        contents (content_cache.ContentCache): where the contents are kept.
+            Its state store holds the index of the snapshots.
+        keep (int): number of snapshots kept per file
+        max_age_days (float): age beyond which the snapshots are removed,
+            in days. 0 keeps them whatever their age.
+    """
+    def __init__(self, contents, keep: int=default_keep,
+                 max_age_days: float=default_max_age_days):
+        self.contents = contents
+        self.store = contents.store
+        self.keep = keep
+        self.max_age_days = max_age_days
+
+    def snapshot(self, path: Path, local_file_path: Path,
+                 cache_folder_path: Path, origin: str,
+                 data_hash: str=None,
+                 algorithm: str=hashing.default_algorithm):
+        """Keep a version of a synced file
+
+        Nothing is recorded if it is the version of the last snapshot.
+
+        Args:
+            path (Path): file holding the version, e.g. `local_file_path`
+                or a download about to replace it
+            local_file_path (Path): the synced local file
+            cache_folder_path (Path): cache folder of the synced file
+            origin (str): how the version was met, e.g. `uploaded`
+            data_hash (str): hash of the version, if known. It is not read
+                again if its content is already kept.
+            algorithm (str): name of the hash algorithm, if `data_hash` is
+                not given (see `hashing.algorithms`)
+
+        Returns:
+            the id of the new snapshot, or None
+        """
+        if data_hash is not None:
+            algorithm = hashing.algorithm_of(data_hash)
+        if data_hash is None \
+                or not self.contents.path_of(data_hash).exists():
+            data_hash = self.contents.store_file(path, algorithm)
+        snapshots = self.store.snapshots(cache_folder_path)
+        if snapshots and snapshots[0]['hash'] == data_hash \
+                and snapshots[0]['path'] == str(local_file_path):
+            return None
+        snapshot_id = self._record(cache_folder_path, local_file_path,
+                                   data_hash, origin)
+        if snapshot_id is None:
+            # Evicted from the content cache before being pinned
+            data_hash = self.contents.store_file(path, algorithm)
+            snapshot_id = self._record(cache_folder_path, local_file_path,
+                                       data_hash, origin)
+        if snapshot_id is None:
+            raise FileNotFoundError(f'Could not keep the content of {path}')
+        logger.debug(f'Snapshot {snapshot_id} ({origin}) of '
+                     f'{local_file_path}: {data_hash}')
+        self.apply_retention(cache_folder_path)
+        return snapshot_id
+
+    def _record(self, cache_folder_path: Path, local_file_path: Path,
+                data_hash: str, origin: str):
+        """Index a snapshot, pinning its content in the content cache
+
+        Returns:
+            the id of the snapshot, or None if the content was evicted
+        """
+        # The cache evicts its contents in a transaction too (see
+        # `ContentCache.discard`): once indexed, the content stays
+        with self.store.transaction():
+            try:
+                size = self.contents.path_of(data_hash).stat().st_size
+            except FileNotFoundError:
+                return None
+            self.store.put_content(data_hash, size)
+            return self.store.put_snapshot(cache_folder_path,
+                                           local_file_path, data_hash, size,
+                                           origin)
+
+    def apply_retention(self, cache_folder_path: Path)->list:
+        """Remove the snapshots of a cache folder beyond the retention policy
+
+        Their contents are left to the eviction of the content cache.
+
+        Returns:
+            the ids of the removed snapshots
+        """
+        snapshots = self.store.snapshots(cache_folder_path)
+        oldest_ns = time.time_ns() - int(self.max_age_days * 86400 * 10**9)
+        expired = [snapshot['id'] for position, snapshot
+                   in enumerate(snapshots)
+                   if position >= self.keep or (
+                       position and self.max_age_days
+                       and snapshot['taken_ns'] < oldest_ns)]
+        if not expired:
+            return expired
+        self.store.delete_snapshots(expired)
+        logger.debug(f'Removed {len(expired)} snapshot(s)')
+        self.contents.evict()
+        return expired
+
+    def snapshots(self, cache_folder_path: Path)->list:
+        """Return the snapshots of a profile, most recent first
+
+        Those of every file of a folder profile are included.
+
+        Returns:
+            see `state.StateStore.snapshots`
+        """
+        return self.store.snapshots(cache_folder_path, nested=True)
+
+    def restore(self, snapshot_id: int, cache_folder_path: Path)->dict:
+        """Replace a local file with one of its snapshotted versions
+
+        The replaced content is snapshotted first, unless the snapshots are
+        disabled (`keep` is 0). The restored version is
+        then a local change like any other: it is uploaded by the next
+        sync, or reported as a conflict if the cloud file changed too.
+
+        Args:
+            snapshot_id (int): id of the snapshot to restore
+            cache_folder_path (Path): cache folder of the profile
+
+        Returns:
+            the restored snapshot (see `state.StateStore.snapshots`)
+        """
+        # Imported here, the sync_utils module depending on this one
+        from keypass_sync.sync_utils import replace_local_file
+
+        snapshot = next((snapshot for snapshot
+                         in self.snapshots(cache_folder_path)
+                         if snapshot['id'] == snapshot_id), None)
+        if snapshot is None:
+            log_and_exit(f'No snapshot {snapshot_id} for {cache_folder_path}: '
+                         f'see the `history` command')
+        local_file_path = Path(snapshot['path'])
+        copied = self.contents.copy_next_to(
+            snapshot['hash'], local_file_path,
+            hashing.algorithm_of(snapshot['hash']))
+        if copied is None:
+            log_and_exit(f'The content of snapshot {snapshot_id} is missing '
+                         f'or corrupted')
+        if self.keep and local_file_path.exists():
+            self.snapshot(local_file_path, local_file_path,
+                          snapshot['scope'], replaced,
+                          algorithm=hashing.algorithm_of(snapshot['hash']))
+        replace_local_file(local_file_path, copied[0])
+        logger.info(f'Restored snapshot {snapshot_id} to {local_file_path}')
+        return snapshot
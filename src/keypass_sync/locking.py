@@ -0,0 +1,228 @@
+"""Cross-process lock of the profiles, with single-flight syncs
+
+Only one process (or thread) at a time may sync or force-update a profile:
+each operation holds an exclusive `flock` on the `.lock` file of the cache
+folder of the profile (see `single_flight`). Another invocation either
+waits for it, or gives up at once without any I/O (`already_running`).
+
+An invocation that waited for an operation of the same kind (e.g. a cron
+sync overlapping a slow previous one) does not run it again: it returns
+the result of the operation it waited for, provided that result still
+holds (e.g. the local file was not saved again after the sync read it).
+That result is written in the lock file before the lock is released, along
+with who held it.
+
+A `flock` is released by the system when its holder dies, but a child
+process inheriting the file descriptor keeps it. A lock whose holder
+process is dead, without having finished its operation, is then stale:
+the lock file is removed, and a new one is locked instead. The removal is
+made under the lock of a guard file, so that two invocations replacing the
+same stale lock can not remove the new lock file of the other one.
+
+The time spent waiting is recorded in the `lock_wait` span (see
+`keypass_sync.metrics`).
+"""
+
+import json
+import os
+import socket
+import time
+from pathlib import Path
+
+from keypass_sync import metrics, state
+from keypass_sync.utilities import logger
+
+# Result of an operation given up because another one holds the lock
+already_running = 'already running'
+
+# Time between two attempts to take a held lock, in seconds
+default_poll_interval = .1
+
+
+def lock_path(cache_folder_path: Path)->Path:
+    """Return the lock file of a profile"""
+    return Path(state.scope_of(cache_folder_path)) / '.lock'
+
+
+def _read_state(file_descriptor: int)->dict:
+    """Return the content of a lock file, or {} if it is not readable"""
+    data = b''
+    while True:
+        chunk = os.pread(file_descriptor, 4096, len(data))
+        if not chunk:
+            break
+        data += chunk
+    try:
+        lock_state = json.loads(data.decode())
+    except (UnicodeDecodeError, ValueError):
+        return {}
+    return lock_state if isinstance(lock_state, dict) else {}
+
+
+def _write_state(file_descriptor: int, lock_state: dict)->None:
+    data = json.dumps(lock_state).encode()
+    os.ftruncate(file_descriptor, 0)
+    os.pwrite(file_descriptor, data, 0)
+
+
+def is_stale(lock_state: dict)->bool:
+    """Check if the process holding a lock is dead
+
+    Only the processes of this machine can be checked. The state of a
+    finished operation is never stale: the lock is held by the next one,
+    which did not write its own state yet.
+
+    Args:
+        lock_state (dict): content of the lock file
+    """
+    if lock_state.get('host') != socket.gethostname() \
+            or not isinstance(lock_state.get('pid'), int) \
+            or 'finished_ns' in lock_state:
+        return False
+    try:
+        os.kill(lock_state['pid'], 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        # Alive, run by another user
+        return False
+    return False
+
+
+def _is_current(file_descriptor: int, path: Path)->bool:
+    """Check if the opened lock file is still the one at `path`"""
+    try:
+        path_stat = path.stat()
+    except FileNotFoundError:
+        return False
+    file_stat = os.fstat(file_descriptor)
+    return (path_stat.st_dev, path_stat.st_ino) \
+        == (file_stat.st_dev, file_stat.st_ino)
+
+
+def _remove_if_current(file_descriptor: int, path: Path)->bool:
+    """Remove the lock file at `path` if it is still the opened one
+
+    The check and the removal are made under the lock of a guard file:
+    once another invocation replaced the file, it is not removed.
+
+    Returns:
+        true if the file was removed
+    """
+    # Imported here, as it is not available on every platform
+    import fcntl
+
+    guard_descriptor = os.open(str(path.with_name(path.name + '.guard')),
+                               os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(guard_descriptor, fcntl.LOCK_EX)
+        if not _is_current(file_descriptor, path):
+            return False
+        path.unlink()
+        return True
+    finally:
+        # Releases the lock of the guard file
+        os.close(guard_descriptor)
+
+
+def single_flight(cache_folder_path: Path, operation: str, run,
+                  wait: bool=True, share: bool=True, unshared: tuple=(),
+                  poll_interval: float=default_poll_interval,
+                  timeout: float=None, is_current=None):
+    """Run an operation on a profile, holding the lock of the profile
+
+    Args:
+        cache_folder_path (Path): cache folder of the profile
+        operation (str): kind of operation, e.g. `sync`
+        run: runs the operation, and returns its result (str)
+        wait (bool): whether to wait for the lock if it is held. Otherwise
+            `already_running` is returned at once.
+        share (bool): whether the result of an operation of the same kind,
+            that finished while waiting for it, may be returned instead of
+            running `run`
+        unshared (tuple): results that are not shared (e.g. failures, which
+            the waiting operation may not meet)
+        poll_interval (float): time between two attempts to take the lock,
+            in seconds
+        timeout (float): maximum time to wait for the lock, in seconds.
+            Defaults to no limit.
+        is_current: tells (bool) if the result of the operation waited for
+            still holds once it finished, e.g. if the local file was not
+            saved since it was synced. Otherwise `run` is run. Defaults to
+            always sharing it.
+
+    Returns:
+        the result of `run`, of the operation waited for, or
+        `already_running`
+    """
+    try:
+        # Imported here, as it is not available on every platform
+        import fcntl
+    except ImportError:
+        logger.warning('File locks are not supported: running unlocked')
+        return run()
+
+    path = lock_path(cache_folder_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    waiting_since_ns = time.time_ns()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with metrics.span('lock_wait'):
+        while True:
+            file_descriptor = os.open(str(path), os.O_RDWR | os.O_CREAT,
+                                      0o600)
+            try:
+                fcntl.flock(file_descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                holder = _read_state(file_descriptor)
+                stale = is_stale(holder)
+                if stale and _remove_if_current(file_descriptor, path):
+                    logger.warning(f'Replaced the stale lock {path} of '
+                                   f'dead process {holder["pid"]}')
+                os.close(file_descriptor)
+                if stale:
+                    # Possibly already replaced by another invocation
+                    continue
+                if not wait or (deadline is not None
+                                and time.monotonic() >= deadline):
+                    logger.info(f'{holder.get("operation", "An operation")} '
+                                f'of process {holder.get("pid")} is already '
+                                f'running for {cache_folder_path}')
+                    return already_running
+                time.sleep(poll_interval)
+                continue
+            if _is_current(file_descriptor, path):
+                break
+            # Replaced while taking it
+            os.close(file_descriptor)
+    waited = (time.time_ns() - waiting_since_ns) / 10**9
+
+    try:
+        previous = _read_state(file_descriptor)
+        # Written at once: the state of the previous holder, whose process
+        # may be dead, must not be taken for the state of this one
+        lock_state = dict(pid=os.getpid(), host=socket.gethostname(),
+                          operation=operation, started_ns=time.time_ns())
+        _write_state(file_descriptor, lock_state)
+        if share and previous.get('operation') == operation \
+                and previous.get('finished_ns', 0) >= waiting_since_ns \
+                and previous.get('result') is not None \
+                and previous['result'] not in unshared \
+                and (is_current is None or is_current()):
+            logger.info(f'Waited {waited:.1f}s for the {operation} of process '
+                        f'{previous.get("pid")}: {previous["result"]}')
+            # Shared with the other invocations that waited for it
+            _write_state(file_descriptor, previous)
+            return previous['result']
+        if waited >= poll_interval:
+            logger.info(f'Waited {waited:.1f}s for the lock of '
+                        f'{cache_folder_path}')
+        result = None
+        try:
+            result = run()
+            return result
+        finally:
+            _write_state(file_descriptor, dict(
+                lock_state, finished_ns=time.time_ns(), result=result))
+    finally:
+        fcntl.flock(file_descriptor, fcntl.LOCK_UN)
+        os.close(file_descriptor)
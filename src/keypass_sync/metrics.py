@@ -0,0 +1,174 @@
+"""Timing instrumentation of the sync operations
+
+The phases of a sync (config load, lock wait, credential setup, remote
+metadata, download, hashing, upload, local write) are wrapped in `span`s.
+The spans are collected by the `Recorder` active in the current thread, if
+any, and exported once the operation is over:
+
+* as a json line appended to a log file
+* as a node_exporter textfile
+  (https://github.com/prometheus/node_exporter#textfile-collector)
+
+Without an active recorder, spans cost next to nothing.
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+_current_recorder = contextvars.ContextVar('keypass_sync_recorder',
+                                           default=None)
+
+
+class Span:
+    """A timed phase of an operation
+
+    Args:
+        name (str): name of the phase
+        bytes_count (int): number of bytes processed during the phase, if
+            known. May be set while the phase runs.
+    """
+    def __init__(self, name: str, bytes_count: int=None):
+        self.name = name
+        self.bytes_count = bytes_count
+        self.duration = None
+
+
+@contextlib.contextmanager
+def span(name: str, bytes_count: int=None):
+    """Time the enclosed code as the phase `name`
+
+    Args:
+        name (str): name of the phase
+        bytes_count (int): number of bytes processed during the phase, if
+            known beforehand
+
+    Yields:
+        Span, whose `bytes_count` may be set by the enclosed code
+    """
+    recorder = _current_recorder.get()
+    current_span = Span(name, bytes_count)
+    start = time.perf_counter()
+    try:
+        yield current_span
+    finally:
+        current_span.duration = time.perf_counter() - start
+        if recorder is not None:
+            recorder.spans.append(current_span)
+
+
+class Recorder:
+    """Collect the spans of one operation (context manager)
+
+    Args:
+        **labels: labels identifying the operation, e.g. `version`
+    """
+    def __init__(self, **labels):
+        self.labels = labels
+        self.spans = []
+        self.result = None
+        self.timestamp = None
+        self.duration = None
+        self._start = None
+        self._token = None
+
+    def __enter__(self):
+        self.timestamp = time.time()
+        self._start = time.perf_counter()
+        self._token = _current_recorder.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration = time.perf_counter() - self._start
+        _current_recorder.reset(self._token)
+
+    def totals(self)->dict:
+        """Sum the durations and bytes of the spans, by phase
+
+        Returns:
+            dict giving {'duration': float, 'bytes': int, 'count': int} for
+            each phase
+        """
+        totals = {}
+        for recorded_span in self.spans:
+            total = totals.setdefault(recorded_span.name,
+                                      dict(duration=0., bytes=0, count=0))
+            total['duration'] += recorded_span.duration
+            total['bytes'] += recorded_span.bytes_count or 0
+            total['count'] += 1
+        return totals
+
+    def to_dict(self)->dict:
+        return dict(self.labels, result=self.result,
+                    timestamp=self.timestamp, duration=self.duration,
+                    spans=[dict(name=recorded_span.name,
+                                duration=recorded_span.duration,
+                                bytes=recorded_span.bytes_count)
+                           for recorded_span in self.spans])
+
+    def write_json_line(self, path: Path)->None:
+        """Append the operation as one json line to `path`"""
+        with Path(path).expanduser().open('a') as log_file:
+            log_file.write(json.dumps(self.to_dict()) + '\n')
+
+    def write_textfile(self, path: Path, success: bool)->None:
+        """Write the operation into a node_exporter textfile
+
+        The file is replaced atomically, as the collector may read it at any
+        time.
+
+        Args:
+            path (Path): the textfile, its name should end with `.prom`
+            success (bool): whether the operation succeeded
+        """
+        path = Path(path).expanduser()
+        labels = ','.join(f'{key}="{value}"'
+                          for key, value in sorted(self.labels.items()))
+        lines = [
+            '# HELP keypass_sync_last_run_timestamp_seconds Start of the '
+            'last sync.',
+            '# TYPE keypass_sync_last_run_timestamp_seconds gauge',
+            f'keypass_sync_last_run_timestamp_seconds{{{labels}}} '
+            f'{self.timestamp}',
+            '# HELP keypass_sync_last_run_duration_seconds Duration of the '
+            'last sync.',
+            '# TYPE keypass_sync_last_run_duration_seconds gauge',
+            f'keypass_sync_last_run_duration_seconds{{{labels}}} '
+            f'{self.duration}',
+            '# HELP keypass_sync_last_run_success Whether the last sync '
+            'succeeded.',
+            '# TYPE keypass_sync_last_run_success gauge',
+            f'keypass_sync_last_run_success{{{labels}}} {int(success)}',
+            '# HELP keypass_sync_phase_duration_seconds Time spent in each '
+            'phase of the last sync.',
+            '# TYPE keypass_sync_phase_duration_seconds gauge']
+        totals = self.totals()
+        for name, total in sorted(totals.items()):
+            lines.append(f'keypass_sync_phase_duration_seconds{{{labels},'
+                         f'phase="{name}"}} {total["duration"]}')
+        lines += [
+            '# HELP keypass_sync_phase_bytes Bytes processed in each phase '
+            'of the last sync.',
+            '# TYPE keypass_sync_phase_bytes gauge']
+        for name, total in sorted(totals.items()):
+            lines.append(f'keypass_sync_phase_bytes{{{labels},'
+                         f'phase="{name}"}} {total["bytes"]}')
+        lines += [
+            '# HELP keypass_sync_phase_count Number of times each phase ran '
+            'during the last sync (e.g. retries).',
+            '# TYPE keypass_sync_phase_count gauge']
+        for name, total in sorted(totals.items()):
+            lines.append(f'keypass_sync_phase_count{{{labels},'
+                         f'phase="{name}"}} {total["count"]}')
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        file_descriptor, tmp_path = tempfile.mkstemp(
+            prefix=f'.{path.name}.', dir=str(path.parent))
+        with os.fdopen(file_descriptor, 'w') as textfile:
+            textfile.write('\n'.join(lines) + '\n')
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, str(path))
@@ -0,0 +1,477 @@
+"""Persistent state of the sync operations, in one SQLite database
+
+The database holds:
+
+* the configs, by version (see `keypass_sync.config`)
+* the cache entries of each profile (hash of the last synced content,
+  metadata of the cloud file, stat-fingerprint of the local file, ...),
+  by cache folder (see `keypass_sync.sync_utils`)
+* the position of each profile in the changes feed of its cloud account
+  (see `keypass_sync.changes`)
+* the index of the local content cache: size and last use of each cached
+  content, and the revisions of the cloud files holding them (see
+  `keypass_sync.content_cache`)
+* the snapshots of the synced versions of each cache folder, referring to
+  contents of the content cache (see `keypass_sync.history`)
+
+Related entries are updated in one transaction, so that a crash never
+leaves e.g. a new hash next to the fingerprint of the old content. The
+database is in WAL mode: a sync may read it while another process (e.g. the
+`watch` daemon) writes to it.
+
+Older versions kept those in files: one json file per config version in the
+config folder, and one file per cache entry in the cache folders. They are
+imported the first time the store is used (see `StateStore.import_configs`
+and `StateStore.entries`). The files are left in place.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+schema_version = 1
+
+# Cache entries written as files by the older versions
+legacy_entries = ('file.sha', 'remote.json', 'file.stat')
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS configs (
+    version TEXT PRIMARY KEY,
+    cloud_file_id TEXT,
+    config TEXT NOT NULL,
+    updated_ns INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS configs_cloud_file_id ON configs (cloud_file_id);
+CREATE TABLE IF NOT EXISTS entries (
+    scope TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    updated_ns INTEGER NOT NULL,
+    PRIMARY KEY (scope, name));
+CREATE TABLE IF NOT EXISTS page_tokens (
+    account TEXT PRIMARY KEY,
+    page_token TEXT NOT NULL,
+    updated_ns INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS contents (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_used_ns INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS contents_last_used ON contents (last_used_ns);
+CREATE TABLE IF NOT EXISTS revisions (
+    file_id TEXT NOT NULL,
+    revision TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (file_id, revision));
+CREATE INDEX IF NOT EXISTS revisions_hash ON revisions (hash);
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    scope TEXT NOT NULL,
+    path TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    origin TEXT NOT NULL,
+    taken_ns INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS snapshots_scope ON snapshots (scope, taken_ns);
+CREATE INDEX IF NOT EXISTS snapshots_hash ON snapshots (hash)
+'''
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(path: Path)->'StateStore':
+    """Return the store kept in the database at `path`
+
+    The store is shared by every caller (and thread) of the process.
+
+    Args:
+        path (Path): the database file. Its folder is created if needed.
+
+    Returns:
+        StateStore
+    """
+    path = Path(path).expanduser().absolute()
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = StateStore(path)
+        return _stores[path]
+
+
+def scope_of(cache_folder_path: Path)->str:
+    """Key under which the entries of a cache folder are stored"""
+    return str(Path(cache_folder_path).expanduser().resolve())
+
+
+class StateStore:
+    """Configs and cache entries, in a SQLite database
+
+    Each thread uses its own connection.
+
+    Args:
+        path (Path): the database file
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._local = threading.local()
+        self._configs_imported = False
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.transaction() as connection:
+            for statement in _schema.split(';'):
+                connection.execute(statement)
+            connection.execute(
+                'INSERT OR IGNORE INTO meta VALUES (?, ?)',
+                ('schema_version', str(schema_version)))
+
+    @property
+    def _connection(self)->sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Transactions are handled by `transaction`
+            connection = sqlite3.connect(str(self.path), timeout=30.,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def transaction(self)->'_Transaction':
+        """Group reads and writes (context manager)
+
+        The transaction is committed when the block exits normally, and
+        rolled back if it raises.
+
+        Returns:
+            context manager giving the `sqlite3.Connection` of the thread
+        """
+        return _Transaction(self._connection)
+
+    # Configs
+
+    def get_config(self, version: str):
+        """Return the saved config of a version, or None"""
+        row = self._connection.execute(
+            'SELECT config FROM configs WHERE version = ?',
+            (version,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put_config(self, version: str, config: dict)->dict:
+        """Save the config of a version, replacing the previous one"""
+        with self.transaction() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO configs VALUES (?, ?, ?, ?)',
+                (version, config.get('cloud_file_id'), json.dumps(config),
+                 time.time_ns()))
+        return config
+
+    def versions(self)->list:
+        """Return the sorted names of the saved versions"""
+        return [row[0] for row in self._connection.execute(
+            'SELECT version FROM configs ORDER BY version')]
+
+    def versions_of(self, cloud_file_id: str)->list:
+        """Return the sorted versions syncing the cloud file `cloud_file_id`
+        """
+        return [row[0] for row in self._connection.execute(
+            'SELECT version FROM configs WHERE cloud_file_id = ? '
+            'ORDER BY version', (cloud_file_id,))]
+
+    def import_configs(self, config_folder_path: Path)->list:
+        """Import the json config files written by the older versions
+
+        Only done once per database: configs should then be saved with
+        `put_config`. Configs already in the database are not replaced.
+
+        Args:
+            config_folder_path (Path): folder containing one json file per
+                version
+
+        Returns:
+            the imported versions
+        """
+        imported = []
+        if self._configs_imported:
+            return imported
+        config_folder_path = Path(config_folder_path)
+        with self.transaction() as connection:
+            if connection.execute(
+                    "SELECT 1 FROM meta WHERE key = 'configs_imported'"
+            ).fetchone() is not None:
+                self._configs_imported = True
+                return imported
+            candidates = sorted(config_folder_path.iterdir()) \
+                if config_folder_path.is_dir() else []
+            for path in candidates:
+                if not path.is_file() or path.name.startswith('.'):
+                    continue
+                try:
+                    config = json.loads(path.read_text())
+                except (ValueError, UnicodeDecodeError):
+                    continue
+                if not isinstance(config, dict):
+                    continue
+                cursor = connection.execute(
+                    'INSERT OR IGNORE INTO configs VALUES (?, ?, ?, ?)',
+                    (path.name, config.get('cloud_file_id'),
+                     json.dumps(config), time.time_ns()))
+                if cursor.rowcount:
+                    imported.append(path.name)
+            connection.execute(
+                "INSERT INTO meta VALUES ('configs_imported', ?)",
+                (str(time.time_ns()),))
+        self._configs_imported = True
+        return imported
+
+    # Changes feed
+
+    def get_page_token(self, account: str):
+        """Return a saved changes-feed position, or None
+
+        Args:
+            account (str): key of the position (see
+                `changes.position_key`)
+        """
+        row = self._connection.execute(
+            'SELECT page_token FROM page_tokens WHERE account = ?',
+            (account,)).fetchone()
+        return None if row is None else row[0]
+
+    def put_page_token(self, account: str, page_token: str)->str:
+        """Save a changes-feed position (see `get_page_token`)"""
+        with self.transaction() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO page_tokens VALUES (?, ?, ?)',
+                (account, page_token, time.time_ns()))
+        return page_token
+
+    # Content cache
+
+    def get_revision(self, file_id: str, revision: str):
+        """Return the hash of a cached revision of a cloud file, or None"""
+        row = self._connection.execute(
+            'SELECT hash FROM revisions WHERE file_id = ? AND revision = ?',
+            (file_id, revision)).fetchone()
+        return None if row is None else row[0]
+
+    def put_content(self, data_hash: str, size: int, file_id: str=None,
+                    revision: str=None)->None:
+        """Index a cached content, as used now
+
+        Args:
+            data_hash (str): hash of the content
+            size (int): size of the content, in bytes
+            file_id (str): id of a cloud file holding the content, if any
+            revision (str): revision of that cloud file
+        """
+        with self.transaction() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO contents VALUES (?, ?, ?)',
+                (data_hash, size, time.time_ns()))
+            if file_id is not None and revision is not None:
+                connection.execute(
+                    'INSERT OR REPLACE INTO revisions VALUES (?, ?, ?)',
+                    (file_id, revision, data_hash))
+
+    def touch_content(self, data_hash: str)->bool:
+        """Mark a cached content as used now
+
+        Returns:
+            true if the content is indexed
+        """
+        with self.transaction() as connection:
+            return connection.execute(
+                'UPDATE contents SET last_used_ns = ? WHERE hash = ?',
+                (time.time_ns(), data_hash)).rowcount > 0
+
+    def contents(self)->list:
+        """Return the (hash, size) of the cached contents that no snapshot
+        refers to, least recently used first"""
+        return list(self._connection.execute(
+            'SELECT hash, size FROM contents WHERE hash NOT IN '
+            '(SELECT hash FROM snapshots) ORDER BY last_used_ns'))
+
+    def delete_contents(self, data_hashes: list,
+                        snapshotted: bool=True)->list:
+        """Remove cached contents, and their revisions, from the index
+
+        Args:
+            data_hashes (list): hashes of the contents
+            snapshotted (bool): whether to remove the contents that
+                snapshots refer to
+
+        Returns:
+            the hashes of the removed contents
+        """
+        deleted = []
+        with self.transaction() as connection:
+            for data_hash in data_hashes:
+                if not snapshotted and connection.execute(
+                        'SELECT 1 FROM snapshots WHERE hash = ? LIMIT 1',
+                        (data_hash,)).fetchone():
+                    continue
+                connection.execute('DELETE FROM contents WHERE hash = ?',
+                                   (data_hash,))
+                connection.execute('DELETE FROM revisions WHERE hash = ?',
+                                   (data_hash,))
+                deleted.append(data_hash)
+        return deleted
+
+    # Snapshots
+
+    _snapshot_columns = ('id', 'scope', 'path', 'hash', 'size', 'origin',
+                         'taken_ns')
+
+    def put_snapshot(self, cache_folder_path: Path, path: Path,
+                     data_hash: str, size: int, origin: str)->int:
+        """Record a snapshot of a synced version
+
+        Args:
+            cache_folder_path (Path): cache folder of the synced file
+            path (Path): the synced local file
+            data_hash (str): hash of the snapshotted content
+            size (int): size of the content, in bytes
+            origin (str): how the version was met (see `history`)
+
+        Returns:
+            the id of the snapshot
+        """
+        with self.transaction() as connection:
+            return connection.execute(
+                'INSERT INTO snapshots (scope, path, hash, size, origin, '
+                'taken_ns) VALUES (?, ?, ?, ?, ?, ?)',
+                (scope_of(cache_folder_path), str(path), data_hash, size,
+                 origin, time.time_ns())).lastrowid
+
+    def get_snapshot(self, snapshot_id: int):
+        """Return a snapshot (dict), or None"""
+        row = self._connection.execute(
+            f'SELECT {", ".join(self._snapshot_columns)} FROM snapshots '
+            f'WHERE id = ?', (snapshot_id,)).fetchone()
+        return None if row is None else dict(zip(self._snapshot_columns, row))
+
+    def snapshots(self, cache_folder_path: Path,
+                  nested: bool=False)->list:
+        """Return the snapshots of a cache folder, most recent first
+
+        Args:
+            cache_folder_path (Path):
+            nested (bool): whether to include the snapshots of the cache
+                folders inside it (e.g. of the files of a folder profile)
+
+        Returns:
+            list of dicts with the `id`, `scope`, `path`, `hash`, `size`,
+            `origin` and `taken_ns` of each snapshot
+        """
+        scope = scope_of(cache_folder_path)
+        condition = 'scope = ?'
+        parameters = (scope,)
+        if nested:
+            condition += ' OR substr(scope, 1, ?) = ?'
+            parameters += (len(scope) + 1, scope + '/')
+        return [dict(zip(self._snapshot_columns, row))
+                for row in self._connection.execute(
+                    f'SELECT {", ".join(self._snapshot_columns)} '
+                    f'FROM snapshots WHERE {condition} '
+                    f'ORDER BY taken_ns DESC, id DESC', parameters)]
+
+    def delete_snapshots(self, snapshot_ids: list)->None:
+        """Remove snapshots from the index"""
+        with self.transaction() as connection:
+            connection.executemany('DELETE FROM snapshots WHERE id = ?',
+                                   [(snapshot_id,)
+                                    for snapshot_id in snapshot_ids])
+
+    # Cache entries
+
+    def entries(self, cache_folder_path: Path)->dict:
+        """Return every cache entry of a cache folder
+
+        The first time a cache folder is seen, the entry files written by
+        the older versions in it are imported.
+
+        Args:
+            cache_folder_path (Path):
+
+        Returns:
+            dict giving the value (str) of each entry, by name
+        """
+        scope = scope_of(cache_folder_path)
+        values = dict(self._connection.execute(
+            'SELECT name, value FROM entries WHERE scope = ?', (scope,)))
+        if values:
+            return values
+        legacy_values = {}
+        for name in legacy_entries:
+            try:
+                legacy_values[name] = (Path(scope) / name).read_text()
+            except OSError:
+                pass
+        if legacy_values:
+            with self.transaction() as connection:
+                # Another thread may have written entries in the meantime
+                if connection.execute(
+                        'SELECT 1 FROM entries WHERE scope = ?',
+                        (scope,)).fetchone() is None:
+                    self._put_entries(connection, scope, legacy_values)
+            return self.entries(cache_folder_path)
+        return values
+
+    def get_entry(self, cache_folder_path: Path, name: str):
+        """Return the value of a cache entry, or None"""
+        return self.entries(cache_folder_path).get(name)
+
+    def put_entries(self, cache_folder_path: Path, values: dict)->dict:
+        """Set several cache entries of a cache folder in one transaction
+
+        Args:
+            cache_folder_path (Path):
+            values (dict): value (str) of each entry to set, by name. None
+                deletes the entry.
+
+        Returns:
+            the values
+        """
+        with self.transaction() as connection:
+            self._put_entries(connection, scope_of(cache_folder_path), values)
+        return values
+
+    @staticmethod
+    def _put_entries(connection: sqlite3.Connection, scope: str,
+                     values: dict)->None:
+        now = time.time_ns()
+        for name, value in values.items():
+            if value is None:
+                connection.execute(
+                    'DELETE FROM entries WHERE scope = ? AND name = ?',
+                    (scope, name))
+            else:
+                connection.execute(
+                    'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                    (scope, name, value, now))
+
+
+class _Transaction:
+    """See `StateStore.transaction`
+
+    Nested transactions join the outer one.
+    """
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        self._outermost = False
+
+    def __enter__(self)->sqlite3.Connection:
+        if not self.connection.in_transaction:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self._outermost = True
+        return self.connection
+
+    def __exit__(self, error_type, *_):
+        if not self._outermost:
+            return
+        if error_type is None:
+            self.connection.execute('COMMIT')
+        else:
+            self.connection.execute('ROLLBACK')
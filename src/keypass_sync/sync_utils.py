@@ -2,42 +2,66 @@
 
 """
 
-import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
 from pathlib import Path
 
-from google_services import drive
+from keypass_sync import changes, chunking, config, downloads, hashing, \
+    history, locking, metrics, uploads
+from keypass_sync.backends import RevisionMismatch, google_drive_client
+from keypass_sync.hashing import HashCache, HashingReader, hash_file
+from keypass_sync.utilities import logger, log_and_exit, sanitize_path
 
-from keypass_sync.utilities import logger, log_and_exit, \
-    create_folder_if_needed
+# Metadata entries telling that the cloud file content changed
+revision_keys = ('headRevisionId', 'md5Checksum', 'size')
 
+# A fingerprint taken less than this after the last modification of the file
+# is not trusted: a write in the same mtime tick would go unnoticed
+racy_window_ns = 2 * 10**9
 
-def get_hash(data: bytearray)->str:
+# Results of a sync operation
+up_to_date, uploaded, downloaded, failed = \
+    'up to date', 'uploaded', 'downloaded', 'failed'
+
+# Number of times a sync is planned again when the cloud file changes
+# while uploading, before giving up until the next one
+max_replans = 2
+
+
+def get_hash(data: bytearray, hashes: HashCache=None)->str:
     """Return the hexadecimal hash of file
 
     Args:
         data (bytearray): data to hash
+        hashes (HashCache): hashes already computed during the operation
 
     Returns:
         hash
     """
-    return hashlib.sha3_512(data).hexdigest()
+    return (hashes or HashCache()).of_data(data)
 
 
-def was_updated(data: bytearray, reference_hash: str)->bool:
+def was_updated(data: bytearray, reference_hash: str,
+                hashes: HashCache=None)->bool:
     """Check if the hash of `file` is different from the reference hash
 
     Args:
         data (bytearray): data to check
         reference_hash (string): reference hash
+        hashes (HashCache): hashes already computed during the operation
 
     Returns:
         true if the hash is different, else false
     """
-    return get_hash(data) != reference_hash
+    return get_hash(data, hashes) != reference_hash
 
 
 def update_conflict_exists(data_1: bytearray, data_2: bytearray,
-                           reference_hash: str)->bool:
+                           reference_hash: str,
+                           hashes: HashCache=None)->bool:
     """Check if there is an update conflict between two data chunks
 
     There is a conflict if both files were updated
@@ -47,12 +71,14 @@ def update_conflict_exists(data_1: bytearray, data_2: bytearray,
         data_2 (bytearray): data to compare 2/2
         reference_hash (str): hash with which to compare the file hashes when
             looking for changes
+        hashes (HashCache): hashes already computed during the operation
 
     Returns:
         true if there is a conflict
     """
-    return was_updated(data_1, reference_hash) \
-           and was_updated(data_2, reference_hash)
+    hashes = hashes or HashCache()
+    return was_updated(data_1, reference_hash, hashes) \
+           and was_updated(data_2, reference_hash, hashes)
 
 
 def read_data_from_file(path: Path)->bytearray:
@@ -67,20 +93,52 @@ def read_data_from_file(path: Path)->bytearray:
     return path.read_bytes()
 
 
+def cache_entries(entries: dict, cache_folder_path: Path)->dict:
+    """Cache several entries for `cache_folder_path` in one transaction
+
+    The entries are kept in the state store (see `config.state_store`).
+
+    Args:
+        entries (dict): value (str) of each entry, by name
+        cache_folder_path (Path):
+
+    Returns:
+        the entries
+    """
+    return config.state_store().put_entries(cache_folder_path, entries)
+
+
+def cache_hash(data_hash: str, cache_entry_name: str,
+               cache_folder_path: Path)->str:
+    """Cache an already computed hash for `cache_folder_path`
+
+    Args:
+        data_hash (str):
+        cache_entry_name (str):
+        cache_folder_path (Path):
+
+    Returns:
+        the hash
+    """
+    cache_entries({cache_entry_name: data_hash}, cache_folder_path)
+    return data_hash
+
+
 def cache_data_hash(data: bytearray, cache_entry_name: str,
-                    cache_folder_path: Path) -> bytearray:
-    """Cache the hash of data into `cache_folder_path`
+                    cache_folder_path: Path,
+                    hashes: HashCache=None) -> bytearray:
+    """Cache the hash of data for `cache_folder_path`
 
     Args:
         data (bytearray):
         cache_entry_name (str):
         cache_folder_path (Path):
+        hashes (HashCache): hashes already computed during the operation
 
     Returns:
         the data
     """
-    (create_folder_if_needed(cache_folder_path) / cache_entry_name).write_text(
-        get_hash(data))
+    cache_hash(get_hash(data, hashes), cache_entry_name, cache_folder_path)
     return data
 
 
@@ -94,86 +152,993 @@ def load_entry_from_cache(cache_entry_name: str, cache_folder_path: Path):
     Returns:
         the cache value if there is some, else None
     """
-    if (cache_folder_path / cache_entry_name).exists():
-        return (cache_folder_path / cache_entry_name).read_text()
-    return None
+    return config.state_store().get_entry(cache_folder_path, cache_entry_name)
 
 
-def update_cloud(data: bytearray, cloud_file_id: str,
-                 cache_folder_path: Path, file_name: str)->None:
-    """Replace the data in the cloud with `data`
+def cache_remote_metadata(metadata: dict, cache_folder_path: Path)->dict:
+    """Cache the metadata of the cloud file for `cache_folder_path`
 
     Args:
-        data (bytearray):
+        metadata (dict): metadata returned by `Backend.get_metadata`
+        cache_folder_path (Path):
+
+    Returns:
+        the metadata
+    """
+    cache_entries({'remote.json': json.dumps(metadata)}, cache_folder_path)
+    return metadata
+
+
+def load_remote_metadata(cache_folder_path: Path):
+    """Load the metadata of the cloud file as it was at the last sync
+
+    Args:
+        cache_folder_path (Path):
+
+    Returns:
+        the cached metadata if there is some, else None
+    """
+    cached_metadata = load_entry_from_cache('remote.json', cache_folder_path)
+    if cached_metadata is None:
+        return None
+    return json.loads(cached_metadata)
+
+
+def remote_was_updated(metadata: dict, reference_metadata)->bool:
+    """Check if the cloud file changed since `reference_metadata`
+
+    Only the content-related entries (`revision_keys`) are compared: renaming
+    the file on the drive does not count as an update.
+
+    Args:
+        metadata (dict): current metadata of the cloud file
+        reference_metadata (dict): metadata cached at the last sync, or None
+
+    Returns:
+        true if the content may have changed, else false
+    """
+    if not reference_metadata:
+        return True
+    return any(metadata.get(key) != reference_metadata.get(key)
+               for key in revision_keys)
+
+
+def get_fingerprint(path: Path)->dict:
+    """Return the stat-fingerprint of the file at `path`
+
+    The fingerprint changes whenever the file is written to, without having
+    to read it.
+
+    Args:
+        path (Path): file to fingerprint
+
+    Returns:
+        dict with the `size`, `mtime_ns`, `inode` and `ctime_ns` of the file
+    """
+    stat = path.stat()
+    return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                inode=stat.st_ino, ctime_ns=stat.st_ctime_ns)
+
+
+def fingerprint_entry(fingerprint: dict, runs_since_rehash: int=0)->str:
+    """Return the `file.stat` cache entry for a fingerprint
+
+    Args:
+        fingerprint (dict): result of `get_fingerprint`
+        runs_since_rehash (int): number of syncs since the last time the
+            local file was fully hashed
+
+    Returns:
+        the serialized entry
+    """
+    return json.dumps(dict(fingerprint, recorded_ns=time.time_ns(),
+                           runs_since_rehash=runs_since_rehash))
+
+
+def cache_fingerprint(fingerprint: dict, cache_folder_path: Path,
+                      runs_since_rehash: int=0)->dict:
+    """Cache the fingerprint of the local file for `cache_folder_path`
+
+    It should be the fingerprint of the content whose hash is in `file.sha`.
+
+    Args:
+        fingerprint (dict): result of `get_fingerprint`
+        cache_folder_path (Path):
+        runs_since_rehash (int): number of syncs since the last time the
+            local file was fully hashed
+
+    Returns:
+        the fingerprint
+    """
+    cache_entries({'file.stat': fingerprint_entry(
+        fingerprint, runs_since_rehash)}, cache_folder_path)
+    return fingerprint
+
+
+def fingerprint_matches(fingerprint: dict, cache_folder_path: Path,
+                        rehash_every: int=0)->bool:
+    """Check if the local file is untouched since its hash was cached
+
+    On a match the run is counted in the cache, so that a full rehash can be
+    forced every `rehash_every` runs (paranoid mode).
+
+    Args:
+        fingerprint (dict): current fingerprint of the local file
+        cache_folder_path (Path):
+        rehash_every (int): force a full rehash every `rehash_every` runs.
+            0 disables the paranoid mode.
+
+    Returns:
+        true if the cached hash can be trusted without reading the file
+    """
+    cached_fingerprint = load_entry_from_cache('file.stat', cache_folder_path)
+    if cached_fingerprint is None:
+        return False
+    cached_fingerprint = json.loads(cached_fingerprint)
+    runs_since_rehash = cached_fingerprint.pop('runs_since_rehash', 0) + 1
+    recorded_ns = cached_fingerprint.pop('recorded_ns', 0)
+
+    if cached_fingerprint != fingerprint:
+        return False
+    if recorded_ns - fingerprint['mtime_ns'] < racy_window_ns:
+        logger.debug('Fingerprint too close to the last file modification')
+        return False
+    if rehash_every and runs_since_rehash >= rehash_every:
+        logger.info('Forcing a full rehash of the local file')
+        return False
+
+    cache_fingerprint(fingerprint, cache_folder_path, runs_since_rehash)
+    return True
+
+
+def unchanged_local_hash(local_file_path: Path, cache_folder_path: Path):
+    """Return the cached hash of the local file, if it is untouched since
+
+    Unlike `fingerprint_matches`, nothing is recorded and the paranoid mode
+    is not applied.
+
+    Args:
+        local_file_path (Path): the local file
+        cache_folder_path (Path):
+
+    Returns:
+        the hash cached in `file.sha` if the fingerprint of the local file
+        did not change since, else None
+    """
+    cached_fingerprint = load_entry_from_cache('file.stat', cache_folder_path)
+    if cached_fingerprint is None:
+        return None
+    cached_fingerprint = json.loads(cached_fingerprint)
+    recorded_ns = cached_fingerprint.pop('recorded_ns', 0)
+    cached_fingerprint.pop('runs_since_rehash', None)
+    fingerprint = get_fingerprint(local_file_path)
+    if cached_fingerprint != fingerprint \
+            or recorded_ns - fingerprint['mtime_ns'] < racy_window_ns:
+        return None
+    return load_entry_from_cache('file.sha', cache_folder_path)
+
+
+def update_cloud(local_file_path: Path, cloud_file_id: str,
+                 cache_folder_path: Path, file_name: str=None,
+                 backend=None,
+                 chunk_size: int=uploads.default_chunk_size,
+                 algorithm: str=hashing.default_algorithm,
+                 content_cache=None, snapshots=None,
+                 expected_revision: str=None,
+                 local_hash: tuple=None)->None:
+    """Replace the data in the cloud with the content of `local_file_path`
+
+    The file is streamed from the disk to the drive and hashed in the same
+    pass, unless its hash is already known: no copy of it is held in
+    memory. It is sent by chunks, and an interrupted upload is resumed by
+    the next call (see `keypass_sync.uploads`).
+
+    Args:
+        local_file_path(Path):
         cloud_file_id(str):
         cache_folder_path(Path):
-        file_name(str): name to give to the file on the cloud
+        file_name(str): name to give to the file on the cloud. Defaults to
+            the name of the local file.
+        backend (Backend): where the cloud file is. Defaults to the google
+            drive configured in google_services.
+        chunk_size (int): size of the uploaded chunks, in bytes
+        algorithm (str): name of the hash algorithm (see
+            `hashing.algorithms`)
+        content_cache (content_cache.ContentCache): where to keep a copy of
+            the uploaded content, if anywhere
+        snapshots (history.History): where to snapshot the uploaded
+            version, if anywhere
+        expected_revision (str): `headRevisionId` the cloud file must still
+            have, else `backends.RevisionMismatch` is raised and it is left
+            untouched. Defaults to replacing whatever revision.
+        local_hash (tuple): (stat-fingerprint: dict, hash: str) of the local
+            file, if it was just hashed (e.g. by `sync`). It is not hashed
+            again if its fingerprint is still the same.
     """
     logger.info('Updating cloud file with local one')
-    (cache_folder_path / 'tmp').write_bytes(data)
-    if drive.update_file(
-            cache_folder_path / 'tmp', cloud_file_id,
-            file_name=file_name).get('id') is not None:
+    backend = backend or google_drive_client()
+    fingerprint = get_fingerprint(local_file_path)
+    data_hash = None
+    if local_hash is not None and local_hash[0] == fingerprint:
+        data_hash = local_hash[1]
+    with local_file_path.open('rb') as local_file, \
+            metrics.span('upload') as upload_span:
+        reader = local_file if data_hash is not None \
+            else HashingReader(local_file, algorithm)
+        metadata = uploads.upload(
+            backend, reader, cloud_file_id,
+            file_name or local_file_path.name, fingerprint['size'],
+            cache_folder_path, fingerprint, chunk_size, expected_revision)
+        if data_hash is None:
+            upload_span.bytes_count = reader.bytes_hashed
+            # Hash what the cloud file holds, even if the local file grew
+            data_hash = reader.hexdigest(
+                int(metadata['size']) if 'size' in metadata else None)
+        else:
+            upload_span.bytes_count = fingerprint['size']
+    if metadata.get('id') is not None:
         # Success !
-        cache_data_hash(data, 'file.sha', cache_folder_path)
-        (cache_folder_path / 'tmp').unlink()
+        unchanged = get_fingerprint(local_file_path) == fingerprint
+        if not unchanged and reader is local_file:
+            # The hash of what was uploaded is not known
+            logger.info('The local file changed while uploading it: '
+                        'uploading it again')
+            return update_cloud(
+                local_file_path, cloud_file_id, cache_folder_path,
+                file_name, backend, chunk_size, algorithm, content_cache,
+                snapshots, metadata.get('headRevisionId'))
+        cache_entries({
+            'file.sha': data_hash, 'remote.json': json.dumps(metadata),
+            'file.stat': fingerprint_entry(fingerprint) if unchanged
+            else None}, cache_folder_path)
+        if unchanged and content_cache is not None:
+            # Checked against its hash when used
+            content_cache.put(local_file_path, data_hash, cloud_file_id,
+                              metadata)
+        if unchanged and snapshots is not None:
+            snapshots.snapshot(local_file_path, local_file_path,
+                               cache_folder_path, history.uploaded,
+                               data_hash)
         logger.info('Success')
-        logger.debug(f'New sha: {get_hash(data)}')
+        logger.debug(f'New sha: {data_hash}')
+    else:
+        log_and_exit(f'Could not update cloud file {cloud_file_id}: '
+                     f'unexpected response {metadata}')
+
 
+def update_cloud_chunked(local_file_path: Path, cloud_file_id: str,
+                         chunk_folder_id: str, cache_folder_path: Path,
+                         file_name: str=None, backend=None,
+                         average_size: int=chunking.default_average_size,
+                         algorithm: str=hashing.default_algorithm,
+                         content_cache=None, snapshots=None,
+                         expected_revision: str=None)->None:
+    """Replace the data in the cloud with the content of `local_file_path`,
+    in the chunked mode
 
-def update_local(local_file_path: Path, data: bytearray,
-                 cache_folder_path: Path)->None:
-    """Replace the local file content with `data`
+    Only the chunks missing from the chunk store are uploaded, then the
+    cloud file is replaced with the manifest of the local file (see
+    `keypass_sync.chunking`).
+
+    Args:
+        local_file_path(Path):
+        cloud_file_id(str): id of the cloud file holding the manifest
+        chunk_folder_id(str): id of the cloud folder holding the chunks
+        cache_folder_path(Path):
+        file_name(str): name to give to the file on the cloud. Defaults to
+            the name of the local file.
+        backend (Backend): where the cloud file is. Defaults to the google
+            drive configured in google_services.
+        average_size (int): average size of the chunks, in bytes
+        algorithm (str): name of the hash algorithm (see
+            `hashing.algorithms`)
+        content_cache (content_cache.ContentCache): where to keep a copy of
+            the uploaded content, if anywhere
+        snapshots (history.History): where to snapshot the uploaded
+            version, if anywhere
+        expected_revision (str): see `update_cloud`. The chunks are
+            uploaded anyway, only the manifest is conditioned on it.
+    """
+    logger.info('Updating cloud file with local one, by chunks')
+    backend = backend or google_drive_client()
+    fingerprint = get_fingerprint(local_file_path)
+    with metrics.span('upload') as upload_span:
+        metadata, manifest, upload_span.bytes_count = chunking.upload(
+            backend, local_file_path, cloud_file_id, chunk_folder_id,
+            file_name or local_file_path.name, average_size, algorithm,
+            expected_revision)
+    if metadata.get('id') is not None:
+        # Success !
+        unchanged = get_fingerprint(local_file_path) == fingerprint
+        cache_entries({
+            'file.sha': manifest['hash'], 'remote.json': json.dumps(metadata),
+            'manifest.json': json.dumps(manifest),
+            'file.stat': fingerprint_entry(fingerprint) if unchanged
+            else None}, cache_folder_path)
+        if unchanged and content_cache is not None:
+            content_cache.put(local_file_path, manifest['hash'])
+        if unchanged and snapshots is not None:
+            snapshots.snapshot(local_file_path, local_file_path,
+                               cache_folder_path, history.uploaded,
+                               manifest['hash'])
+        logger.info('Success')
+        logger.debug(f'New sha: {manifest["hash"]}')
+    else:
+        log_and_exit(f'Could not update cloud file {cloud_file_id}: '
+                     f'unexpected response {metadata}')
+
+
+def download_chunks_next_to(local_file_path: Path, manifest: dict,
+                            cache_folder_path: Path, backend=None,
+                            algorithm: str=hashing.default_algorithm,
+                            content_cache=None)->tuple:
+    """Rebuild the content described by a manifest in a temporary file next
+    to `local_file_path`, in the chunked mode
+
+    The chunks the local file had at the last sync are not downloaded
+    again (see `chunking.download_next_to`), nor is a content found in
+    `content_cache`.
+
+    Args:
+        local_file_path (Path): file that the download may replace
+        manifest (dict): manifest held by the cloud file
+        cache_folder_path (Path):
+        backend (Backend): where the chunk store is. Defaults to the google
+            drive configured in google_services.
+        algorithm (str): name of the hash algorithm (see
+            `hashing.algorithms`)
+        content_cache (content_cache.ContentCache): contents that need not
+            be downloaded, and where to keep the downloaded one
+
+    Returns:
+        (downloaded_file_path: Path, hash of the downloaded content: str)
+    """
+    if content_cache is not None:
+        with metrics.span('content_cache', manifest['size']):
+            copied = content_cache.copy_next_to(
+                manifest['hash'], local_file_path, algorithm)
+        if copied is not None:
+            logger.info('Cloud content found in the content cache')
+            return copied
+    backend = backend or google_drive_client()
+    local_manifest = load_entry_from_cache('manifest.json', cache_folder_path)
+    with metrics.span('download') as download_span:
+        downloaded_file_path, data_hash, download_span.bytes_count = \
+            chunking.download_next_to(
+                local_file_path, manifest, backend,
+                local_manifest and json.loads(local_manifest), algorithm)
+    if content_cache is not None:
+        content_cache.put(downloaded_file_path, manifest['hash'])
+    return downloaded_file_path, data_hash
+
+
+def download_next_to(local_file_path: Path, cloud_file_id: str,
+                     backend=None, metadata: dict=None,
+                     chunk_size: int=downloads.default_chunk_size,
+                     max_workers: int=downloads.default_max_workers,
+                     algorithm: str=hashing.default_algorithm,
+                     content_cache=None)->tuple:
+    """Download the cloud file into a temporary file next to `local_file_path`
+
+    The content is streamed to the disk and hashed as it arrives: memory
+    usage does not depend on the size of the file. Large files are fetched
+    by ranges, in parallel (see `keypass_sync.downloads`). The temporary
+    file is on the same file system as `local_file_path`, so that it can
+    atomically replace it (see `update_local`).
+
+    A revision whose content is in `content_cache` is copied from there
+    instead. A downloaded one is added to it, if its size is the one of the
+    metadata: the content could otherwise be of a later revision.
+
+    Args:
+        local_file_path (Path): file that the download may replace
+        cloud_file_id (str): id of the cloud file
+        backend (Backend): where the cloud file is. Defaults to the google
+            drive configured in google_services.
+        metadata (dict): current metadata of the cloud file. Its size is
+            needed to download it by ranges.
+        chunk_size (int): size of the downloaded ranges, in bytes
+        max_workers (int): number of ranges downloaded at once
+        algorithm (str): name of the hash algorithm (see
+            `hashing.algorithms`)
+        content_cache (content_cache.ContentCache): revisions that need not
+            be downloaded, and where to keep the downloaded one
+
+    Returns:
+        (downloaded_file_path: Path, hash of the downloaded content: str)
+    """
+    metadata = metadata or {}
+    size = metadata.get('size')
+    cached_hash = None if content_cache is None \
+        else content_cache.lookup(cloud_file_id, metadata)
+    if cached_hash is not None:
+        with metrics.span('content_cache', size and int(size)):
+            copied = content_cache.copy_next_to(cached_hash, local_file_path,
+                                                algorithm)
+        if copied is not None:
+            logger.info('Cloud revision found in the content cache')
+            return copied
+    file_descriptor, downloaded_file_path = tempfile.mkstemp(
+        prefix=f'.{local_file_path.name}.', suffix='.download',
+        dir=str(local_file_path.parent))
+    downloaded_file_path = Path(downloaded_file_path)
+    backend = backend or google_drive_client()
+    try:
+        with os.fdopen(file_descriptor, 'wb') as downloaded_file, \
+                metrics.span('download') as download_span:
+            data_hash, bytes_count = downloads.download(
+                backend, cloud_file_id, downloaded_file,
+                size=None if size is None else int(size),
+                md5_checksum=metadata.get('md5Checksum'),
+                chunk_size=chunk_size, max_workers=max_workers,
+                algorithm=algorithm)
+            downloaded_file.flush()
+            os.fsync(downloaded_file.fileno())
+            download_span.bytes_count = bytes_count
+    except BaseException:
+        downloaded_file_path.unlink()
+        raise
+    logger.debug(f'Downloaded {bytes_count} bytes')
+    if content_cache is not None and size is not None \
+            and int(size) == bytes_count:
+        content_cache.put(downloaded_file_path, data_hash, cloud_file_id,
+                          metadata)
+    return downloaded_file_path, data_hash
+
+
+def _fsync_folder(folder_path: Path)->None:
+    """Persist the entries of a folder (e.g. after a rename)"""
+    try:
+        folder_descriptor = os.open(str(folder_path), os.O_RDONLY)
+    except OSError:
+        # Folders can not be opened on every platform
+        return
+    try:
+        os.fsync(folder_descriptor)
+    finally:
+        os.close(folder_descriptor)
+
+
+def replace_local_file(local_file_path: Path, new_file_path: Path)->None:
+    """Atomically replace a local file with another one of its folder
+
+    A crash leaves either the old or the new content, never a partially
+    written file. The permissions of the local file are kept.
+    """
+    with metrics.span('local_write'):
+        if local_file_path.exists():
+            shutil.copymode(str(local_file_path), str(new_file_path))
+        os.replace(str(new_file_path), str(local_file_path))
+        _fsync_folder(local_file_path.parent)
+
+
+def update_local(local_file_path: Path, downloaded_file_path: Path,
+                 cache_folder_path: Path, metadata: dict=None,
+                 data_hash: str=None, manifest: dict=None,
+                 algorithm: str=hashing.default_algorithm,
+                 snapshots=None)->None:
+    """Replace the local file with a downloaded one
+
+    The replacement is an atomic rename (see `replace_local_file`).
 
     Args:
         local_file_path:
-        data:
+        downloaded_file_path: file returned by `download_next_to`
         cache_folder_path:
+        metadata (dict): metadata of the cloud file the download comes from.
+            It should be fetched *before* downloading it.
+        data_hash (str): hash of the downloaded content, if already known
+        manifest (dict): manifest of the downloaded content, in the chunked
+            mode (see `keypass_sync.chunking`)
+        algorithm (str): name of the hash algorithm, if `data_hash` is not
+            given (see `hashing.algorithms`)
+        snapshots (history.History): where to snapshot the replaced and
+            the downloaded versions, if anywhere
     """
     logger.info('Updating local file with cloud one')
-    local_file_path.write_bytes(data)
-    cache_data_hash(data, 'file.sha', cache_folder_path)
+    if data_hash is None:
+        with metrics.span('hash', downloaded_file_path.stat().st_size):
+            data_hash = hash_file(downloaded_file_path, algorithm=algorithm)
+    if snapshots is not None:
+        if local_file_path.exists():
+            snapshots.snapshot(
+                local_file_path, local_file_path, cache_folder_path,
+                history.replaced,
+                unchanged_local_hash(local_file_path, cache_folder_path),
+                hashing.algorithm_of(data_hash))
+        snapshots.snapshot(downloaded_file_path, local_file_path,
+                           cache_folder_path, history.downloaded, data_hash)
+    replace_local_file(local_file_path, downloaded_file_path)
+    entries = {'file.sha': data_hash, 'file.stat': fingerprint_entry(
+        get_fingerprint(local_file_path))}
+    if metadata is not None:
+        entries['remote.json'] = json.dumps(metadata)
+    if manifest is not None:
+        entries['manifest.json'] = json.dumps(manifest)
+    cache_entries(entries, cache_folder_path)
     logger.info('Success')
 
 
-def sync(local_file_path: Path, cloud_file_id: str, cache_folder_path: Path):
+def migrate_hash(local_file_path: Path, cached_sha: str,
+                 cache_folder_path: Path, algorithm: str,
+                 rehash_every: int=0)->str:
+    """Re-hash the synced content with another algorithm
+
+    The cached hash can only be replaced if the local file still holds the
+    synced content, i.e. if its fingerprint did not change since the last
+    sync. Otherwise the sync runs with the algorithm of the cached hash,
+    and the migration is tried again at the next one.
+
+    Args:
+        local_file_path (Path): the local file
+        cached_sha (str): hash of the content synced last, made by another
+            algorithm
+        cache_folder_path (Path):
+        algorithm (str): name of the new algorithm (see `hashing.algorithms`)
+        rehash_every (int): see `fingerprint_matches`
+
+    Returns:
+        the hash to compare the local and cloud contents with: made by
+        `algorithm` if it could be migrated, else `cached_sha`
+    """
+    fingerprint = get_fingerprint(local_file_path)
+    if not fingerprint_matches(fingerprint, cache_folder_path, rehash_every):
+        logger.info(f'Local file changed since the last sync, its hash will '
+                    f'be migrated to {algorithm} at the next one')
+        return cached_sha
+    with metrics.span('hash', fingerprint['size']):
+        data_hash = hash_file(local_file_path, algorithm=algorithm)
+    if get_fingerprint(local_file_path) != fingerprint:
+        return cached_sha
+    logger.info(f'Migrated the hash of the synced content from '
+                f'{hashing.algorithm_of(cached_sha)} to {algorithm}')
+    return cache_hash(data_hash, 'file.sha', cache_folder_path)
+
+
+def sync(local_file_path: Path, cloud_file_id: str, cache_folder_path: Path,
+         backend=None, rehash_every: int=0,
+         remote_unchanged: bool=False, metadata: dict=None,
+         upload_chunk_size: int=uploads.default_chunk_size,
+         download_chunk_size: int=downloads.default_chunk_size,
+         download_workers: int=downloads.default_max_workers,
+         chunk_folder_id: str=None,
+         chunk_average_size: int=chunking.default_average_size,
+         hash_algorithm: str=hashing.default_algorithm,
+         content_cache=None, snapshots=None,
+         replans: int=max_replans)->str:
     """Perform a sync operation between the local and the cloud data
 
+    The cloud file is only downloaded if its metadata tells that it changed
+    since the last sync. The local file is only hashed if its
+    stat-fingerprint changed since the last sync. Both are streamed, never
+    loaded in memory, and each hash is computed at most once.
+
+    In the chunked mode (`chunk_folder_id` given), the cloud file holds the
+    manifest of the content, whose chunks are in the `chunk_folder_id`
+    folder: only the chunks that changed are transferred (see
+    `keypass_sync.chunking`).
+
+    The revisions of the cloud file found in `content_cache` are not
+    downloaded: their hash is known, and their content copied from the disk
+    if needed (see `keypass_sync.content_cache`).
+
+    The versions uploaded, downloaded or replaced, and both sides of a
+    conflict, are snapshotted in `snapshots` (see `keypass_sync.history`).
+
+    The uploads are conditioned on the revision of the cloud file the
+    decision was made on: if another client replaced it in between, the
+    upload fails before overwriting it, and the sync is planned again with
+    the new revision: the conflict is then reported.
+
     Args:
         local_file_path (Path): path to the file containing the local data
         cloud_file_id (str): id of the cloud file containing the remote data
-        cache_folder_path (Path): path to the folder containing the
-            references-hashes of the data
+        cache_folder_path (Path): path to the cache folder of the profile,
+            identifying its reference-hashes in the state store
+        backend (Backend): where the cloud file is. Defaults to the google
+            drive configured in google_services.
+        rehash_every (int): fully re-hash the local file every `rehash_every`
+            runs even if its fingerprint did not change. 0 disables it.
+        remote_unchanged (bool): whether the cloud file is known not to have
+            changed since the last sync (see `keypass_sync.changes`). Its
+            metadata are then not fetched.
+        metadata (dict): current metadata of the cloud file, if already
+            fetched (e.g. in a batch, see `sync_all`)
+        upload_chunk_size (int): size of the uploaded chunks, in bytes
+        download_chunk_size (int): size of the ranges in which large cloud
+            files are downloaded, in bytes
+        download_workers (int): number of ranges downloaded at once
+        chunk_folder_id (str): id of the cloud folder holding the chunks,
+            to sync in the chunked mode
+        chunk_average_size (int): average size of the chunks, in bytes
+        hash_algorithm (str): name of the hash algorithm (see
+            `hashing.algorithms`). The hashes cached with another algorithm
+            are migrated (see `migrate_hash`).
+        content_cache (content_cache.ContentCache): local copies of the
+            synced contents, if any
+        snapshots (history.History): where to snapshot the synced versions,
+            if anywhere
+        replans (int): number of times the sync may be planned again if the
+            cloud file changes while uploading. `RevisionMismatch` is raised
+            beyond.
+
+    Returns:
+        what was done: `up_to_date`, `uploaded` or `downloaded`
     """
-    # Load files
-    local_file = read_data_from_file(local_file_path)
-    cloud_file = drive.download_file(cloud_file_id)
+    backend = backend or google_drive_client()
     cached_sha = load_entry_from_cache('file.sha', cache_folder_path)
+    algorithm = hash_algorithm
+    if cached_sha is not None \
+            and hashing.algorithm_of(cached_sha) != hash_algorithm:
+        cached_sha = migrate_hash(local_file_path, cached_sha,
+                                  cache_folder_path, hash_algorithm,
+                                  rehash_every)
+        # The hashes compared below should be made by the same algorithm
+        algorithm = hashing.algorithm_of(cached_sha)
+    hashes = HashCache(algorithm)
+
+    def upload()->str:
+        # The revision the decision to upload was made on
+        expected_revision = metadata.get('headRevisionId')
+        try:
+            if chunk_folder_id:
+                update_cloud_chunked(local_file_path, cloud_file_id,
+                                     chunk_folder_id, cache_folder_path,
+                                     backend=backend,
+                                     average_size=chunk_average_size,
+                                     algorithm=hash_algorithm,
+                                     content_cache=content_cache,
+                                     snapshots=snapshots,
+                                     expected_revision=expected_revision)
+            else:
+                update_cloud(local_file_path, cloud_file_id,
+                             cache_folder_path, backend=backend,
+                             chunk_size=upload_chunk_size,
+                             algorithm=hash_algorithm,
+                             content_cache=content_cache,
+                             snapshots=snapshots,
+                             expected_revision=expected_revision,
+                             local_hash=(fingerprint, local_sha))
+        except RevisionMismatch as error:
+            if replans <= 0:
+                raise
+            logger.info(f'{error}: planning the sync again')
+            return sync(local_file_path, cloud_file_id, cache_folder_path,
+                        backend, rehash_every,
+                        upload_chunk_size=upload_chunk_size,
+                        download_chunk_size=download_chunk_size,
+                        download_workers=download_workers,
+                        chunk_folder_id=chunk_folder_id,
+                        chunk_average_size=chunk_average_size,
+                        hash_algorithm=hash_algorithm,
+                        content_cache=content_cache, snapshots=snapshots,
+                        replans=replans - 1)
+        return uploaded
+
+    def report_conflict()->None:
+        message = (f'Could not sync keypass database {local_file_path} with '
+                   f'cloud file {cloud_file_id}: both were updated since the '
+                   f'last sync operation. Please merge them manually using '
+                   f'the `force-update` option.')
+        if snapshots is not None:
+            snapshots.snapshot(local_file_path, local_file_path,
+                               cache_folder_path, history.local_conflict,
+                               local_sha)
+            if downloaded_file_path is not None:
+                snapshots.snapshot(downloaded_file_path, local_file_path,
+                                   cache_folder_path, history.cloud_conflict,
+                                   cloud_sha)
+            message += (' Both versions were snapshotted: see the `history` '
+                        'and `restore` commands.')
+        log_and_exit(message)
+
+    with metrics.span('remote_metadata'):
+        if metadata is None and remote_unchanged and cached_sha is not None:
+            metadata = load_remote_metadata(cache_folder_path)
+        if metadata is None:
+            metadata = backend.get_metadata(cloud_file_id)
+
+    # Hash the local file, unless it is untouched since the last sync
+    fingerprint = get_fingerprint(local_file_path)
+    local_was_hashed = cached_sha is None or not fingerprint_matches(
+        fingerprint, cache_folder_path, rehash_every)
+    if local_was_hashed:
+        with metrics.span('hash', fingerprint['size']):
+            local_sha = hashes.of_file(local_file_path, fingerprint)
+    else:
+        logger.info('Local file unchanged since last sync')
+        local_sha = cached_sha
+
+    if cached_sha is not None and not remote_was_updated(
+            metadata, load_remote_metadata(cache_folder_path)):
+        logger.info('Cloud file unchanged since last sync')
+        if local_sha != cached_sha:
+            return upload()
+        if local_was_hashed:
+            cache_fingerprint(fingerprint, cache_folder_path)
+        return up_to_date
+
+    manifest = downloaded_file_path = None
+    if chunk_folder_id:
+        # The chunks are only downloaded if the local file is to be updated
+        with metrics.span('download'):
+            try:
+                manifest = chunking.fetch_manifest(backend, cloud_file_id,
+                                                   metadata)
+            except ValueError:
+                log_and_exit(
+                    f'Cloud file {cloud_file_id} does not hold a chunk '
+                    f'manifest. Please convert it by using the '
+                    f'`force-update cloud` option.')
+        if hashing.algorithm_of(manifest['hash']) == algorithm:
+            cloud_sha = manifest['hash']
+        else:
+            # Uploaded by a client using another hash algorithm
+            downloaded_file_path, cloud_sha = download_chunks_next_to(
+                local_file_path, manifest, cache_folder_path, backend,
+                algorithm, content_cache)
+    else:
+        cloud_sha = None if content_cache is None \
+            else content_cache.lookup(cloud_file_id, metadata)
+        if cloud_sha is not None \
+                and hashing.algorithm_of(cloud_sha) == algorithm:
+            # The content is only copied if the local file is to be updated
+            logger.info('Cloud revision found in the content cache')
+        else:
+            downloaded_file_path, cloud_sha = download_next_to(
+                local_file_path, cloud_file_id, backend, metadata,
+                chunk_size=download_chunk_size, max_workers=download_workers,
+                algorithm=algorithm, content_cache=content_cache)
+    try:
+        if cached_sha is None:
+            # This is the first time we sync
+            if local_sha != cloud_sha:
+                report_conflict()
+            cached_sha = cache_hash(local_sha, 'file.sha', cache_folder_path)
+
+        # Check for conflicts
+        if local_sha != cached_sha and cloud_sha != cached_sha:
+            # Stop if a conflict was found
+            report_conflict()
+
+        # Do sync
+        if local_sha != cached_sha:
+            return upload()
+        if cloud_sha != cached_sha:
+            if downloaded_file_path is None and manifest is not None:
+                downloaded_file_path, cloud_sha = download_chunks_next_to(
+                    local_file_path, manifest, cache_folder_path, backend,
+                    algorithm, content_cache)
+            elif downloaded_file_path is None:
+                downloaded_file_path, cloud_sha = download_next_to(
+                    local_file_path, cloud_file_id, backend, metadata,
+                    chunk_size=download_chunk_size,
+                    max_workers=download_workers, algorithm=algorithm,
+                    content_cache=content_cache)
+            update_local(local_file_path, downloaded_file_path,
+                         cache_folder_path, metadata, cloud_sha, manifest,
+                         snapshots=snapshots)
+            return downloaded
+
+        # Same content, remember the revision to skip the next downloads
+        entries = {'remote.json': json.dumps(metadata)}
+        if local_was_hashed:
+            entries['file.stat'] = fingerprint_entry(fingerprint)
+        if manifest is not None:
+            entries['manifest.json'] = json.dumps(manifest)
+        cache_entries(entries, cache_folder_path)
+        return up_to_date
+    finally:
+        if downloaded_file_path is not None \
+                and downloaded_file_path.exists():
+            downloaded_file_path.unlink()
+
+
+def sync_version(version: str, backend=None,
+                 remote_unchanged: bool=False, metadata: dict=None,
+                 wait: bool=True)->str:
+    """Sync the file of one config version
+
+    Failures are logged and reported instead of stopping the process. The
+    timings of the sync phases are exported as configured by the
+    `metrics_log` and `metrics_textfile` config entries.
+
+    The sync holds the lock of the profile (see `keypass_sync.locking`): if
+    another sync of it is running, its result is waited for and returned,
+    or `locking.already_running` at once if `wait` is false. The local file
+    saved again after the running sync read it is synced again instead.
+
+    Versions whose local path is a folder sync the files of that folder
+    with the ones of the cloud folder (see `keypass_sync.folders`).
+
+    Args:
+        version (str): version of the configuration to use
+        backend (Backend): where the cloud file is. Defaults to the shared
+            google-drive client for the version's credentials.
+        remote_unchanged (bool): whether the cloud file is known not to have
+            changed since the last sync (see `sync`)
+        metadata (dict): current metadata of the cloud file, if already
+            fetched (see `sync`)
+        wait (bool): whether to wait for a running sync of the version
+
+    Returns:
+        what was done (see `sync`), `failed`, or `locking.already_running`
+    """
+    profile = None
+    with metrics.Recorder(version=version or 'default') as recorder:
+        try:
+            with metrics.span('config_load'):
+                profile = config.load_profile(version)
+                options = config.sync_options(version)
+            folder_workers = options.pop('folder_workers', None)
+
+            def run()->str:
+                profile_backend = backend or google_drive_client(
+                    profile['credential_folder_path'])
+                if profile['local_file_path'].is_dir():
+                    return _sync_folder_version(
+                        profile, profile_backend, folder_workers, options)
+                return sync(
+                    profile['local_file_path'], profile['cloud_file_id'],
+                    profile['cache_folder_path'], backend=profile_backend,
+                    remote_unchanged=remote_unchanged, metadata=metadata,
+                    **options)
+
+            def is_current()->bool:
+                if profile['local_file_path'].is_dir():
+                    # Imported here, the folders module depending on this one
+                    from keypass_sync import folders
+                    return folders.local_files_unchanged(
+                        profile['local_file_path'],
+                        profile['cache_folder_path'])
+                return unchanged_local_hash(
+                    profile['local_file_path'],
+                    profile['cache_folder_path']) is not None
+
+            recorder.result = locking.single_flight(
+                profile['cache_folder_path'], 'sync', run, wait=wait,
+                unshared=(failed,), is_current=is_current)
+        except SystemExit:
+            # The reason was already logged by `log_and_exit`
+            recorder.result = failed
+        except Exception as error:
+            logger.error(f'Could not sync version {version}: {error!r}')
+            recorder.result = failed
+
+    if profile is not None and profile['metrics_log']:
+        recorder.write_json_line(profile['metrics_log'])
+    if profile is not None and profile['metrics_textfile']:
+        recorder.write_textfile(profile['metrics_textfile'],
+                                success=recorder.result != failed)
+    return recorder.result
+
+
+def _sync_folder_version(profile: dict, backend, folder_workers: int,
+                         options: dict)->str:
+    """Sync a folder profile (see `sync_version`)"""
+    # Imported here, the folders module depending on this one
+    from keypass_sync import folders
+
+    if options.pop('chunk_folder_id', None):
+        logger.warning('The chunked mode is not supported by the folder '
+                       'profiles: the files are synced whole')
+    options.pop('chunk_average_size', None)
+    results = folders.sync_folder(
+        profile['local_file_path'], profile['cloud_file_id'],
+        profile['cache_folder_path'], backend,
+        max_workers=folder_workers or folders.default_max_workers,
+        **options)
+    for name, result in sorted(results.items()):
+        logger.info(f'{name}: {result}')
+    return folders.summarize(results)
+
+
+def fetch_metadata(backend, cloud_file_ids: list)->dict:
+    """Fetch the metadata of several cloud files in batches
+
+    Args:
+        backend (Backend): where the cloud files are
+        cloud_file_ids (list): ids of the cloud files
+
+    Returns:
+        dict giving the metadata of each cloud file, by id. The files whose
+        metadata could not be fetched are left out: `sync` fetches them
+        again, and reports the error.
+    """
+    if not cloud_file_ids:
+        return {}
+    try:
+        with metrics.span('remote_metadata'):
+            results = backend.get_metadata_batch(cloud_file_ids)
+    except Exception as error:
+        logger.warning(f'Could not fetch the metadata in batch: {error!r}')
+        return {}
+    return {cloud_file_id: metadata
+            for cloud_file_id, metadata in results.items()
+            if isinstance(metadata, dict)}
+
+
+def sync_all(versions: list=None, max_workers: int=4,
+             backend=None, wait: bool=True)->dict:
+    """Sync the files of several config versions concurrently
+
+    Versions using the same google-SSO token share the same drive client.
+    The changes feed of each account tells which cloud files changed since
+    the last sync (see `keypass_sync.changes`): the metadata of the others
+    are not fetched. Those of the changed ones are fetched in batches, a
+    few requests per account instead of one per version. The folder
+    profiles always list their cloud folder (see `keypass_sync.folders`).
+
+    The position in the changes feed is kept by version: the new one of a
+    version is only saved once it was synced, the changes of the failed,
+    skipped or unsynced ones are listed again at the next poll.
+
+    Args:
+        versions (list): versions of the configuration to sync. Defaults to
+            every version saved on this machine.
+        max_workers (int): maximum number of versions synced at once
+        backend (Backend): where the cloud files are, for every version
+            (see `sync_version`)
+        wait (bool): whether to wait for the running syncs of the versions
+            (see `sync_version`)
+
+    Returns:
+        dict giving what was done (see `sync_version`) for each version
+    """
+    # Imported here to keep the import of this module fast
+    from concurrent.futures import ThreadPoolExecutor
+
+    if versions is None:
+        versions = config.list_versions()
+
+    # Versions by account, the config being validated later by sync_version
+    versions_by_account = {}
+    cloud_file_ids = {}
+    folder_versions = set()
+    store = config.state_store()
+    for version in versions:
+        saved_config = store.get_config(version or 'default') or {}
+        cloud_file_ids[version] = saved_config.get('cloud_file_id')
+        if saved_config.get('local_file_path') and sanitize_path(
+                saved_config['local_file_path']).is_dir():
+            folder_versions.add(version)
+        versions_by_account.setdefault(
+            saved_config.get('credential_folder_path'), []).append(version)
+
+    unchanged_versions = set()
+    positions = {}
+    fetched_metadata = {}
+    for account, account_versions in versions_by_account.items():
+        if account is None:
+            continue
+        account_backend = backend or google_drive_client(account)
+        changed_file_ids, positions[account] = changes.poll(
+            account_backend, account, account_versions)
+        unchanged_versions.update(
+            version for version in account_versions
+            if changed_file_ids[version] is not None
+            and cloud_file_ids[version] not in changed_file_ids[version]
+            and version not in folder_versions)
+        fetched_metadata.update(fetch_metadata(account_backend, [
+            cloud_file_ids[version] for version in account_versions
+            if version not in unchanged_versions
+            and version not in folder_versions
+            and cloud_file_ids[version]]))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = dict(zip(versions, executor.map(
+            lambda version: sync_version(
+                version, backend,
+                remote_unchanged=version in unchanged_versions,
+                metadata=fetched_metadata.get(cloud_file_ids[version]),
+                wait=wait),
+            versions)))
 
-    if cached_sha is None:
-        # This is the first time we sync
-        if was_updated(local_file, get_hash(cloud_file)):
-            log_and_exit(
-                f'Could not sync keypass database {local_file_path} with '
-                f'cloud file {cloud_file_id}: both were updated since the '
-                f'last sync operation. Please merge them manually using the '
-                f'`force-update` option.')
-        cache_data_hash(local_file, 'file.sha', cache_folder_path)
-        cached_sha = load_entry_from_cache('file.sha', cache_folder_path)
-
-    # Check for conflicts
-    if update_conflict_exists(local_file, cloud_file, cached_sha):
-        # Stop if a conflict was found
-        log_and_exit(
-            f'Could not sync keypass database {local_file_path} with '
-            f'cloud file {cloud_file_id}: both were updated since the '
-            f'last sync operation. Please merge them manually using the '
-            f'`force-update` option.')
-
-    # Do sync
-    if was_updated(local_file, cached_sha):
-        update_cloud(local_file, cloud_file_id, cache_folder_path,
-                     local_file_path.name)
-
-    if was_updated(cloud_file, cached_sha):
-        update_local(local_file_path, cloud_file, cache_folder_path)
+    for account, account_positions in positions.items():
+        for version, page_token in account_positions.items():
+            # Changes of a failed or skipped version are listed again at the
+            # next poll
+            if page_token is not None and results[version] not in (
+                    failed, locking.already_running):
+                changes.save(account, version, page_token)
+    return results
@@ -0,0 +1,132 @@
+"""Upload files by chunks, resuming the interrupted uploads
+
+The upload session of the cloud file and the number of bytes it received
+are saved in the cache entries of the profile (`upload.json`, see
+`keypass_sync.state`) after each chunk. If the upload is interrupted (crash,
+network failure, ...), the next one asks the backend how far it went and
+only sends the rest, provided the local file did not change in between.
+
+An upload conditioned on a revision of the cloud file (see
+`backends.RevisionMismatch`) only resumes a session started with the same
+condition.
+"""
+
+import json
+from pathlib import Path
+
+from keypass_sync import config
+from keypass_sync.backends import RevisionMismatch
+from keypass_sync.backends.scheduled import is_retryable
+from keypass_sync.utilities import logger
+
+# Default size of the uploaded chunks, in bytes
+default_chunk_size = 8 * 1024 * 1024
+
+# Number of times the rest of an upload is sent again after a failed chunk,
+# before giving up until the next sync
+max_chunk_failures = 5
+
+
+def _save(cache_folder_path: Path, upload)->None:
+    config.state_store().put_entries(cache_folder_path, {
+        'upload.json': None if upload is None else json.dumps(upload)})
+
+
+def _resume(backend, upload: dict, file_id: str, size: int,
+            fingerprint: dict, expected_revision: str)->tuple:
+    """Ask how far a saved upload went
+
+    Returns:
+        (number of bytes received, metadata if complete), or None if the
+        saved upload can not be resumed
+    """
+    if upload is None or upload['file_id'] != file_id \
+            or upload['size'] != size or upload['fingerprint'] != fingerprint \
+            or upload.get('expected_revision') != expected_revision:
+        return None
+    try:
+        return backend.query_upload(upload['session'], size)
+    except Exception as error:
+        # e.g. an expired session
+        logger.info(f'Could not resume the upload: {error!r}')
+        return None
+
+
+def upload(backend, file_object, file_id: str, file_name: str, size: int,
+           cache_folder_path: Path, fingerprint: dict,
+           chunk_size: int=default_chunk_size,
+           expected_revision: str=None)->dict:
+    """Replace the content of a cloud file with the one of `file_object`
+
+    The content is sent by chunks of `chunk_size` bytes, resuming the
+    previous upload if it was interrupted. Backends without resumable
+    uploads get the whole content with `Backend.upload_from`.
+
+    Args:
+        backend (Backend): where the cloud file is
+        file_object: readable, seekable binary file, at its beginning
+        file_id (str): id of the cloud file
+        file_name (str): name to give to the cloud file
+        size (int): number of bytes to upload from `file_object`
+        cache_folder_path (Path): where to save the upload session
+        fingerprint (dict): stat-fingerprint of the uploaded file, telling
+            if the content of an interrupted upload changed since
+        chunk_size (int): size of the uploaded chunks, in bytes. Rounded to
+            the chunk granularity of the backend.
+        expected_revision (str): `headRevisionId` the cloud file must still
+            have, else `backends.RevisionMismatch` is raised. Defaults to
+            replacing whatever revision.
+
+    Returns:
+        the metadata of the updated cloud file
+    """
+    saved_upload = config.state_store().get_entry(cache_folder_path,
+                                                  'upload.json')
+    saved_upload = None if saved_upload is None else json.loads(saved_upload)
+    status = _resume(backend, saved_upload, file_id, size, fingerprint,
+                     expected_revision)
+    if status is not None:
+        upload_state = saved_upload
+        logger.info(f'Resuming the upload at byte {status[0]}')
+    else:
+        try:
+            session = backend.start_upload(file_id, file_name, size,
+                                           expected_revision)
+        except NotImplementedError:
+            return backend.upload_from(file_object, file_id, file_name,
+                                       expected_revision)
+        upload_state = dict(session=session, file_id=file_id, size=size,
+                            fingerprint=fingerprint, offset=0,
+                            expected_revision=expected_revision)
+        status = 0, None
+        _save(cache_folder_path, upload_state)
+
+    granularity = backend.chunk_granularity
+    chunk_size = max(granularity, chunk_size // granularity * granularity)
+    offset, metadata = status
+    failures = 0
+    while metadata is None:
+        file_object.seek(offset)
+        data = file_object.read(min(chunk_size, size - offset))
+        if offset + len(data) < size and len(data) < chunk_size:
+            _save(cache_folder_path, None)
+            raise RuntimeError('The file was truncated while uploading it')
+        try:
+            offset, metadata = backend.upload_chunk(
+                upload_state['session'], data, offset, size)
+        except RevisionMismatch:
+            # The session is over
+            _save(cache_folder_path, None)
+            raise
+        except Exception as error:
+            if not is_retryable(error) or failures >= max_chunk_failures:
+                raise
+            failures += 1
+            # Part of the chunk may have been received
+            offset, metadata = backend.query_upload(
+                upload_state['session'], size)
+        upload_state['offset'] = offset
+        if metadata is None:
+            _save(cache_folder_path, upload_state)
+    _save(cache_folder_path, None)
+    return metadata
@@ -5,8 +5,8 @@
 import logging
 from pathlib import Path
 
-from google_services._utilities import logger
-
+logger = logging.getLogger('keypass_sync')
+logger.addHandler(logging.StreamHandler())
 logger.setLevel(logging.ERROR)
 
 
@@ -0,0 +1,235 @@
+"""Long-running sync: watch the local files, poll the cloud ones
+
+Local changes are detected with inotify when available (linux), else by
+polling the stat-fingerprint of the files. A folder (see
+`keypass_sync.folders`) changes when one of the files it syncs does.
+Programs like keypass write a
+burst of changes when saving: a file is only synced once it has been quiet
+for `debounce` seconds. The cloud files are checked on a separate, slower
+schedule.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+from pathlib import Path
+
+from keypass_sync import config
+from keypass_sync.folders import list_local_files
+from keypass_sync.sync_utils import get_fingerprint, sync_all
+from keypass_sync.utilities import logger
+
+# inotify constants, from <sys/inotify.h>
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_event_header = struct.Struct('iIII')
+
+
+class PollingWatcher:
+    """Detect changes of files by polling their stat-fingerprint
+
+    Args:
+        paths (list of Path): files or folders to watch
+        interval (float): time between two polls, in seconds
+    """
+    def __init__(self, paths, interval: float=1.):
+        self.interval = interval
+        self._fingerprints = {path: self._fingerprint(path) for path in paths}
+
+    @staticmethod
+    def _fingerprint(path: Path):
+        try:
+            if path.is_dir():
+                return {name: get_fingerprint(file_path) for name, file_path
+                        in list_local_files(path).items()}
+            return get_fingerprint(path)
+        except FileNotFoundError:
+            return None
+
+    def wait(self, timeout: float)->set:
+        """Wait at most `timeout` seconds for files to change
+
+        Args:
+            timeout (float): in seconds
+
+        Returns:
+            set of the changed paths
+        """
+        time.sleep(max(0., min(timeout, self.interval)))
+        changed = set()
+        for path, fingerprint in self._fingerprints.items():
+            new_fingerprint = self._fingerprint(path)
+            if new_fingerprint != fingerprint:
+                self._fingerprints[path] = new_fingerprint
+                changed.add(path)
+        return changed
+
+    def close(self)->None:
+        pass
+
+
+class InotifyWatcher:
+    """Detect changes of files with inotify
+
+    The parent folders are watched rather than the files themselves, so
+    that files replaced by a rename (atomic saves) are still followed. The
+    watched folders are also watched themselves: a change of one of the
+    files they sync is a change of the folder.
+
+    Args:
+        paths (list of Path): files or folders to watch
+
+    Raises:
+        OSError if inotify is not available
+    """
+    def __init__(self, paths):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self._file_descriptor = libc.inotify_init1(
+            os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._file_descriptor < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self._paths = {}
+        # Watched folders, by watch descriptor
+        self._folders = {}
+        for path in paths:
+            self._paths[(self._add_watch(libc, path.parent), path.name)] = path
+            if path.is_dir():
+                self._folders[self._add_watch(libc, path)] = path
+
+    def _add_watch(self, libc, folder_path: Path)->int:
+        """Watch the changes of the files of a folder
+
+        Returns:
+            the watch descriptor, the same for a folder watched twice
+        """
+        watch_descriptor = libc.inotify_add_watch(
+            self._file_descriptor, os.fsencode(str(folder_path)),
+            _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE)
+        if watch_descriptor < 0:
+            error_number = ctypes.get_errno()
+            self.close()
+            raise OSError(error_number,
+                          f'inotify_add_watch failed for {folder_path}')
+        return watch_descriptor
+
+    def wait(self, timeout: float)->set:
+        """Wait at most `timeout` seconds for files to change
+
+        Args:
+            timeout (float): in seconds
+
+        Returns:
+            set of the changed paths
+        """
+        readable, _, _ = select.select(
+            [self._file_descriptor], [], [], max(0., timeout))
+        if not readable:
+            return set()
+
+        changed = set()
+        buffer = os.read(self._file_descriptor, 64 * 1024)
+        offset = 0
+        while offset < len(buffer):
+            watch_descriptor, _, _, name_length = _event_header.unpack_from(
+                buffer, offset)
+            offset += _event_header.size
+            name = os.fsdecode(
+                buffer[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+            if (watch_descriptor, name) in self._paths:
+                changed.add(self._paths[(watch_descriptor, name)])
+            if watch_descriptor in self._folders and name \
+                    and not name.startswith('.'):
+                # Hidden files are not synced (see `folders.list_local_files`)
+                changed.add(self._folders[watch_descriptor])
+        return changed
+
+    def close(self)->None:
+        os.close(self._file_descriptor)
+
+
+def make_watcher(paths):
+    """Return an inotify watcher for `paths`, or a polling one as fallback
+
+    Args:
+        paths (list of Path): files or folders to watch
+
+    Returns:
+        InotifyWatcher or PollingWatcher
+    """
+    try:
+        return InotifyWatcher(paths)
+    except OSError as error:
+        logger.info(f'Falling back to polling the local files: {error}')
+        return PollingWatcher(paths)
+
+
+def watch(versions: list=None, debounce: float=.5,
+          remote_poll_interval: float=60., backend=None,
+          stop_event: threading.Event=None)->None:
+    """Keep the files of several config versions synced until stopped
+
+    A version is synced `debounce` seconds after the last change of its
+    local file, and every `remote_poll_interval` seconds to catch the
+    changes made on the cloud.
+
+    Args:
+        versions (list): versions of the configuration to sync. Defaults to
+            every version saved on this machine.
+        debounce (float): quiet time to wait after a local change, in seconds
+        remote_poll_interval (float): time between two checks of the cloud
+            files, in seconds
+        backend (Backend): where the cloud files are (see
+            `sync_utils.sync_version`)
+        stop_event (threading.Event): stop watching once set
+    """
+    if versions is None:
+        versions = config.list_versions()
+    stop_event = stop_event or threading.Event()
+
+    versions_by_path = {}
+    for version in versions:
+        local_file_path = config.load_profile(version)['local_file_path']
+        versions_by_path.setdefault(local_file_path, []).append(version)
+    watcher = make_watcher(list(versions_by_path))
+    logger.info(f'Watching {len(versions_by_path)} file(s)')
+
+    deadlines = {}
+    next_remote_poll = time.monotonic()
+    try:
+        while not stop_event.is_set():
+            now = time.monotonic()
+            # Wake up regularly to check the stop event
+            timeout = min([next_remote_poll, now + 1.]
+                          + list(deadlines.values())) - now
+            for path in watcher.wait(timeout):
+                deadlines[path] = time.monotonic() + debounce
+
+            now = time.monotonic()
+            due = set()
+            for path, deadline in list(deadlines.items()):
+                if deadline <= now:
+                    due.update(versions_by_path[path])
+                    del deadlines[path]
+            if now >= next_remote_poll:
+                # Files still being written are synced once they are quiet
+                due.update(version for path, path_versions
+                           in versions_by_path.items()
+                           if path not in deadlines
+                           for version in path_versions)
+                next_remote_poll = now + remote_poll_interval
+            if due:
+                for version, result in sync_all(
+                        sorted(due), backend=backend).items():
+                    logger.info(f'{version}: {result}')
+    finally:
+        watcher.close()
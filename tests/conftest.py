@@ -0,0 +1,11 @@
+import pytest
+
+from keypass_sync import config
+
+
+@pytest.fixture(autouse=True)
+def config_folder(tmp_path_factory, monkeypatch):
+    """Keep the state store out of the user's config folder"""
+    config_path = tmp_path_factory.mktemp('config')
+    monkeypatch.setattr(config, 'default_config_path', str(config_path) + '/')
+    return config_path
@@ -0,0 +1,124 @@
+import io
+import threading
+import time
+
+import pytest
+
+from keypass_sync.backends import RevisionMismatch
+from keypass_sync.backends.local import LocalDirectoryBackend
+from keypass_sync.backends.memory import InMemoryBackend
+
+
+@pytest.fixture(params=['local', 'memory'])
+def backend(request, tmp_path):
+    if request.param == 'local':
+        (tmp_path / 'id').write_bytes(b'content')
+        return LocalDirectoryBackend(tmp_path)
+    return InMemoryBackend(dict(id=b'content'), chunk_size=3)
+
+
+def test_backend_round_trip(backend):
+    metadata = backend.get_metadata('id')
+    assert metadata['id'] == 'id'
+    assert metadata['size'] == '7'
+    assert backend.download('id') == b'content'
+
+    new_metadata = backend.upload_from(io.BytesIO(b'new content'), 'id',
+                                       file_name='db.kdbx')
+    assert new_metadata['headRevisionId'] != metadata['headRevisionId']
+    assert new_metadata == backend.get_metadata('id')
+    assert backend.download('id') == b'new content'
+
+
+def test_conditional_uploads(backend):
+    revision = backend.get_metadata('id')['headRevisionId']
+    new_metadata = backend.upload(b'new content', 'id', 'db.kdbx',
+                                  expected_revision=revision)
+    with pytest.raises(RevisionMismatch):
+        backend.upload(b'lost update', 'id', 'db.kdbx',
+                       expected_revision=revision)
+    assert backend.download('id') == b'new content'
+    assert backend.get_metadata('id') == new_metadata
+
+
+def test_concurrent_conditional_uploads_replace_the_file_once(backend):
+    revision = backend.get_metadata('id')['headRevisionId']
+    get_metadata = backend.get_metadata
+
+    def slow_get_metadata(file_id: str)->dict:
+        # Lets the other upload check the revision in between
+        metadata = get_metadata(file_id)
+        time.sleep(.1)
+        return metadata
+
+    backend.get_metadata = slow_get_metadata
+    barrier = threading.Barrier(2)
+    results = []
+
+    def upload(data: bytes)->None:
+        barrier.wait()
+        try:
+            backend.upload(data, 'id', 'db.kdbx', expected_revision=revision)
+            results.append(data)
+        except RevisionMismatch:
+            results.append(None)
+
+    uploads = [threading.Thread(target=upload, args=(data,))
+               for data in (b'first', b'second')]
+    for thread in uploads:
+        thread.start()
+    for thread in uploads:
+        thread.join()
+    assert results.count(None) == 1
+    assert backend.download('id') in results
+
+
+def test_in_memory_backend_injects_errors():
+    backend = InMemoryBackend(dict(id=b'content'))
+    backend.fail_next(2)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            backend.get_metadata('id')
+    assert backend.get_metadata('id')['size'] == '7'
+    assert backend.calls['get_metadata'] == 3
+
+    backend = InMemoryBackend(dict(id=b'content'), error_rate=1.,
+                              error=TimeoutError)
+    with pytest.raises(TimeoutError):
+        backend.download('id')
+
+
+def test_in_memory_backend_replays_its_change_log():
+    backend = InMemoryBackend(dict(first=b'content'), changes_page_size=2)
+    page_token = backend.get_start_page_token()
+    assert backend.list_changes(page_token) == (set(), page_token)
+
+    backend.put('first', b'new content')
+    backend.put('second', b'content')
+    backend.record_change('third')
+    changed_file_ids, page_token = backend.list_changes(page_token)
+    assert changed_file_ids == {'first', 'second', 'third'}
+    assert backend.calls['list_changes'] == 3
+    assert backend.list_changes(page_token)[0] == set()
+
+
+def test_in_memory_backend_fetches_metadata_in_batches():
+    backend = InMemoryBackend({str(index): b'content' for index in range(200)})
+    results = backend.get_metadata_batch(
+        [str(index) for index in range(200)] + ['missing'])
+    assert backend.calls['get_metadata_batch'] == 3
+    assert results['42'] == backend.get_metadata('42')
+    assert isinstance(results['missing'], FileNotFoundError)
+
+
+def test_backends_fetch_metadata_one_by_one_without_batches(backend):
+    results = backend.get_metadata_batch(['id', 'missing'])
+    assert results['id'] == backend.get_metadata('id')
+    assert isinstance(results['missing'], FileNotFoundError)
+
+
+def test_backend_folders(backend):
+    assert backend.list_folder('folder') == {}
+    metadata = backend.create_file(io.BytesIO(b'chunk'), 'folder', 'name')
+    assert backend.list_folder('folder') == {'name': metadata['id']}
+    assert backend.download(metadata['id']) == b'chunk'
@@ -0,0 +1,180 @@
+import io
+import random
+
+import pytest
+
+from keypass_sync import chunking, hashing, sync_utils
+from keypass_sync.backends.local import LocalDirectoryBackend
+from keypass_sync.backends.memory import InMemoryBackend
+
+average_size = 1024
+
+
+def random_bytes(size: int, seed: int=0)->bytes:
+    return random.Random(seed).getrandbits(8 * size).to_bytes(size, 'big')
+
+
+def test_chunks_only_change_around_an_edit():
+    data = random_bytes(64 * 1024)
+    chunks = list(chunking.iter_chunks(io.BytesIO(data), average_size))
+    assert b''.join(chunks) == data
+    assert all(average_size // 4 <= len(chunk) <= average_size * 4
+               for chunk in chunks[:-1])
+
+    edited = data[:30000] + b'edit' + data[30000:]
+    edited_chunks = list(chunking.iter_chunks(io.BytesIO(edited),
+                                              average_size))
+    assert b''.join(edited_chunks) == edited
+    assert len(set(edited_chunks) - set(chunks)) <= 2
+    assert list(chunking.iter_chunks(io.BytesIO(b''), average_size)) == []
+
+
+@pytest.mark.parametrize('size', [64, 1024, 64 * 1024])
+def test_cut_points_are_the_same_with_numpy(size):
+    numpy = pytest.importorskip('numpy')
+    data = bytearray(random_bytes(20 * size, seed=size))
+    while data:
+        cut = chunking._cut_point_numpy(numpy, data, size)
+        assert cut == chunking._cut_point_python(data, size)
+        del data[:cut]
+
+
+def test_chunked_uploads_hash_each_chunk_once(tmp_path, monkeypatch):
+    local_file_path = tmp_path / 'db.kdbx'
+    local_file_path.write_bytes(random_bytes(64 * 1024))
+    hashed = []
+    chunk_hash = chunking.chunk_hash
+    monkeypatch.setattr(chunking, 'chunk_hash',
+                        lambda data: hashed.append(len(data))
+                        or chunk_hash(data))
+    backend = InMemoryBackend(dict(db=b''))
+    _, manifest, bytes_uploaded = chunking.upload(
+        backend, local_file_path, 'db', 'chunks', 'db.kdbx', average_size)
+    assert sum(hashed) == bytes_uploaded == 64 * 1024
+    assert len(hashed) == len(manifest['chunks'])
+    assert all(chunk_id is not None for _, _, chunk_id in manifest['chunks'])
+
+
+def test_manifests_are_recognized():
+    manifest = dict(format=chunking.manifest_format, size=0,
+                    hash=hashing.hash_data(b''), chunks=[])
+    assert chunking.read_manifest(repr(manifest).replace("'", '"')
+                                  .encode()) == manifest
+    with pytest.raises(ValueError):
+        chunking.read_manifest(b'\x03\xd9\xa2\x9a kdbx content')
+
+
+def test_chunked_sync_with_a_local_backend(tmp_path):
+    backend = LocalDirectoryBackend(tmp_path / 'cloud')
+    first_file_path = tmp_path / 'first' / 'db.kdbx'
+    second_file_path = tmp_path / 'second' / 'db.kdbx'
+    first_file_path.parent.mkdir()
+    second_file_path.parent.mkdir()
+    first_file_path.write_bytes(random_bytes(32 * 1024))
+    options = dict(backend=backend, chunk_folder_id='chunks',
+                   chunk_average_size=average_size)
+
+    sync_utils.update_cloud_chunked(
+        first_file_path, 'db', 'chunks', tmp_path / 'first_cache',
+        backend=backend, average_size=average_size)
+    chunk_count = len(backend.list_folder('chunks'))
+    assert chunk_count > 10
+    # As `force-update local` does
+    manifest = chunking.fetch_manifest(backend, 'db')
+    downloaded_file_path, data_hash = sync_utils.download_chunks_next_to(
+        second_file_path, manifest, tmp_path / 'second_cache', backend)
+    sync_utils.update_local(second_file_path, downloaded_file_path,
+                            tmp_path / 'second_cache',
+                            backend.get_metadata('db'), data_hash, manifest)
+    assert second_file_path.read_bytes() == first_file_path.read_bytes()
+
+    data = second_file_path.read_bytes()
+    second_file_path.write_bytes(data[:1000] + b'edit' + data[1000:])
+    assert sync_utils.sync(second_file_path, 'db', tmp_path / 'second_cache',
+                           **options) == sync_utils.uploaded
+    assert len(backend.list_folder('chunks')) <= chunk_count + 2
+    assert sync_utils.sync(first_file_path, 'db', tmp_path / 'first_cache',
+                           **options) == sync_utils.downloaded
+    assert first_file_path.read_bytes() == second_file_path.read_bytes()
+    assert sync_utils.sync(first_file_path, 'db', tmp_path / 'first_cache',
+                           **options) == sync_utils.up_to_date
+
+
+def test_chunked_sync_only_transfers_the_changed_chunks(tmp_path):
+    backend = InMemoryBackend(dict(db=b''))
+    local_file_path = tmp_path / 'db.kdbx'
+    data = random_bytes(64 * 1024)
+    local_file_path.write_bytes(data)
+    options = dict(backend=backend, chunk_folder_id='chunks',
+                   chunk_average_size=average_size)
+    sync_utils.update_cloud_chunked(local_file_path, 'db', 'chunks',
+                                    tmp_path / 'cache', backend=backend,
+                                    average_size=average_size)
+    assert backend.bytes_uploaded > len(data)
+
+    local_file_path.write_bytes(data[:50000] + b'edit' + data[50000:])
+    bytes_uploaded = backend.bytes_uploaded
+    assert sync_utils.sync(local_file_path, 'db', tmp_path / 'cache',
+                           **options) == sync_utils.uploaded
+    manifest_size = int(backend.get_metadata('db')['size'])
+    assert backend.bytes_uploaded - bytes_uploaded - manifest_size \
+        <= 2 * 4 * average_size
+
+    # Another client edits the file
+    other_file_path = tmp_path / 'other.kdbx'
+    other_file_path.write_bytes(data[:10000] + data[10004:50000] + b'edit'
+                                + data[50000:])
+    sync_utils.update_cloud_chunked(other_file_path, 'db', 'chunks',
+                                    tmp_path / 'other_cache',
+                                    backend=backend,
+                                    average_size=average_size)
+    bytes_downloaded = backend.bytes_downloaded
+    assert sync_utils.sync(local_file_path, 'db', tmp_path / 'cache',
+                           **options) == sync_utils.downloaded
+    assert local_file_path.read_bytes() == other_file_path.read_bytes()
+    assert backend.bytes_downloaded - bytes_downloaded - manifest_size \
+        <= 2 * 4 * average_size
+
+
+def test_chunked_sync_needs_a_manifest(tmp_path):
+    backend = InMemoryBackend(dict(db=b'content'))
+    local_file_path = tmp_path / 'db.kdbx'
+    local_file_path.write_bytes(b'content')
+    with pytest.raises(SystemExit):
+        sync_utils.sync(local_file_path, 'db', tmp_path / 'cache',
+                        backend=backend, chunk_folder_id='chunks')
+
+
+def test_oversize_manifests_are_not_downloaded(monkeypatch):
+    monkeypatch.setattr(chunking, 'max_manifest_size', 16)
+    backend = InMemoryBackend(dict(db=b'a kdbx database, not a manifest'))
+    with pytest.raises(ValueError):
+        chunking.fetch_manifest(backend, 'db')
+    assert backend.bytes_downloaded == 0
+
+    # Without its size in the metadata, only the start of the file is read
+    with pytest.raises(ValueError):
+        chunking.fetch_manifest(backend, 'db', dict(id='db'))
+    assert backend.bytes_downloaded == 17
+
+
+def test_chunked_sync_between_hash_algorithms(tmp_path):
+    backend = InMemoryBackend(dict(db=b''))
+    local_file_path = tmp_path / 'db.kdbx'
+    local_file_path.write_bytes(random_bytes(8 * 1024))
+    options = dict(backend=backend, chunk_folder_id='chunks',
+                   chunk_average_size=average_size)
+    sync_utils.update_cloud_chunked(local_file_path, 'db', 'chunks',
+                                    tmp_path / 'cache', backend=backend,
+                                    average_size=average_size)
+
+    other_file_path = tmp_path / 'other.kdbx'
+    other_file_path.write_bytes(random_bytes(8 * 1024, seed=1))
+    sync_utils.update_cloud_chunked(other_file_path, 'db', 'chunks',
+                                    tmp_path / 'other_cache',
+                                    backend=backend,
+                                    average_size=average_size,
+                                    algorithm='blake2b')
+    assert sync_utils.sync(local_file_path, 'db', tmp_path / 'cache',
+                           **options) == sync_utils.downloaded
+    assert local_file_path.read_bytes() == other_file_path.read_bytes()
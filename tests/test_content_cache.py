@@ -0,0 +1,105 @@
+import os
+
+from keypass_sync import config, sync_utils
+from keypass_sync.backends.memory import InMemoryBackend
+from keypass_sync.hashing import hash_data
+
+
+def write_old_file(path, data: bytes)->None:
+    """Write a file, old enough for its fingerprint to be trusted"""
+    path.write_bytes(data)
+    os.utime(path, ns=(0, 0))
+
+
+def test_content_cache_evicts_the_least_recently_used_contents(tmp_path):
+    content_cache = config.content_cache(max_size=10)
+    for data in (b'aaaa', b'bbbb'):
+        (tmp_path / 'content').write_bytes(data)
+        content_cache.put(tmp_path / 'content', hash_data(data), 'id',
+                          dict(headRevisionId=data.decode()))
+    copied_file_path, data_hash = content_cache.copy_next_to(
+        hash_data(b'aaaa'), tmp_path / 'local')
+    assert copied_file_path.read_bytes() == b'aaaa'
+    assert data_hash == hash_data(b'aaaa')
+
+    (tmp_path / 'content').write_bytes(b'cccc')
+    content_cache.put(tmp_path / 'content', hash_data(b'cccc'))
+    assert content_cache.lookup('id', dict(headRevisionId='aaaa')) \
+        == hash_data(b'aaaa')
+    assert content_cache.lookup('id', dict(headRevisionId='bbbb')) is None
+    assert content_cache.copy_next_to(hash_data(b'bbbb'),
+                                      tmp_path / 'local') is None
+
+    # Larger than the whole cache
+    (tmp_path / 'content').write_bytes(b'd' * 11)
+    assert not content_cache.put(tmp_path / 'content', hash_data(b'd' * 11))
+
+
+def test_content_cache_drops_corrupted_contents(tmp_path):
+    content_cache = config.content_cache()
+    (tmp_path / 'content').write_bytes(b'data')
+    content_cache.put(tmp_path / 'content', hash_data(b'data'), 'id',
+                      dict(headRevisionId='1'))
+    content_cache.path_of(hash_data(b'data')).write_bytes(b'tampered')
+
+    assert content_cache.copy_next_to(hash_data(b'data'),
+                                      tmp_path / 'local') is None
+    assert content_cache.lookup('id', dict(headRevisionId='1')) is None
+    assert [path.name for path in tmp_path.iterdir()] == ['content']
+
+
+def test_content_cache_converts_the_hash_algorithm(tmp_path):
+    content_cache = config.content_cache()
+    (tmp_path / 'content').write_bytes(b'data')
+    content_cache.put(tmp_path / 'content', hash_data(b'data', 'sha3_512'))
+
+    _, data_hash = content_cache.copy_next_to(
+        hash_data(b'data', 'sha3_512'), tmp_path / 'local', 'blake2b')
+    assert data_hash == hash_data(b'data', 'blake2b')
+
+
+def test_sync_serves_known_revisions_from_the_content_cache(tmp_path):
+    backend = InMemoryBackend({'id': b'old'})
+    content_cache = config.content_cache()
+    local_file_paths = [tmp_path / 'first.kdbx', tmp_path / 'second.kdbx']
+    cache_folder_paths = [tmp_path / 'first', tmp_path / 'second']
+    for local_file_path, cache_folder_path in zip(local_file_paths,
+                                                  cache_folder_paths):
+        write_old_file(local_file_path, b'old')
+        sync_utils.sync(local_file_path, 'id', cache_folder_path,
+                        backend=backend, content_cache=content_cache)
+
+    # The first profile downloads the new revision, the second copies it
+    backend.put('id', b'new')
+    bytes_downloaded = backend.bytes_downloaded
+    assert sync_utils.sync(local_file_paths[0], 'id', cache_folder_paths[0],
+                           backend=backend, content_cache=content_cache) \
+        == sync_utils.downloaded
+    assert backend.bytes_downloaded == bytes_downloaded + 3
+    assert sync_utils.sync(local_file_paths[1], 'id', cache_folder_paths[1],
+                           backend=backend, content_cache=content_cache) \
+        == sync_utils.downloaded
+    assert backend.bytes_downloaded == bytes_downloaded + 3
+    assert local_file_paths[1].read_bytes() == b'new'
+
+    # An uploaded revision is not downloaded by `force-update local`
+    write_old_file(local_file_paths[0], b'newer')
+    assert sync_utils.sync(local_file_paths[0], 'id', cache_folder_paths[0],
+                           backend=backend, content_cache=content_cache) \
+        == sync_utils.uploaded
+    downloaded_file_path, data_hash = sync_utils.download_next_to(
+        local_file_paths[1], 'id', backend, backend.get_metadata('id'),
+        content_cache=content_cache)
+    assert downloaded_file_path.read_bytes() == b'newer'
+    assert data_hash == hash_data(b'newer')
+    assert backend.bytes_downloaded == bytes_downloaded + 3
+    downloaded_file_path.unlink()
+
+
+def test_the_content_cache_is_opt_in(tmp_path):
+    config.state_store().put_config('db', dict(
+        local_file_path=str(tmp_path / 'db.kdbx'), cloud_file_id='id'))
+    assert config.sync_options('db')['content_cache'] is None
+
+    config.set_option('content_cache_size', '1000', 'db')
+    assert config.sync_options('db')['content_cache'].max_size == 1000
@@ -0,0 +1,119 @@
+import io
+import os
+
+from keypass_sync import config, folders, sync_utils
+from keypass_sync.backends.memory import InMemoryBackend
+
+
+def write_old_file(path, data: bytes)->None:
+    """Write a file, old enough for its fingerprint to be trusted"""
+    path.write_bytes(data)
+    os.utime(path, ns=(0, 0))
+
+
+def test_folder_sync_transfers_the_changed_files(tmp_path):
+    local_folder_path = tmp_path / 'folder'
+    local_folder_path.mkdir()
+    write_old_file(local_folder_path / 'db.kdbx', b'database')
+    write_old_file(local_folder_path / 'key.keyx', b'key')
+    (local_folder_path / '.db.kdbx.lock').write_bytes(b'')
+    backend = InMemoryBackend()
+    backend.create_file(io.BytesIO(b'attachment'), 'cloud', 'file.pdf')
+    cache_folder_path = tmp_path / 'cache'
+
+    assert folders.sync_folder(local_folder_path, 'cloud', cache_folder_path,
+                               backend) == {'db.kdbx': sync_utils.uploaded,
+                                            'key.keyx': sync_utils.uploaded,
+                                            'file.pdf': sync_utils.downloaded}
+    assert (local_folder_path / 'file.pdf').read_bytes() == b'attachment'
+    assert sorted(backend.list_folder('cloud')) \
+        == ['db.kdbx', 'file.pdf', 'key.keyx']
+    os.utime(local_folder_path / 'file.pdf', ns=(0, 0))
+    sync_utils.sync(local_folder_path / 'file.pdf', 'cloud/file.pdf',
+                    folders.file_cache_path(cache_folder_path, 'file.pdf'),
+                    backend=backend)
+
+    # Nothing changed: one listing and one batch of metadata
+    calls = backend.calls.copy()
+    assert folders.sync_folder(local_folder_path, 'cloud', cache_folder_path,
+                               backend) == {}
+    assert backend.calls - calls == dict(list_folder=1, get_metadata_batch=1)
+
+    write_old_file(local_folder_path / 'key.keyx', b'new key')
+    backend.put('cloud/db.kdbx', b'new database')
+    results = folders.sync_folder(local_folder_path, 'cloud',
+                                  cache_folder_path, backend)
+    assert results == {'db.kdbx': sync_utils.downloaded,
+                       'key.keyx': sync_utils.uploaded}
+    assert folders.summarize(results) == folders.uploaded_and_downloaded
+    assert (local_folder_path / 'db.kdbx').read_bytes() == b'new database'
+    assert backend.get('cloud/key.keyx') == b'new key'
+
+
+def test_folder_sync_detects_conflicts_file_by_file(tmp_path):
+    local_folder_path = tmp_path / 'folder'
+    local_folder_path.mkdir()
+    write_old_file(local_folder_path / 'db.kdbx', b'database')
+    write_old_file(local_folder_path / 'key.keyx', b'key')
+    backend = InMemoryBackend()
+    cache_folder_path = tmp_path / 'cache'
+    folders.sync_folder(local_folder_path, 'cloud', cache_folder_path,
+                        backend)
+
+    write_old_file(local_folder_path / 'db.kdbx', b'local database')
+    backend.put('cloud/db.kdbx', b'remote database')
+    backend.put('cloud/key.keyx', b'new key')
+    results = folders.sync_folder(local_folder_path, 'cloud',
+                                  cache_folder_path, backend, max_workers=2)
+    assert results == {'db.kdbx': sync_utils.failed,
+                       'key.keyx': sync_utils.downloaded}
+    assert folders.summarize(results) == sync_utils.failed
+    assert (local_folder_path / 'db.kdbx').read_bytes() == b'local database'
+    assert (local_folder_path / 'key.keyx').read_bytes() == b'new key'
+
+    # The conflict is reported again until it is solved
+    results = folders.sync_folder(local_folder_path, 'cloud',
+                                  cache_folder_path, backend)
+    assert results['db.kdbx'] == sync_utils.failed
+    assert folders.summarize(results) == sync_utils.failed
+
+
+def test_folder_sync_skips_hostile_cloud_names(tmp_path):
+    local_folder_path = tmp_path / 'folder'
+    local_folder_path.mkdir()
+    backend = InMemoryBackend()
+    for name in ('../escaped.txt', '.hidden', '..', 'db.kdbx'):
+        backend.create_file(io.BytesIO(b'content'), 'cloud', name)
+    cache_folder_path = tmp_path / 'cache'
+
+    skipped = dict.fromkeys(['..', '../escaped.txt', '.hidden'],
+                            folders.skipped)
+    assert folders.sync_folder(local_folder_path, 'cloud', cache_folder_path,
+                               backend) \
+        == dict(skipped, **{'db.kdbx': sync_utils.downloaded})
+    # Reported again, without failing the folder
+    results = folders.sync_folder(local_folder_path, 'cloud',
+                                  cache_folder_path, backend)
+    assert results.pop('db.kdbx', None) in (None, sync_utils.up_to_date)
+    assert results == skipped
+    assert folders.summarize(results) == sync_utils.up_to_date
+    assert not (tmp_path / 'escaped.txt').exists()
+    assert [path.name for path in local_folder_path.iterdir()] \
+        == ['db.kdbx']
+
+
+def test_sync_all_syncs_folder_profiles(tmp_path, config_folder):
+    (config_folder / 'SSO').mkdir()
+    (config_folder / 'SSO' / 'token.json').write_text('{}')
+    local_folder_path = tmp_path / 'folder'
+    local_folder_path.mkdir()
+    (local_folder_path / 'db.kdbx').write_bytes(b'database')
+    config.set_option('credential_folder_path', str(config_folder / 'SSO'),
+                      'folder')
+    config.set_option('local_file_path', str(local_folder_path), 'folder')
+    config.set_option('cloud_file_id', 'cloud', 'folder')
+    backend = InMemoryBackend()
+
+    assert sync_utils.sync_all(backend=backend) \
+        == dict(folder=sync_utils.uploaded)
+    assert backend.get('cloud/db.kdbx') == b'database'
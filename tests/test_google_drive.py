@@ -0,0 +1,133 @@
+import json
+import logging
+
+import pytest
+
+from keypass_sync.backends import RevisionMismatch
+
+# Needs the google-api stack and google_services
+google_drive = pytest.importorskip('keypass_sync.backends.google_drive')
+googleapiclient_http = pytest.importorskip('googleapiclient.http')
+
+metadata = dict(id='id', md5Checksum='md5', headRevisionId='2',
+                modifiedTime='2020-01-01T00:00:00.000Z', size='300000')
+
+
+class RecordingHttp(googleapiclient_http.HttpMockSequence):
+    """Answer the requests with the given responses, recording them"""
+    def __init__(self, responses: list):
+        super().__init__(responses)
+        self.requests = []
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        self.requests.append(dict(uri=uri, method=method, body=body,
+                                  headers=headers or {}))
+        return super().request(uri, method, body, headers, **kwargs)
+
+
+def mocked_backend(tmp_path, responses: list)->tuple:
+    """Return a backend sending its requests to a `RecordingHttp`
+
+    Returns:
+        (GoogleDriveBackend, RecordingHttp)
+    """
+    http = RecordingHttp(responses)
+    backend = google_drive.GoogleDriveBackend(tmp_path)
+    backend._credentials = google_drive.Credentials(token='token')
+    # The bundled discovery document: no request
+    backend._service_resource = google_drive.build(
+        'drive', 'v3', http=http, cache_discovery=False,
+        static_discovery=True)
+    backend._connections.put(http)
+    return backend, http
+
+
+def test_google_drive_metadata(tmp_path):
+    backend, http = mocked_backend(tmp_path, [
+        ({'status': '200'}, json.dumps(metadata))])
+    assert backend.get_metadata('id') == metadata
+    assert '/files/id?' in http.requests[0]['uri']
+    assert 'headRevisionId' in http.requests[0]['uri']
+
+
+def test_google_drive_resumable_uploads(tmp_path):
+    chunk_size = google_drive.GoogleDriveBackend.chunk_granularity
+    session = 'https://www.googleapis.com/upload/drive/v3/files/id?id=1'
+    backend, http = mocked_backend(tmp_path, [
+        ({'status': '200', 'location': session}, ''),
+        ({'status': '308', 'range': f'bytes=0-{chunk_size - 1}'}, ''),
+        # Interrupted: asking how far it went
+        ({'status': '308', 'range': f'bytes=0-{chunk_size - 1}'}, ''),
+        ({'status': '200'}, json.dumps(metadata))])
+    size = int(metadata['size'])
+    data = bytes(size)
+
+    assert backend.start_upload('id', 'db.kdbx', size) == session
+    assert http.requests[0]['method'] == 'PATCH'
+    assert http.requests[0]['headers']['X-Upload-Content-Length'] \
+        == str(size)
+    assert backend.upload_chunk(session, data[:chunk_size], 0, size) \
+        == (chunk_size, None)
+    assert http.requests[1]['headers']['Content-Range'] \
+        == f'bytes 0-{chunk_size - 1}/{size}'
+    assert backend.query_upload(session, size) == (chunk_size, None)
+    assert http.requests[2]['headers']['Content-Range'] == f'bytes */{size}'
+    assert backend.upload_chunk(session, data[chunk_size:], chunk_size,
+                                size) == (size, metadata)
+    assert http.requests[3]['headers']['Content-Range'] \
+        == f'bytes {chunk_size}-{size - 1}/{size}'
+
+
+def test_google_drive_uploads_check_the_revision(tmp_path):
+    backend, http = mocked_backend(tmp_path, [
+        ({'status': '200'}, json.dumps(dict(headRevisionId='2')))])
+    with pytest.raises(RevisionMismatch):
+        backend.start_upload('id', 'db.kdbx', 7, expected_revision='1')
+    # No upload was started
+    assert [request['method'] for request in http.requests] == ['GET']
+
+
+def test_google_drive_changes(tmp_path):
+    backend, http = mocked_backend(tmp_path, [
+        ({'status': '200'}, json.dumps(dict(
+            changes=[dict(fileId='a')], nextPageToken='2'))),
+        ({'status': '200'}, json.dumps(dict(
+            changes=[dict(fileId='b'), dict(fileId='a')],
+            newStartPageToken='3')))])
+    assert backend.list_changes('1') == ({'a', 'b'}, '3')
+    assert 'pageToken=1' in http.requests[0]['uri']
+    assert 'pageToken=2' in http.requests[1]['uri']
+
+
+def test_google_drive_token_is_created_from_the_client_id(tmp_path,
+                                                          monkeypatch):
+    flow_module = pytest.importorskip('google_auth_oauthlib.flow')
+    (tmp_path / 'client_id.json').write_text('{}')
+    credentials = google_drive.Credentials(
+        token='token', refresh_token='refresh token', client_id='client id',
+        client_secret='client secret',
+        token_uri='https://oauth2.googleapis.com/token')
+
+    class Flow:
+        @staticmethod
+        def from_client_secrets_file(path: str, scopes: list):
+            assert path == str(tmp_path / 'client_id.json')
+            assert scopes == google_drive.scopes
+            return Flow()
+
+        def run_local_server(self, **kwargs):
+            return credentials
+
+    monkeypatch.setattr(flow_module, 'InstalledAppFlow', Flow)
+    backend = google_drive.GoogleDriveBackend(tmp_path)
+    try:
+        backend._service()
+    finally:
+        backend.close()
+    assert backend._credentials is credentials
+    assert json.loads((tmp_path / 'token.json').read_text())[
+        'refresh_token'] == 'refresh token'
+
+
+def test_google_services_warnings_stay_visible():
+    assert google_drive.services_logger.isEnabledFor(logging.WARNING)
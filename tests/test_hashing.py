@@ -0,0 +1,63 @@
+import hashlib
+
+import pytest
+
+from keypass_sync import hashing
+
+
+def test_hash_file_matches_hash_of_content(tmp_path):
+    data = bytes(range(256)) * 1000
+    (tmp_path / 'file').write_bytes(data)
+    assert hashing.hash_file(tmp_path / 'file', chunk_size=1000) \
+        == 'sha256:' + hashlib.sha256(data).hexdigest()
+    assert hashing.hash_data(data) == 'sha256:' \
+        + hashlib.sha256(data).hexdigest()
+
+
+def test_hashes_tell_their_algorithm():
+    legacy_hash = hashing.hash_data(b'data', 'sha3_512')
+    assert legacy_hash == hashlib.sha3_512(b'data').hexdigest()
+    assert hashing.algorithm_of(legacy_hash) == 'sha3_512'
+    blake2b_hash = hashing.hash_data(b'data', 'blake2b')
+    assert blake2b_hash == 'blake2b:' + hashlib.blake2b(b'data').hexdigest()
+    assert hashing.algorithm_of(blake2b_hash) == 'blake2b'
+    with pytest.raises(ValueError):
+        hashing.new_hasher('md4')
+
+
+def test_hashing_writer(tmp_path):
+    with (tmp_path / 'file').open('wb') as file:
+        writer = hashing.HashingWriter(file)
+        writer.write(b'some ')
+        writer.write(b'data')
+    assert writer.bytes_written == 9
+    assert writer.hexdigest() == hashing.hash_data(b'some data')
+    assert (tmp_path / 'file').read_bytes() == b'some data'
+
+
+def test_hash_cache_hashes_each_buffer_once(monkeypatch):
+    calls = []
+    hash_data = hashing.hash_data
+    monkeypatch.setattr(hashing, 'hash_data',
+                        lambda data, *args: calls.append(data)
+                        or hash_data(data, *args))
+    hashes = hashing.HashCache()
+    data = bytearray(b'data')
+    assert hashes.of_data(data) == hashes.of_data(data)
+    assert len(calls) == 1
+
+
+def test_hashing_reader_hashes_re_read_data_once(tmp_path):
+    (tmp_path / 'file').write_bytes(b'some data')
+    with (tmp_path / 'file').open('rb') as file:
+        reader = hashing.HashingReader(file)
+        assert reader.read(4) == b'some'
+        reader.seek(2)
+        assert reader.read(4) == b'me d'
+        assert reader.hexdigest() == hashing.hash_data(b'some data')
+
+    with (tmp_path / 'file').open('rb') as file:
+        reader = hashing.HashingReader(file)
+        reader.seek(5)
+        assert reader.read() == b'data'
+        assert reader.hexdigest(4) == hashing.hash_data(b'some')
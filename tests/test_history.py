@@ -0,0 +1,163 @@
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+import keypass_sync
+from keypass_sync import config, history, sync_utils
+from keypass_sync.backends.memory import InMemoryBackend
+from keypass_sync.hashing import hash_data
+
+
+def write_old_file(path, data: bytes)->None:
+    """Write a file, old enough for its fingerprint to be trusted"""
+    path.write_bytes(data)
+    os.utime(path, ns=(0, 0))
+
+
+def test_snapshots_are_deduplicated_and_retained(tmp_path):
+    # The contents no snapshot refers to are evicted at once
+    snapshots = config.history(keep=3, content_cache_size=0)
+    local_file_path = tmp_path / 'db.kdbx'
+    cache_folder_path = tmp_path / 'cache'
+    for data in (b'first', b'first', b'second', b'first'):
+        local_file_path.write_bytes(data)
+        snapshots.snapshot(local_file_path, local_file_path,
+                           cache_folder_path, history.uploaded)
+    assert [snapshot['hash'] for snapshot
+            in snapshots.snapshots(cache_folder_path)] \
+        == [hash_data(b'first'), hash_data(b'second'), hash_data(b'first')]
+    folder_path = snapshots.contents.folder_path
+    assert len(list(folder_path.iterdir())) == 2
+
+    local_file_path.write_bytes(b'third')
+    snapshots.snapshot(local_file_path, local_file_path, cache_folder_path,
+                       history.uploaded, hash_data(b'third'))
+    local_file_path.write_bytes(b'fourth')
+    snapshots.snapshot(local_file_path, local_file_path, cache_folder_path,
+                       history.uploaded)
+    assert [snapshot['hash'] for snapshot
+            in snapshots.snapshots(cache_folder_path)] \
+        == [hash_data(b'fourth'), hash_data(b'third'), hash_data(b'first')]
+    assert len(list(folder_path.iterdir())) == 3
+
+    # Only the most recent snapshot is younger than the maximum age
+    time.sleep(.01)
+    snapshots.max_age_days = .001 / 86400
+    snapshots.apply_retention(cache_folder_path)
+    assert [snapshot['hash'] for snapshot
+            in snapshots.snapshots(cache_folder_path)] \
+        == [hash_data(b'fourth')]
+    assert len(list(folder_path.iterdir())) == 1
+
+
+def test_snapshots_share_the_contents_of_the_content_cache(tmp_path):
+    backend = InMemoryBackend({'id': b'aaaa'})
+    content_cache = config.content_cache(max_size=4)
+    snapshots = config.history(keep=2, content_cache_size=4)
+    local_file_path = tmp_path / 'db.kdbx'
+    cache_folder_path = tmp_path / 'cache'
+    for data in (b'aaaa', b'bbbb', b'cccc', b'dddd'):
+        write_old_file(local_file_path, data)
+        sync_utils.sync(local_file_path, 'id', cache_folder_path,
+                        backend=backend, content_cache=content_cache,
+                        snapshots=snapshots)
+
+    # Each content is stored once. The snapshotted ones are not evicted,
+    # nor counted in the size of the cache.
+    assert [snapshot['hash'] for snapshot
+            in snapshots.snapshots(cache_folder_path)] \
+        == [hash_data(b'dddd'), hash_data(b'cccc')]
+    assert sorted(path.name for path
+                  in content_cache.folder_path.iterdir()) \
+        == sorted(content_cache.path_of(hash_data(data)).name
+                  for data in (b'bbbb', b'cccc', b'dddd'))
+
+
+def test_conflicts_are_snapshotted_and_restored(tmp_path):
+    backend = InMemoryBackend({'id': b'synced'})
+    snapshots = config.history()
+    local_file_path = tmp_path / 'db.kdbx'
+    cache_folder_path = tmp_path / 'cache'
+    write_old_file(local_file_path, b'synced')
+    sync_utils.sync(local_file_path, 'id', cache_folder_path,
+                    backend=backend, snapshots=snapshots)
+
+    write_old_file(local_file_path, b'local change')
+    backend.put('id', b'cloud change')
+    with pytest.raises(SystemExit):
+        sync_utils.sync(local_file_path, 'id', cache_folder_path,
+                        backend=backend, snapshots=snapshots)
+    local_snapshot, cloud_snapshot = snapshots.snapshots(
+        cache_folder_path)[1::-1]
+    assert local_snapshot['origin'] == history.local_conflict
+    assert local_snapshot['hash'] == hash_data(b'local change')
+    assert cloud_snapshot['origin'] == history.cloud_conflict
+    assert cloud_snapshot['hash'] == hash_data(b'cloud change')
+
+    # `force-update local` discards the local change...
+    downloaded_file_path, data_hash = sync_utils.download_next_to(
+        local_file_path, 'id', backend)
+    sync_utils.update_local(local_file_path, downloaded_file_path,
+                            cache_folder_path, backend.get_metadata('id'),
+                            data_hash, snapshots=snapshots)
+    assert local_file_path.read_bytes() == b'cloud change'
+
+    # ... which can be restored, and is then uploaded
+    snapshots.restore(local_snapshot['id'], cache_folder_path)
+    assert local_file_path.read_bytes() == b'local change'
+    assert sync_utils.sync(local_file_path, 'id', cache_folder_path,
+                           backend=backend, snapshots=snapshots) \
+        == sync_utils.uploaded
+    assert backend.get('id') == b'local change'
+    assert [path.name for path in tmp_path.iterdir()
+            if path.name.startswith('.')] == []
+
+    with pytest.raises(SystemExit):
+        snapshots.restore(local_snapshot['id'], tmp_path / 'other_cache')
+
+
+def test_the_snapshots_are_opt_in(tmp_path):
+    config.state_store().put_config('db', dict(
+        local_file_path=str(tmp_path / 'db.kdbx'), cloud_file_id='id'))
+    assert config.sync_options('db')['snapshots'] is None
+    assert config.profile_history('db').keep == 0
+
+    config.set_option('history_keep', '10', 'db')
+    assert config.sync_options('db')['snapshots'].keep == 10
+
+
+def test_restore_applies_the_retention_policy_of_the_profile(tmp_path,
+                                                             monkeypatch):
+    home_path = tmp_path / 'home'
+    monkeypatch.setattr(config, 'default_config_path',
+                        str(home_path / '.keypass_google_drive_sync') + '/')
+    (tmp_path / 'SSO').mkdir()
+    (tmp_path / 'SSO' / 'token.json').write_text('{}')
+    local_file_path = tmp_path / 'db.kdbx'
+    local_file_path.write_bytes(b'')
+    config.set_option('credential_folder_path', str(tmp_path / 'SSO'), 'db')
+    config.set_option('local_file_path', str(local_file_path), 'db')
+    config.set_option('cloud_file_id', 'id', 'db')
+    config.set_option('history_keep', '20', 'db')
+    snapshots = config.profile_history('db')
+    assert snapshots.keep == 20
+    cache_folder_path = config.load_profile('db')['cache_folder_path']
+    for index in range(12):
+        local_file_path.write_bytes(str(index).encode())
+        snapshots.snapshot(local_file_path, local_file_path,
+                           cache_folder_path, history.uploaded)
+    oldest = snapshots.snapshots(cache_folder_path)[-1]
+    local_file_path.write_bytes(b'local change')
+
+    environment = dict(os.environ, HOME=str(home_path),
+                       PYTHONPATH=os.pathsep.join(
+                           [str(Path(keypass_sync.__file__).parents[1])]
+                           + [path for path in sys.path if path]))
+    subprocess.run([sys.executable, '-m', 'keypass_sync', 'restore',
+                    str(oldest['id']), 'db'], check=True, env=environment)
+    assert local_file_path.read_bytes() == b'0'
+    assert len(snapshots.snapshots(cache_folder_path)) == 13
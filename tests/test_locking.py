@@ -0,0 +1,153 @@
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from keypass_sync import locking, metrics
+
+
+def run_in_thread(function)->tuple:
+    """Start `function` in a thread
+
+    Returns:
+        (thread, list that will hold the result of `function`)
+    """
+    results = []
+    thread = threading.Thread(target=lambda: results.append(function()))
+    thread.start()
+    return thread, results
+
+
+def test_single_flight_shares_the_result_of_the_running_operation(tmp_path):
+    started, finish = threading.Event(), threading.Event()
+    runs = []
+
+    def slow_run()->str:
+        runs.append('slow')
+        started.set()
+        finish.wait()
+        return 'uploaded'
+
+    slow_thread, slow_results = run_in_thread(
+        lambda: locking.single_flight(tmp_path, 'sync', slow_run))
+    started.wait()
+    with metrics.Recorder() as recorder:
+        assert locking.single_flight(
+            tmp_path, 'sync', lambda: runs.append('no-wait'),
+            wait=False) == locking.already_running
+    assert recorder.totals()['lock_wait']['count'] == 1
+
+    waiting_thread, waiting_results = run_in_thread(
+        lambda: locking.single_flight(tmp_path, 'sync',
+                                      lambda: runs.append('waiting'),
+                                      poll_interval=.01))
+    time.sleep(.2)
+    finish.set()
+    for thread in (slow_thread, waiting_thread):
+        thread.join()
+    assert slow_results == waiting_results == ['uploaded']
+    assert runs == ['slow']
+
+    # Another kind of operation, or a later one, runs
+    assert locking.single_flight(tmp_path, 'force-update local',
+                                 lambda: 'downloaded') == 'downloaded'
+    assert locking.single_flight(tmp_path, 'sync',
+                                 lambda: 'up to date') == 'up to date'
+    state = json.loads(locking.lock_path(tmp_path).read_text())
+    assert state['pid'] == os.getpid()
+    assert state['result'] == 'up to date'
+
+
+def test_single_flight_does_not_share_failures(tmp_path):
+    started, finish = threading.Event(), threading.Event()
+
+    def failing_run()->str:
+        started.set()
+        finish.wait()
+        return 'failed'
+
+    failing_thread, _ = run_in_thread(
+        lambda: locking.single_flight(tmp_path, 'sync', failing_run,
+                                      unshared=('failed',)))
+    started.wait()
+    waiting_thread, waiting_results = run_in_thread(
+        lambda: locking.single_flight(tmp_path, 'sync', lambda: 'uploaded',
+                                      unshared=('failed',),
+                                      poll_interval=.01))
+    time.sleep(.2)
+    finish.set()
+    for thread in (failing_thread, waiting_thread):
+        thread.join()
+    assert waiting_results == ['uploaded']
+
+
+def test_stale_locks_are_replaced(tmp_path):
+    dead_process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead_process.wait()
+    path = locking.lock_path(tmp_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Held by a file descriptor that the dead process left behind
+    file_descriptor = os.open(str(path), os.O_RDWR | os.O_CREAT)
+    fcntl.flock(file_descriptor, fcntl.LOCK_EX)
+    path.write_text(json.dumps(dict(pid=dead_process.pid,
+                                    host=locking.socket.gethostname(),
+                                    operation='sync')))
+    try:
+        assert locking.single_flight(tmp_path, 'sync', lambda: 'uploaded',
+                                     wait=False) == 'uploaded'
+    finally:
+        os.close(file_descriptor)
+
+
+def test_a_replaced_stale_lock_is_not_removed_again(tmp_path):
+    path = locking.lock_path(tmp_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text('{}')
+    # Two invocations opened the same stale lock file
+    first, second = (os.open(str(path), os.O_RDWR) for _ in range(2))
+    try:
+        assert locking._remove_if_current(first, path)
+        # The first one locks its new lock file
+        path.write_text('{}')
+        assert not locking._remove_if_current(second, path)
+        assert path.exists()
+    finally:
+        os.close(first)
+        os.close(second)
+
+
+def test_the_state_of_a_finished_holder_is_not_stale(tmp_path):
+    dead_process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead_process.wait()
+    path = locking.lock_path(tmp_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Its result is still to be checked by the next holder
+    path.write_text(json.dumps(dict(
+        pid=dead_process.pid, host=locking.socket.gethostname(),
+        operation='sync', finished_ns=time.time_ns() + 10**12,
+        result='uploaded')))
+    checking, finish = threading.Event(), threading.Event()
+    runs = []
+
+    def is_current()->bool:
+        checking.set()
+        finish.wait()
+        return False
+
+    holder_thread, holder_results = run_in_thread(
+        lambda: locking.single_flight(tmp_path, 'sync',
+                                      lambda: runs.append('holder'),
+                                      is_current=is_current))
+    checking.wait()
+    try:
+        assert locking.single_flight(
+            tmp_path, 'sync', lambda: runs.append('contender'),
+            wait=False) == locking.already_running
+    finally:
+        finish.set()
+        holder_thread.join()
+    assert runs == ['holder']
+    assert locking.is_stale(json.loads(path.read_text())) is False
@@ -0,0 +1,34 @@
+import json
+
+from keypass_sync import metrics
+
+
+def test_spans_are_recorded_and_exported(tmp_path):
+    with metrics.span('ignored'):
+        pass
+
+    with metrics.Recorder(version='default') as recorder:
+        with metrics.span('download') as download_span:
+            download_span.bytes_count = 10
+        with metrics.span('hash', 4):
+            pass
+        with metrics.span('hash', 6):
+            pass
+        recorder.result = 'downloaded'
+
+    assert [span.name for span in recorder.spans] \
+        == ['download', 'hash', 'hash']
+    assert recorder.totals()['hash']['bytes'] == 10
+    assert recorder.totals()['hash']['count'] == 2
+
+    recorder.write_json_line(tmp_path / 'metrics.log')
+    recorder.write_json_line(tmp_path / 'metrics.log')
+    lines = (tmp_path / 'metrics.log').read_text().splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[0])['result'] == 'downloaded'
+
+    recorder.write_textfile(tmp_path / 'keypass_sync.prom', success=True)
+    textfile = (tmp_path / 'keypass_sync.prom').read_text()
+    assert 'keypass_sync_last_run_success{version="default"} 1' in textfile
+    assert 'keypass_sync_phase_bytes{version="default",phase="hash"} 10' \
+        in textfile
@@ -0,0 +1,148 @@
+import io
+import threading
+import time
+
+import pytest
+
+from keypass_sync.backends.memory import InMemoryBackend
+from keypass_sync.backends.scheduled import ScheduledBackend, TokenBucket, \
+    is_retryable, is_throttled
+
+
+class HttpError(Exception):
+    def __init__(self, status, content=b'', retry_after=None):
+        super().__init__(status)
+        self.status = status
+        self.content = content
+        self.retry_after = retry_after
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, delay):
+        if delay:
+            self.sleeps.append(delay)
+        self.now += delay
+
+
+def scheduled(backend, clock, **kwargs):
+    return ScheduledBackend(backend, clock=clock, sleep=clock.sleep, seed=0,
+                            **kwargs)
+
+
+def test_errors_are_classified():
+    assert is_throttled(HttpError(429))
+    assert is_throttled(HttpError(403, b'{"reason": "userRateLimitExceeded"}'))
+    assert not is_throttled(HttpError(403, b'{"reason": "forbidden"}'))
+    assert is_retryable(HttpError(503))
+    assert is_retryable(ConnectionError())
+    assert not is_retryable(HttpError(404))
+    assert not is_retryable(FileNotFoundError())
+
+
+def test_transient_failures_are_retried_with_backoff():
+    clock = FakeClock()
+    memory_backend = InMemoryBackend(dict(id=b'content'))
+    backend = scheduled(memory_backend, clock, base_delay=1., max_retries=3)
+
+    memory_backend.fail_next(2)
+    assert backend.get_metadata('id')['size'] == '7'
+    assert memory_backend.calls['get_metadata'] == 3
+    assert backend.retries == 2
+    assert len(clock.sleeps) == 2
+    # Full jitter, below the exponential backoff
+    assert 0 <= clock.sleeps[0] <= 1. and 0 <= clock.sleeps[1] <= 2.
+
+    memory_backend.fail_next(4)
+    with pytest.raises(ConnectionError):
+        backend.get_metadata('id')
+
+    with pytest.raises(FileNotFoundError):
+        backend.get_metadata('missing')
+    assert backend.retries == 5
+
+
+def test_throttled_calls_wait_as_asked():
+    clock = FakeClock()
+    memory_backend = InMemoryBackend(dict(id=b'content'))
+    backend = scheduled(memory_backend, clock, rate=1., burst=10)
+
+    memory_backend.fail_next(error=HttpError(429, retry_after=30))
+    backend.get_metadata('id')
+    assert backend.throttled == 1
+    assert clock.sleeps[0] == 30
+    # The bucket was paused for every call
+    clock.sleeps.clear()
+    backend.get_metadata('id')
+    assert sum(clock.sleeps) > 0
+
+
+def test_uploads_are_retried_from_the_start():
+    clock = FakeClock()
+    memory_backend = InMemoryBackend(dict(id=b'content'))
+    backend = scheduled(memory_backend, clock)
+    file_object = io.BytesIO(b'header new content')
+    file_object.seek(7)
+
+    memory_backend.fail_next()
+    backend.upload_from(file_object, 'id', 'db.kdbx')
+    assert memory_backend.get('id') == b'new content'
+
+
+def test_partial_downloads_are_not_retried():
+    class FailingWriter:
+        def __init__(self):
+            self.data = b''
+
+        def write(self, data):
+            self.data += data
+            raise ConnectionError
+
+    clock = FakeClock()
+    backend = scheduled(InMemoryBackend(dict(id=b'content')), clock)
+    with pytest.raises(ConnectionError):
+        backend.download_to('id', FailingWriter())
+    assert backend.retries == 0
+
+
+def test_token_bucket_limits_the_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2., capacity=2, clock=clock)
+    waits = []
+    for _ in range(6):
+        waits.append(bucket.reserve())
+        clock.sleep(waits[-1])
+    assert waits[:2] == [0., 0.]
+    assert waits[2:] == [.5] * 4
+
+
+def test_concurrency_is_limited():
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    class SlowBackend(InMemoryBackend):
+        def get_metadata(self, file_id):
+            with lock:
+                running.append(file_id)
+                peak.append(len(running))
+            time.sleep(.02)
+            with lock:
+                running.remove(file_id)
+            return super().get_metadata(file_id)
+
+    backend = ScheduledBackend(SlowBackend(dict(id=b'content')), rate=1000.,
+                               burst=1000, max_concurrency=2)
+    threads = [threading.Thread(target=backend.get_metadata, args=('id',))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(peak) == 2
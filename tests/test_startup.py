@@ -0,0 +1,92 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import keypass_sync
+from keypass_sync import config
+
+# Top-level packages of the google-api stack
+google_stack = ('google', 'googleapiclient', 'google_services',
+                'google_auth_httplib2', 'httplib2')
+
+# Replaces the google-api stack with stubs recording their imports, then
+# syncs the `default` profile and loads it. Prints the google modules
+# imported by each step.
+stubbed_sync = '''
+import importlib.abc
+import importlib.machinery
+import json
+import sys
+import unittest.mock
+
+imported = []
+
+
+class StubFinder(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    def find_spec(self, name, path=None, target=None):
+        if name.split('.')[0] in sys.argv[2].split(','):
+            imported.append(name)
+            return importlib.machinery.ModuleSpec(name, self,
+                                                  is_package=True)
+
+    def create_module(self, spec):
+        return unittest.mock.MagicMock(__path__=[])
+
+    def exec_module(self, module):
+        pass
+
+
+sys.meta_path.insert(0, StubFinder())
+
+from keypass_sync import config, sync_utils
+from keypass_sync.backends.memory import InMemoryBackend
+
+config.default_config_path = sys.argv[1]
+steps = dict(result=sync_utils.sync_version(
+    '', backend=InMemoryBackend(dict(id=b'content'))))
+steps['sync'] = list(imported)
+config.load()
+steps['load'] = imported[len(steps['sync']):]
+print(json.dumps(steps))
+'''
+
+
+def package_environment()->dict:
+    """Return the environment running the package from this tree"""
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [str(Path(keypass_sync.__file__).parents[1])]
+        + [path for path in sys.path if path]))
+
+
+def test_help_does_not_import_the_google_stack():
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-m', 'keypass_sync', 'help'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True,
+        env=package_environment()).stderr.decode()
+    imported = [line.split('|')[-1].strip() for line in stderr.splitlines()
+                if line.startswith('import time:')]
+    assert not [module for module in imported
+                if module.split('.')[0] in google_stack]
+
+
+def test_the_google_stack_is_imported_once_needed(tmp_path):
+    (tmp_path / 'SSO').mkdir()
+    (tmp_path / 'SSO' / 'token.json').write_text('{}')
+    (tmp_path / 'db.kdbx').write_bytes(b'content')
+    config.state_store().put_config('default', dict(
+        credential_folder_path=str(tmp_path / 'SSO'),
+        local_file_path=str(tmp_path / 'db.kdbx'), cloud_file_id='id',
+        cache_folder=str(tmp_path / 'cache')))
+
+    steps = json.loads(subprocess.run(
+        [sys.executable, '-c', stubbed_sync, config.default_config_path,
+         ','.join(google_stack)],
+        stdout=subprocess.PIPE, check=True,
+        env=package_environment()).stdout.decode().splitlines()[-1])
+    assert steps['result'] == 'up to date'
+    # Synced with an in-memory backend: no google-drive client needed
+    assert steps['sync'] == []
+    # Setting the credentials of google_services
+    assert steps['load'] == ['google_services']
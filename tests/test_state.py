@@ -0,0 +1,66 @@
+import json
+import threading
+
+import pytest
+
+from keypass_sync import state
+
+
+def test_state_store_saves_configs_and_entries(tmp_path):
+    store = state.StateStore(tmp_path / 'state.sqlite3')
+    store.put_config('first', dict(cloud_file_id='id'))
+    store.put_config('second', dict(cloud_file_id='id'))
+    store.put_entries(tmp_path / 'cache', {'file.sha': 'hash'})
+
+    store = state.StateStore(tmp_path / 'state.sqlite3')
+    assert store.get_config('first') == dict(cloud_file_id='id')
+    assert store.get_config('missing') is None
+    assert store.versions() == ['first', 'second']
+    assert store.versions_of('id') == ['first', 'second']
+    assert store.entries(tmp_path / 'cache') == {'file.sha': 'hash'}
+
+    store.put_entries(tmp_path / 'cache', {'file.sha': None})
+    assert store.get_entry(tmp_path / 'cache', 'file.sha') is None
+
+
+def test_state_store_transactions_are_atomic(tmp_path):
+    store = state.StateStore(tmp_path / 'state.sqlite3')
+    with pytest.raises(RuntimeError):
+        with store.transaction():
+            store.put_entries(tmp_path / 'cache', {'file.sha': 'hash'})
+            raise RuntimeError
+    assert store.entries(tmp_path / 'cache') == {}
+
+
+def test_state_store_imports_the_files_of_older_versions(tmp_path):
+    (tmp_path / 'default').write_text(json.dumps(dict(cloud_file_id='id')))
+    (tmp_path / 'default_cache').mkdir()
+    (tmp_path / 'default_cache' / 'file.sha').write_text('hash')
+    store = state.StateStore(tmp_path / '.state.sqlite3')
+
+    assert store.import_configs(tmp_path) == ['default']
+    assert store.get_config('default') == dict(cloud_file_id='id')
+    assert store.entries(tmp_path / 'default_cache') == {'file.sha': 'hash'}
+
+    # The files are only imported once
+    (tmp_path / 'default_cache' / 'file.sha').write_text('other hash')
+    (tmp_path / 'other').write_text(json.dumps(dict(cloud_file_id='id')))
+    assert store.import_configs(tmp_path) == []
+    assert store.versions() == ['default']
+    assert store.entries(tmp_path / 'default_cache') == {'file.sha': 'hash'}
+
+
+def test_state_store_is_shared_between_threads(tmp_path):
+    store = state.open_store(tmp_path / 'state.sqlite3')
+    assert state.open_store(tmp_path / 'state.sqlite3') is store
+
+    def put(index):
+        store.put_entries(tmp_path / 'cache', {f'entry {index}': 'value'})
+
+    threads = [threading.Thread(target=put, args=(index,))
+               for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(store.entries(tmp_path / 'cache')) == 8
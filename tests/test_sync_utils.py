@@ -0,0 +1,480 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from keypass_sync import config, hashing, sync_utils
+from keypass_sync.backends.memory import InMemoryBackend
+
+
+def test_sync_skips_download_when_remote_unchanged(tmp_path):
+    local_file_path = tmp_path / 'db.kdbx'
+    local_file_path.write_bytes(b'content')
+    cache_folder_path = tmp_path / 'cache'
+    backend = InMemoryBackend(dict(id=b'content'))
+
+    sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend)
+    assert backend.calls['download_to'] == 1
+
+    sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend)
+    assert backend.calls['download_to'] == 1
+
+    local_file_path.write_bytes(b'new content')
+    sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend)
+    assert backend.calls['download_to'] == 1
+    assert backend.get('id') == b'new content'
+
+    sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend)
+    assert backend.calls['download_to'] == 1
+
+
+def test_sync_downloads_remote_updates(tmp_path):
+    local_file_path = tmp_path / 'db.kdbx'
+    local_file_path.write_bytes(b'content')
+    cache_folder_path = tmp_path / 'cache'
+    backend = InMemoryBackend(dict(id=b'content'))
+    sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend)
+
+    backend.put('id', b'remote content')
+    sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend)
+    assert backend.calls['download_to'] == 2
+    assert local_file_path.read_bytes() == b'remote content'
+
+
+def test_sync_detects_conflicts(tmp_path):
+    local_file_path = tmp_path / 'db.kdbx'
+    local_file_path.write_bytes(b'content')
+    cache_folder_path = tmp_path / 'cache'
+    backend = InMemoryBackend(dict(id=b'content'))
+    sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend)
+
+    local_file_path.write_bytes(b'local content')
+    backend.put('id', b'remote content')
+    with pytest.raises(SystemExit):
+        sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend)
+    assert local_file_path.read_bytes() == b'local content'
+    assert backend.get('id') == b'remote content'
+
+
+def test_sync_does_not_read_untouched_local_file(tmp_path, monkeypatch):
+    local_file_path = tmp_path / 'db.kdbx'
+    local_file_path.write_bytes(b'content')
+    os.utime(local_file_path, ns=(0, 0))
+    cache_folder_path = tmp_path / 'cache'
+    backend = InMemoryBackend(dict(id=b'content'))
+    sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend)
+
+    reads = []
+    hash_file = hashing.hash_file
+    monkeypatch.setattr(hashing, 'hash_file',
+                        lambda path, **kwargs: reads.append(path)
+                        or hash_file(path, **kwargs))
+    sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend)
+    assert reads == []
+
+    # Paranoid mode
+    sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend,
+                    rehash_every=2)
+    assert reads == [local_file_path]
+
+
+def test_sync_hashes_a_changed_local_file_once(tmp_path, monkeypatch):
+    local_file_path = tmp_path / 'db.kdbx'
+    local_file_path.write_bytes(b'content')
+    cache_folder_path = tmp_path / 'cache'
+    backend = InMemoryBackend(dict(id=b'content'))
+    sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend)
+
+    hashed = []
+    new_hasher = hashing.new_hasher
+
+    def counting_hasher(*args)->hashing.Hasher:
+        hasher = new_hasher(*args)
+        update = hasher.update
+        hasher.update = lambda data: hashed.append(len(data)) or update(data)
+        return hasher
+
+    monkeypatch.setattr(hashing, 'new_hasher', counting_hasher)
+    local_file_path.write_bytes(b'new content')
+    assert sync_utils.sync(local_file_path, 'id', cache_folder_path,
+                           backend=backend) == sync_utils.uploaded
+    assert sum(hashed) == len(b'new content')
+    assert backend.get('id') == b'new content'
+
+
+def test_sync_leaves_no_temporary_file(tmp_path):
+    local_file_path = tmp_path / 'db.kdbx'
+    local_file_path.write_bytes(b'content')
+    cache_folder_path = tmp_path / 'cache'
+    backend = InMemoryBackend(dict(id=b'content'))
+    sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend)
+    backend.put('id', b'remote content')
+    sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend)
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['db.kdbx']
+
+
+def test_sync_all_reports_each_version(tmp_path, config_folder):
+    # Configs saved as json files by the older versions
+    config_path = config_folder
+    (config_path / 'SSO').mkdir(parents=True)
+    (config_path / 'SSO' / 'token.json').write_text('{}')
+    for version in ['first', 'second']:
+        (tmp_path / f'{version}.kdbx').write_bytes(b'content')
+        (config_path / version).write_text(json.dumps(dict(
+            credential_folder_path=str(config_path / 'SSO'),
+            local_file_path=str(tmp_path / f'{version}.kdbx'),
+            cloud_file_id=version,
+            cache_folder=str(config_path / f'{version}_cache'))))
+    (config_path / 'broken').write_text(json.dumps(dict(
+        credential_folder_path=str(config_path / 'SSO'),
+        local_file_path=str(tmp_path / 'missing.kdbx'),
+        cloud_file_id='broken')))
+
+    assert sync_utils.sync_all(backend=InMemoryBackend(
+        dict(first=b'content', second=b'content'))) == dict(
+        broken=sync_utils.failed, first=sync_utils.up_to_date,
+        second=sync_utils.up_to_date)
+
+
+def test_sync_imports_the_cache_files_of_older_versions(tmp_path):
+    local_file_path = tmp_path / 'db.kdbx'
+    local_file_path.write_bytes(b'content')
+    cache_folder_path = tmp_path / 'cache'
+    cache_folder_path.mkdir()
+    (cache_folder_path / 'file.sha').write_text(
+        hashing.hash_data(b'content'))
+    backend = InMemoryBackend(dict(id=b'content'))
+    (cache_folder_path / 'remote.json').write_text(
+        json.dumps(backend.get_metadata('id')))
+
+    # No false conflict, no download
+    local_file_path.write_bytes(b'local content')
+    assert sync_utils.sync(local_file_path, 'id', cache_folder_path,
+                           backend=backend) == sync_utils.uploaded
+    assert backend.calls['download_to'] == 0
+    assert backend.get('id') == b'local content'
+
+
+def test_sync_all_only_checks_the_changed_cloud_files(tmp_path):
+    (tmp_path / 'SSO').mkdir()
+    (tmp_path / 'SSO' / 'token.json').write_text('{}')
+    for version in ['first', 'second']:
+        (tmp_path / f'{version}.kdbx').write_bytes(b'content')
+        config.state_store().put_config(version, dict(
+            credential_folder_path=str(tmp_path / 'SSO'),
+            local_file_path=str(tmp_path / f'{version}.kdbx'),
+            cloud_file_id=version,
+            cache_folder=str(tmp_path / f'{version}_cache')))
+    backend = InMemoryBackend(dict(first=b'content', second=b'content'))
+
+    # The metadata are fetched in one batch
+    assert set(sync_utils.sync_all(backend=backend).values()) \
+        == {sync_utils.up_to_date}
+    assert backend.calls['get_metadata_batch'] == 1
+    assert backend.calls['get_metadata'] == 0
+
+    # Nothing changed: no metadata request
+    assert set(sync_utils.sync_all(backend=backend).values()) \
+        == {sync_utils.up_to_date}
+    assert backend.calls['get_metadata_batch'] == 1
+    assert backend.calls['list_changes'] == 1
+
+    backend.put('second', b'remote content')
+    (tmp_path / 'first.kdbx').write_bytes(b'local content')
+    assert sync_utils.sync_all(backend=backend) == dict(
+        first=sync_utils.uploaded, second=sync_utils.downloaded)
+    assert backend.calls['get_metadata_batch'] == 2
+    assert (tmp_path / 'second.kdbx').read_bytes() == b'remote content'
+
+    # The upload shows in the changes feed, but is not downloaded back
+    assert set(sync_utils.sync_all(backend=backend).values()) \
+        == {sync_utils.up_to_date}
+    assert backend.calls['get_metadata_batch'] == 3
+    assert backend.calls['get_metadata'] == 0
+    assert backend.calls['download_to'] == 3
+
+
+def test_sync_all_lists_the_changes_again_after_a_failure(tmp_path):
+    (tmp_path / 'SSO').mkdir()
+    (tmp_path / 'SSO' / 'token.json').write_text('{}')
+    (tmp_path / 'db.kdbx').write_bytes(b'content')
+    config.state_store().put_config('default', dict(
+        credential_folder_path=str(tmp_path / 'SSO'),
+        local_file_path=str(tmp_path / 'db.kdbx'), cloud_file_id='id',
+        cache_folder=str(tmp_path / 'cache')))
+    backend = InMemoryBackend(dict(id=b'content'))
+    sync_utils.sync_all(backend=backend)
+
+    # Conflict
+    backend.put('id', b'remote content')
+    (tmp_path / 'db.kdbx').write_bytes(b'local content')
+    assert sync_utils.sync_all(backend=backend) == dict(
+        default=sync_utils.failed)
+
+    # Solved
+    (tmp_path / 'db.kdbx').write_bytes(b'content')
+    assert sync_utils.sync_all(backend=backend) == dict(
+        default=sync_utils.downloaded)
+
+
+def test_sync_all_of_a_subset_keeps_the_changes_of_the_others(tmp_path):
+    (tmp_path / 'SSO').mkdir()
+    (tmp_path / 'SSO' / 'token.json').write_text('{}')
+    for version in ['first', 'second']:
+        (tmp_path / f'{version}.kdbx').write_bytes(b'content')
+        config.state_store().put_config(version, dict(
+            credential_folder_path=str(tmp_path / 'SSO'),
+            local_file_path=str(tmp_path / f'{version}.kdbx'),
+            cloud_file_id=version,
+            cache_folder=str(tmp_path / f'{version}_cache')))
+    backend = InMemoryBackend(dict(first=b'content', second=b'content'))
+    sync_utils.sync_all(backend=backend)
+
+    backend.put('second', b'remote content')
+    assert sync_utils.sync_all(['first'], backend=backend) == dict(
+        first=sync_utils.up_to_date)
+    assert sync_utils.sync_all(backend=backend) == dict(
+        first=sync_utils.up_to_date, second=sync_utils.downloaded)
+    assert (tmp_path / 'second.kdbx').read_bytes() == b'remote content'
+
+
+class InterruptedUpload(Exception):
+    pass
+
+
+def interrupt_upload_after(backend, chunk_count):
+    """Make the upload of `backend` fail after `chunk_count` chunks"""
+    upload_chunk = backend.upload_chunk
+
+    def interrupted_upload_chunk(*args):
+        if backend.calls['upload_chunk'] >= chunk_count:
+            backend.upload_chunk = upload_chunk
+            raise InterruptedUpload
+        return upload_chunk(*args)
+    backend.upload_chunk = interrupted_upload_chunk
+
+
+def test_interrupted_uploads_resume(tmp_path):
+    local_file_path = tmp_path / 'db.kdbx'
+    local_file_path.write_bytes(b'content')
+    cache_folder_path = tmp_path / 'cache'
+    backend = InMemoryBackend(dict(id=b'content'))
+    sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend)
+
+    local_file_path.write_bytes(b'0123456789' * 4)
+    os.utime(local_file_path, ns=(0, 0))
+    interrupt_upload_after(backend, 2)
+    with pytest.raises(InterruptedUpload):
+        sync_utils.sync(local_file_path, 'id', cache_folder_path,
+                        backend=backend, upload_chunk_size=16)
+    assert backend.bytes_uploaded == 32
+
+    assert sync_utils.sync(local_file_path, 'id', cache_folder_path,
+                           backend=backend, upload_chunk_size=16) \
+        == sync_utils.uploaded
+    assert backend.calls['start_upload'] == 1
+    assert backend.bytes_uploaded == 40
+    assert backend.get('id') == b'0123456789' * 4
+    assert sync_utils.sync(local_file_path, 'id', cache_folder_path,
+                           backend=backend) == sync_utils.up_to_date
+
+
+def test_uploads_restart_if_the_session_or_the_file_changed(tmp_path):
+    local_file_path = tmp_path / 'db.kdbx'
+    local_file_path.write_bytes(b'0123456789' * 4)
+    cache_folder_path = tmp_path / 'cache'
+    backend = InMemoryBackend()
+
+    interrupt_upload_after(backend, 1)
+    with pytest.raises(InterruptedUpload):
+        sync_utils.update_cloud(local_file_path, 'id', cache_folder_path,
+                                backend=backend, chunk_size=16)
+    backend.expire_upload_sessions()
+    sync_utils.update_cloud(local_file_path, 'id', cache_folder_path,
+                            backend=backend, chunk_size=16)
+    assert backend.calls['start_upload'] == 2
+    assert backend.get('id') == b'0123456789' * 4
+
+    interrupt_upload_after(backend, backend.calls['upload_chunk'] + 1)
+    with pytest.raises(InterruptedUpload):
+        sync_utils.update_cloud(local_file_path, 'id', cache_folder_path,
+                                backend=backend, chunk_size=16)
+    local_file_path.write_bytes(b'9876543210' * 4)
+    sync_utils.update_cloud(local_file_path, 'id', cache_folder_path,
+                            backend=backend, chunk_size=16)
+    assert backend.calls['start_upload'] == 4
+    assert backend.get('id') == b'9876543210' * 4
+
+
+def test_uploads_do_not_overwrite_concurrent_cloud_changes(tmp_path):
+    local_file_path = tmp_path / 'db.kdbx'
+    local_file_path.write_bytes(b'content')
+    cache_folder_path = tmp_path / 'cache'
+    backend = InMemoryBackend(dict(id=b'content'))
+    sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend)
+
+    # Another client uploads while the local change is being uploaded
+    local_file_path.write_bytes(b'0123456789' * 4)
+    os.utime(local_file_path, ns=(0, 0))
+    upload_chunk = backend.upload_chunk
+
+    def concurrent_upload_chunk(*args):
+        if backend.calls['upload_chunk'] == 1:
+            backend.put('id', b'cloud change')
+        return upload_chunk(*args)
+    backend.upload_chunk = concurrent_upload_chunk
+    with pytest.raises(SystemExit):
+        sync_utils.sync(local_file_path, 'id', cache_folder_path,
+                        backend=backend, upload_chunk_size=16)
+    assert backend.get('id') == b'cloud change'
+    assert backend.calls['get_metadata'] == 3
+    assert config.state_store().get_entry(cache_folder_path,
+                                          'upload.json') is None
+
+
+def test_large_files_are_downloaded_by_ranges(tmp_path):
+    local_file_path = tmp_path / 'db.kdbx'
+    local_file_path.write_bytes(b'content')
+    cache_folder_path = tmp_path / 'cache'
+    backend = InMemoryBackend(dict(id=b'content'))
+    sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend)
+
+    content = bytes(range(256)) * 10
+    backend.put('id', content)
+    assert sync_utils.sync(local_file_path, 'id', cache_folder_path,
+                           backend=backend, download_chunk_size=256) \
+        == sync_utils.downloaded
+    assert backend.calls['download_range'] == 10
+    assert backend.calls['download_to'] == 1
+    assert local_file_path.read_bytes() == content
+    assert sync_utils.load_entry_from_cache('file.sha', cache_folder_path) \
+        == hashing.hash_data(content)
+
+
+def test_ranged_downloads_check_the_revision(tmp_path):
+    local_file_path = tmp_path / 'db.kdbx'
+    backend = InMemoryBackend(dict(id=b'0123456789' * 10))
+    metadata = backend.get_metadata('id')
+    download_range = backend.download_range
+
+    def changing_download_range(file_id, start, end):
+        if start:
+            # Another client replaced the file during the download
+            backend.put('id', b'9876543210' * 10)
+        return download_range(file_id, start, end)
+    backend.download_range = changing_download_range
+
+    with pytest.raises(IOError):
+        sync_utils.download_next_to(local_file_path, 'id', backend, metadata,
+                                    chunk_size=10)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_downloads_fall_back_to_a_single_stream(tmp_path):
+    local_file_path = tmp_path / 'db.kdbx'
+    backend = InMemoryBackend(dict(id=b'0123456789' * 10))
+
+    def download_range(file_id, start, end):
+        raise NotImplementedError
+    backend.download_range = download_range
+
+    downloaded_file_path, data_hash = sync_utils.download_next_to(
+        local_file_path, 'id', backend, backend.get_metadata('id'),
+        chunk_size=10)
+    assert downloaded_file_path.read_bytes() == b'0123456789' * 10
+    assert data_hash == hashing.hash_data(b'0123456789' * 10)
+    assert backend.calls['download_to'] == 1
+
+
+def test_sha3_hashes_migrate_without_conflict(tmp_path):
+    local_file_path = tmp_path / 'db.kdbx'
+    local_file_path.write_bytes(b'content')
+    os.utime(local_file_path, ns=(0, 0))
+    cache_folder_path = tmp_path / 'cache'
+    backend = InMemoryBackend(dict(id=b'content'))
+    sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend,
+                    hash_algorithm='sha3_512')
+    assert sync_utils.load_entry_from_cache('file.sha', cache_folder_path) \
+        == hashing.hash_data(b'content', 'sha3_512')
+
+    backend.put('id', b'remote content')
+    assert sync_utils.sync(local_file_path, 'id', cache_folder_path,
+                           backend=backend) == sync_utils.downloaded
+    assert local_file_path.read_bytes() == b'remote content'
+    assert sync_utils.load_entry_from_cache('file.sha', cache_folder_path) \
+        == hashing.hash_data(b'remote content')
+
+
+def test_hashes_of_a_changed_file_migrate_at_the_next_sync(tmp_path):
+    local_file_path = tmp_path / 'db.kdbx'
+    local_file_path.write_bytes(b'content')
+    cache_folder_path = tmp_path / 'cache'
+    backend = InMemoryBackend(dict(id=b'content'))
+    sync_utils.sync(local_file_path, 'id', cache_folder_path, backend=backend,
+                    hash_algorithm='sha3_512')
+
+    # The conflict is still detected with the old hash
+    local_file_path.write_bytes(b'local content')
+    backend.put('id', b'remote content')
+    with pytest.raises(SystemExit):
+        sync_utils.sync(local_file_path, 'id', cache_folder_path,
+                        backend=backend, hash_algorithm='blake2b')
+
+    local_file_path.write_bytes(b'content')
+    os.utime(local_file_path, ns=(0, 0))
+    backend.put('id', b'content')
+    assert sync_utils.sync(local_file_path, 'id', cache_folder_path,
+                           backend=backend, hash_algorithm='blake2b') \
+        == sync_utils.up_to_date
+    assert sync_utils.sync(local_file_path, 'id', cache_folder_path,
+                           backend=backend, hash_algorithm='blake2b') \
+        == sync_utils.up_to_date
+    assert sync_utils.load_entry_from_cache('file.sha', cache_folder_path) \
+        == hashing.hash_data(b'content', 'blake2b')
+
+
+def test_a_waiting_sync_runs_again_after_a_local_save(tmp_path,
+                                                     monkeypatch):
+    (tmp_path / 'SSO').mkdir()
+    (tmp_path / 'SSO' / 'token.json').write_text('{}')
+    local_file_path = tmp_path / 'db.kdbx'
+    local_file_path.write_bytes(b'content')
+    config.state_store().put_config('default', dict(
+        credential_folder_path=str(tmp_path / 'SSO'),
+        local_file_path=str(local_file_path), cloud_file_id='id',
+        cache_folder=str(tmp_path / 'cache')))
+    backend = InMemoryBackend(dict(id=b'content'))
+    sync_utils.sync_version('', backend=backend)
+
+    # The file is saved again once the first sync recorded its upload
+    recorded, finish = threading.Event(), threading.Event()
+    cache_entries = sync_utils.cache_entries
+
+    def slow_cache_entries(entries: dict, *args)->None:
+        cache_entries(entries, *args)
+        if 'remote.json' in entries and not recorded.is_set():
+            recorded.set()
+            finish.wait()
+
+    monkeypatch.setattr(sync_utils, 'cache_entries', slow_cache_entries)
+    local_file_path.write_bytes(b'first save')
+    results = {}
+    first_sync = threading.Thread(target=lambda: results.update(
+        first=sync_utils.sync_version('', backend=backend)))
+    first_sync.start()
+    recorded.wait()
+    local_file_path.write_bytes(b'second save')
+    waiting_sync = threading.Thread(target=lambda: results.update(
+        waiting=sync_utils.sync_version('', backend=backend)))
+    waiting_sync.start()
+    time.sleep(.2)
+    finish.set()
+    for thread in (first_sync, waiting_sync):
+        thread.join()
+
+    assert results == dict(first=sync_utils.uploaded,
+                           waiting=sync_utils.uploaded)
+    assert backend.get('id') == b'second save'
@@ -0,0 +1,166 @@
+import os
+import queue
+import threading
+import time
+
+import pytest
+
+from keypass_sync import config, sync_utils, watch
+from keypass_sync.backends.memory import InMemoryBackend
+
+
+@pytest.mark.parametrize('watcher_class', [watch.PollingWatcher,
+                                           watch.InotifyWatcher])
+def test_watcher_detects_writes_and_replacements(tmp_path, watcher_class):
+    path = tmp_path / 'db.kdbx'
+    path.write_bytes(b'content')
+    os.utime(path, ns=(0, 0))
+    try:
+        watcher = watcher_class([path])
+    except OSError:
+        pytest.skip('inotify is not available')
+    try:
+        assert watcher.wait(.1) == set()
+
+        path.write_bytes(b'new content')
+        assert watcher.wait(1.) == {path}
+
+        (tmp_path / 'saved').write_bytes(b'saved content')
+        os.replace(str(tmp_path / 'saved'), str(path))
+        assert path in watcher.wait(1.)
+    finally:
+        watcher.close()
+
+
+@pytest.mark.parametrize('watcher_class', [watch.PollingWatcher,
+                                           watch.InotifyWatcher])
+def test_watcher_detects_the_changes_inside_a_folder(tmp_path, watcher_class):
+    folder_path = tmp_path / 'folder'
+    folder_path.mkdir()
+    path = folder_path / 'db.kdbx'
+    path.write_bytes(b'content')
+    os.utime(path, ns=(0, 0))
+    try:
+        watcher = watcher_class([folder_path])
+    except OSError:
+        pytest.skip('inotify is not available')
+    try:
+        assert watcher.wait(.1) == set()
+
+        path.write_bytes(b'new content')
+        assert watcher.wait(1.) == {folder_path}
+
+        (folder_path / 'key.key').write_bytes(b'key')
+        assert watcher.wait(1.) == {folder_path}
+
+        # Hidden files are not synced
+        (folder_path / '.lock').write_bytes(b'')
+        assert watcher.wait(.1) == set()
+    finally:
+        watcher.close()
+
+
+class FakeWatcher:
+    """Report the paths put in `changes`, as they are put"""
+    def __init__(self):
+        self.changes = queue.Queue()
+
+    def wait(self, timeout: float)->set:
+        try:
+            return {self.changes.get(timeout=max(0., timeout))}
+        except queue.Empty:
+            return set()
+
+    def close(self)->None:
+        pass
+
+
+def test_a_burst_of_saves_is_synced_once(tmp_path, monkeypatch):
+    (tmp_path / 'SSO').mkdir()
+    (tmp_path / 'SSO' / 'token.json').write_text('{}')
+    (tmp_path / 'db.kdbx').write_bytes(b'content')
+    config.state_store().put_config('default', dict(
+        credential_folder_path=str(tmp_path / 'SSO'),
+        local_file_path=str(tmp_path / 'db.kdbx'), cloud_file_id='id',
+        cache_folder=str(tmp_path / 'cache')))
+    path = config.load_profile('default')['local_file_path']
+    backend = InMemoryBackend(dict(id=b'content'))
+    watcher = FakeWatcher()
+    monkeypatch.setattr(watch, 'make_watcher', lambda paths: watcher)
+    syncs, synced_twice = [], threading.Event()
+    sync_all = watch.sync_all
+
+    def counting_sync_all(versions: list, **kwargs)->dict:
+        results = sync_all(versions, **kwargs)
+        syncs.append(results)
+        if len(syncs) == 2:
+            synced_twice.set()
+        return results
+
+    monkeypatch.setattr(watch, 'sync_all', counting_sync_all)
+    stop_event = threading.Event()
+    watching = threading.Thread(target=lambda: watch.watch(
+        ['default'], debounce=.2, remote_poll_interval=3600.,
+        backend=backend, stop_event=stop_event))
+    watching.start()
+    try:
+        # The first check of the cloud file
+        while not syncs:
+            time.sleep(.01)
+        for index in range(5):
+            path.write_bytes(f'save {index}'.encode())
+            watcher.changes.put(path)
+            time.sleep(.02)
+        assert synced_twice.wait(5.)
+        # Nothing left to sync
+        time.sleep(.5)
+    finally:
+        stop_event.set()
+        watching.join()
+
+    assert syncs == [dict(default=sync_utils.up_to_date),
+                     dict(default=sync_utils.uploaded)]
+    assert backend.get('id') == b'save 4'
+
+
+def test_watching_some_profiles_of_an_account_uses_the_changes_feed(
+        tmp_path, monkeypatch):
+    (tmp_path / 'SSO').mkdir()
+    (tmp_path / 'SSO' / 'token.json').write_text('{}')
+    for version in ['first', 'second']:
+        (tmp_path / f'{version}.kdbx').write_bytes(b'content')
+        config.state_store().put_config(version, dict(
+            credential_folder_path=str(tmp_path / 'SSO'),
+            local_file_path=str(tmp_path / f'{version}.kdbx'),
+            cloud_file_id=version,
+            cache_folder=str(tmp_path / f'{version}_cache')))
+    backend = InMemoryBackend(dict(first=b'content', second=b'content'))
+    monkeypatch.setattr(watch, 'make_watcher', lambda paths: FakeWatcher())
+    syncs, synced_thrice = [], threading.Event()
+    sync_all = watch.sync_all
+
+    def counting_sync_all(versions: list, **kwargs)->dict:
+        results = sync_all(versions, **kwargs)
+        syncs.append(results)
+        if len(syncs) == 3:
+            synced_thrice.set()
+        return results
+
+    monkeypatch.setattr(watch, 'sync_all', counting_sync_all)
+    stop_event = threading.Event()
+    watching = threading.Thread(target=lambda: watch.watch(
+        ['first'], debounce=.05, remote_poll_interval=.1,
+        backend=backend, stop_event=stop_event))
+    watching.start()
+    try:
+        assert synced_thrice.wait(5.)
+    finally:
+        stop_event.set()
+        watching.join()
+
+    assert syncs[:3] == [dict(first=sync_utils.up_to_date)] * 3
+    # The position of `first` moved forward, although `second` was not
+    # synced: the later polls only listed the changes
+    assert backend.calls['get_start_page_token'] == 1
+    assert backend.calls['get_metadata_batch'] == 1
+    assert backend.calls['list_changes'] >= 2